@@ -15,6 +15,7 @@
 from __future__ import annotations
 import numpy as np
 from pyhipp.core import DataDict, abc, DataTable, Num
+from pyhipp.core.dataproc import periodic
 from pyhipp.stats.summary import Summary
 from pyhipp.stats import Rng
 
@@ -119,8 +120,7 @@ class SimSample(abc.HasDictRepr):
 
     def __init__(self, l_box: float, data: DataTable):
 
-        assert (data['x'] >= 0).all()
-        assert (data['x'] < l_box).all()
+        assert periodic.in_bounds(data['x'], l_box)
 
         n_objs = len(data['x'])
 
@@ -1,4 +1,5 @@
-from . import data_structs, filter, frame, grid, mask, num, iter
+from . import (data_structs, filter, frame, grid, mask, num, iter, parallel,
+    periodic)
 
 from .data_structs import Array, Dict
 from .num import Num
@@ -1,5 +1,6 @@
 import numpy as np
 from .num import Num
+from . import periodic
 
 class Polar:
     @staticmethod
@@ -50,13 +51,7 @@ class PeriodicBox:
     def shift_in(x: np.ndarray, l_box: float, where=None, copy=True):
         if copy:
             x = x.copy()
-            
-        mask = PeriodicBox.__combine_mask(x < 0.0, where)
-        x[mask] += l_box
-            
-        mask = PeriodicBox.__combine_mask(x >= l_box, where)
-        x[mask] -= l_box
-            
+        periodic.wrap_in(x, l_box, where=where)
         return x
     
     @staticmethod
@@ -64,25 +59,18 @@ class PeriodicBox:
                  where=None, copy=True):
         if copy:
             x = x.copy()
-        l_half = .5 * l_box
-        dx = x - x_ref
-            
-        mask = PeriodicBox.__combine_mask(dx < -l_half, where)
-        x[mask] += l_box
-            
-        mask = PeriodicBox.__combine_mask(dx >= l_half, where)
-        x[mask] -= l_box
-            
+        periodic.shift_to(x, x_ref, l_box, where=where)
         return x
     
     @staticmethod
     def test_bound(x: np.ndarray, l_box: float, where=None):
+        x = np.asarray(x)
         if where is not None:
-            x = x[where]
-            
-        return ((x >= 0.0) & (x < l_box)).all()
-    
-    @staticmethod
-    def __combine_mask(mask, where):
-        return mask if where is None else mask & where
-    
\ No newline at end of file
+            where = np.asarray(where)
+            if where.dtype != bool:
+                x, where = x[where], None
+            else:
+                # a mask of the leading axes selects sub-arrays, as x[where]
+                where = where.reshape(
+                    where.shape + (1,) * (x.ndim - where.ndim))
+        return periodic.in_bounds(x, l_box, where=where)
@@ -0,0 +1,37 @@
+from __future__ import annotations
+import typing
+import numba
+
+
+class NumbaThreads:
+    '''
+    Context manager that temporarily sets the number of threads used by the
+    numba parallel regions launched from the calling thread.
+
+    @n_threads: None for unchanged. A value larger than the number of threads
+        launched by numba (i.e., NUMBA_NUM_THREADS) is bounded by it.
+
+    Examples
+    --------
+    with NumbaThreads(8):
+        kernel(...)     # numba.njit(parallel=True) function.
+    '''
+
+    def __init__(self, n_threads: int = None) -> None:
+        if n_threads is not None:
+            n_threads = int(n_threads)
+            assert n_threads > 0
+            n_threads = min(n_threads, numba.config.NUMBA_NUM_THREADS)
+        self.n_threads = n_threads
+        self._n_threads_old = None
+
+    def __enter__(self):
+        if self.n_threads is not None:
+            self._n_threads_old = numba.get_num_threads()
+            numba.set_num_threads(self.n_threads)
+        return self
+
+    def __exit__(self, *exc):
+        if self._n_threads_old is not None:
+            numba.set_num_threads(self._n_threads_old)
+            self._n_threads_old = None
@@ -0,0 +1,242 @@
+'''
+Kernels of the geometry in a periodic box of side length `l_box`, i.e.,
+wrapping into the box, minimum-image displacement and distance, and bounds
+checking.
+
+Each is a single parallel pass over the array, made in place where it
+modifies the input, without temporary arrays or boolean masks.
+
+Arrays of points have shape (..., d). Other arguments (reference points,
+`where` masks) are broadcast against them as numpy does. Kernels (i.e.,
+those prefixed by underscore) work on arrays of shape (n, d), with the
+other arrays of shape (1 or n, 1 or d), and can be called from numba code.
+'''
+
+from __future__ import annotations
+import typing
+import numpy as np
+import numba
+
+
+def wrap_in(x: np.ndarray, l_box: float, where: np.ndarray = None) -> int:
+    '''
+    Shift `x` in place by a period, into [0, l_box), where it is below 0 or
+    not below l_box.
+
+    @where: optional bool mask. If provided, only the elements where it is
+        True are shifted and checked.
+
+    Return the number of elements still out of [0, l_box) (e.g., those
+    more than a period away, or NaN).
+    '''
+    x2 = _rows_of(x)
+    where = None if where is None else _rows_like(where, x.shape)
+    n_bad = _wrap_in(x2, l_box, where)
+    _write_back(x, x2)
+    return n_bad
+
+
+def shift_to(x: np.ndarray, x_ref: np.ndarray, l_box: float,
+             where: np.ndarray = None) -> int:
+    '''
+    Shift `x` in place by a period, to its image nearest to `x_ref`, i.e.,
+    with x - x_ref in [-l_box/2, l_box/2), where it is not.
+
+    @where: see wrap_in().
+
+    Return the number of elements still out of the range (e.g., those more
+    than a period away, or NaN).
+    '''
+    x2 = _rows_of(x)
+    x_ref = _rows_like(x_ref, x.shape)
+    where = None if where is None else _rows_like(where, x.shape)
+    n_bad = _shift_to(x2, x_ref, l_box, where)
+    _write_back(x, x2)
+    return n_bad
+
+
+def displacement(x1: np.ndarray, x2: np.ndarray, l_box: float,
+                 out: np.ndarray = None) -> np.ndarray:
+    '''
+    Minimum-image displacement from `x1` to `x2`, in [-l_box/2, l_box/2).
+
+    @out: optional, array of the broadcast shape to write the result into.
+    '''
+    x1, x2 = np.asarray(x1), np.asarray(x2)
+    shape = np.broadcast_shapes(x1.shape, x2.shape)
+    if out is None:
+        out = np.empty(shape, dtype=np.result_type(x1, x2, np.float32))
+    assert out.shape == shape
+    out2 = _rows_of(out)
+    _displacement(_rows_like(x1, shape), _rows_like(x2, shape), l_box, out2)
+    _write_back(out, out2)
+    return out
+
+
+def distance(x1: np.ndarray, x2: np.ndarray, l_box: float,
+             out: np.ndarray = None) -> np.ndarray:
+    '''
+    Minimum-image distance between `x1` and `x2`, reduced over the last
+    axis.
+
+    @out: optional, array of the broadcast shape (without the last axis)
+        to write the result into.
+    '''
+    x1, x2 = np.asarray(x1), np.asarray(x2)
+    shape = np.broadcast_shapes(x1.shape, x2.shape)
+    if out is None:
+        out = np.empty(shape[:-1], dtype=np.result_type(x1, x2, np.float32))
+    assert out.shape == shape[:-1]
+    out1 = out.reshape(-1)
+    _distance(_rows_like(x1, shape), _rows_like(x2, shape), l_box, out1)
+    _write_back(out, out1)
+    return out
+
+
+def count_out_of_bounds(x: np.ndarray, l_box: float,
+                        where: np.ndarray = None) -> int:
+    '''
+    Number of elements of `x` out of [0, l_box). NaN is out of bounds.
+
+    @where: see wrap_in().
+    '''
+    x = np.asarray(x)
+    where = None if where is None else _rows_like(where, x.shape)
+    return _count_out_of_bounds(_rows_of(x), l_box, where)
+
+
+def in_bounds(x: np.ndarray, l_box: float, where: np.ndarray = None) -> bool:
+    '''
+    Whether all the elements of `x` are in [0, l_box).
+
+    @where: see wrap_in().
+    '''
+    return count_out_of_bounds(x, l_box, where) == 0
+
+
+def _rows_of(x: np.ndarray) -> np.ndarray:
+    '''
+    View `x` as shape (n, d). A scalar (0-d array) is viewed as (1, 1).
+    '''
+    if x.ndim == 0:
+        return x.reshape(1, 1)
+    return x.reshape(-1, x.shape[-1])
+
+
+def _rows_like(a: np.ndarray, shape: tuple[int, ...]) -> np.ndarray:
+    '''
+    View `a` as shape (1 or n, 1 or d), to be broadcast against an array
+    of `shape`, viewed as shape (n, d).
+    '''
+    a = np.asarray(a)
+    d = shape[-1] if len(shape) > 0 else 1
+    if a.shape != shape and not (a.ndim <= 1 and a.size in (1, d)):
+        a = np.broadcast_to(a, shape)
+    return a.reshape(-1, a.shape[-1]) if a.ndim > 0 else a.reshape(1, 1)
+
+
+def _write_back(x: np.ndarray, x_view: np.ndarray):
+    '''
+    For an `x` whose reshape is a copy (i.e., some non-contiguous ones).
+    '''
+    if x.size > 0 and not np.shares_memory(x, x_view):
+        x[...] = x_view.reshape(x.shape)
+
+
+@numba.njit(inline='always')
+def _at(a: np.ndarray, i: int, j: int):
+    i, j = np.int64(i), np.int64(j)     # prange index is unsigned
+    return a[i if a.shape[0] > 1 else 0, j if a.shape[1] > 1 else 0]
+
+
+@numba.njit(parallel=True)
+def _wrap_in(x: np.ndarray, l_box: float, where: np.ndarray = None) -> int:
+    n, d = x.shape
+    n_bad = 0
+    for i in numba.prange(n):
+        for j in range(d):
+            if where is not None and not _at(where, i, j):
+                continue
+            v = x[i, j]
+            if v < 0.:
+                x[i, j] = v + l_box
+                v = x[i, j]
+            if v >= l_box:
+                x[i, j] = v - l_box
+                v = x[i, j]
+            if not (v >= 0. and v < l_box):
+                n_bad += 1
+    return n_bad
+
+
+@numba.njit(parallel=True)
+def _shift_to(x: np.ndarray, x_ref: np.ndarray, l_box: float,
+              where: np.ndarray = None) -> int:
+    n, d = x.shape
+    l_half = .5 * l_box
+    n_bad = 0
+    for i in numba.prange(n):
+        for j in range(d):
+            if where is not None and not _at(where, i, j):
+                continue
+            v, v_ref = x[i, j], _at(x_ref, i, j)
+            dv = v - v_ref
+            if dv < -l_half:
+                x[i, j] = v + l_box
+                dv = x[i, j] - v_ref
+            elif dv >= l_half:
+                x[i, j] = v - l_box
+                dv = x[i, j] - v_ref
+            if not (dv >= -l_half and dv < l_half):
+                n_bad += 1
+    return n_bad
+
+
+@numba.njit(inline='always')
+def _min_image(dv: float, l_box: float, l_half: float) -> float:
+    if dv < -l_half:
+        dv += l_box
+    elif dv >= l_half:
+        dv -= l_box
+    return dv
+
+
+@numba.njit(parallel=True)
+def _displacement(x1: np.ndarray, x2: np.ndarray, l_box: float,
+                  out: np.ndarray) -> None:
+    n, d = out.shape
+    l_half = .5 * l_box
+    for i in numba.prange(n):
+        for j in range(d):
+            dv = _at(x2, i, j) - _at(x1, i, j)
+            out[i, j] = _min_image(dv, l_box, l_half)
+
+
+@numba.njit(parallel=True)
+def _distance(x1: np.ndarray, x2: np.ndarray, l_box: float,
+              out: np.ndarray) -> None:
+    n = len(out)
+    d = max(x1.shape[1], x2.shape[1])
+    l_half = .5 * l_box
+    for i in numba.prange(n):
+        acc = 0.
+        for j in range(d):
+            dv = _at(x2, i, j) - _at(x1, i, j)
+            dv = _min_image(dv, l_box, l_half)
+            acc += dv * dv
+        out[i] = np.sqrt(acc)
+
+
+@numba.njit(parallel=True)
+def _count_out_of_bounds(x: np.ndarray, l_box: float,
+                         where: np.ndarray = None) -> int:
+    n, d = x.shape
+    n_bad = 0
+    for i in numba.prange(n):
+        for j in range(d):
+            if where is not None and not _at(where, i, j):
+                continue
+            v = x[i, j]
+            if not (v >= 0. and v < l_box):
+                n_bad += 1
+    return n_bad
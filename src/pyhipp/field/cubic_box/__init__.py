@@ -1,7 +1,15 @@
 from .mesh import _Mesh, Mesh
 from .field import _Field, Field
 from .smoothing import _Gaussian, _Tophat, FourierSpaceSmoothing, FFTSmoothing
-from .mass_assignment import _Linear, _LinearShapeFn, DensityField
+from .mass_assignment import (
+    _Constant, _ConstantShapeFn, _Linear, _LinearShapeFn, _Quadratic,
+    _QuadraticShapeFn, _Cubic, _CubicShapeFn, DensityField,
+    MultiDensityField)
 from .gravity import TidalField
 from .cosmic_web import TidalClassifier
-from . import cosmic_web, fft, field, gravity, mass_assignment, smoothing, box
\ No newline at end of file
+from .sampling import FieldSampler
+from .distributed import SharedArray, DistributedDensityField
+from .power_spectrum import PowerSpectrumEstimator
+from .dump_policy import DumpPolicy
+from . import (cosmic_web, fft, field, gravity, mass_assignment, smoothing, box,
+    distributed, kernels, power_spectrum, sampling, dump_policy)
\ No newline at end of file
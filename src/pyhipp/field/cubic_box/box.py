@@ -2,6 +2,8 @@ from __future__ import annotations
 import typing
 import numpy as np
 from pyhipp.core import abc
+from pyhipp.core.dataproc import periodic
+from pyhipp.core.dataproc.periodic import _wrap_in, _shift_to
 from numba.experimental import jitclass
 import numba
 
@@ -15,22 +17,22 @@ class _PeriodicBox:
         self.l_box = l_box
 
     def ishift_in(self, x: np.ndarray) -> None:
-        l_box = self.l_box
-        x[x < 0.] += l_box
-        x[x >= l_box] -= l_box
-        assert np.all(x >= 0.)
-        assert np.all(x < self.l_box)
+        # The kernels take rows, so a non-contiguous x is shifted in a 
+        # contiguous copy, and written back.
+        x2 = np.ascontiguousarray(x)
+        n_bad = _wrap_in(x2.reshape(-1, x2.shape[-1]), self.l_box, None)
+        if not x.flags.c_contiguous:
+            x[...] = x2
+        assert n_bad == 0
 
     def ishift_to(self, x: np.ndarray, x_ref: np.ndarray) -> None:
-        l_box = self.l_box
-        l_half = .5 * l_box
-        dx = x - x_ref
-        x[dx < -l_half] += l_box
-        x[dx >= l_half] -= l_box
-
-        dx = x - x_ref
-        assert np.all(dx >= -l_half)
-        assert np.all(dx < l_half)
+        x2 = np.ascontiguousarray(x)
+        x_ref = np.ascontiguousarray(x_ref)
+        n_bad = _shift_to(x2.reshape(-1, x2.shape[-1]),
+                          x_ref.reshape(-1, x_ref.shape[-1]), self.l_box, None)
+        if not x.flags.c_contiguous:
+            x[...] = x2
+        assert n_bad == 0
 
     def shift_to(self, x: np.ndarray, x_ref: np.ndarray) -> np.ndarray:
         x = x.copy()
@@ -47,19 +49,9 @@ class PeriodicBox(abc.HasDictRepr):
         self.l_box = l_box
 
     def ishift_in(self, x: np.ndarray) -> None:
-        l_box = self.l_box
-        x[x < 0.] += l_box
-        x[x >= l_box] -= l_box
-        assert np.all(x >= 0.)
-        assert np.all(x < self.l_box)
+        n_bad = periodic.wrap_in(x, self.l_box)
+        assert n_bad == 0
 
     def ishift_to(self, x: np.ndarray, x_ref: np.ndarray) -> None:
-        l_box = self.l_box
-        l_half = .5 * l_box
-        dx = x - x_ref
-        x[dx < -l_half] += l_box
-        x[dx >= l_half] -= l_box
-
-        dx = x - x_ref
-        assert np.all(dx >= -l_half)
-        assert np.all(dx < l_half)
+        n_bad = periodic.shift_to(x, x_ref, self.l_box)
+        assert n_bad == 0
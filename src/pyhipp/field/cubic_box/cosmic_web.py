@@ -1,32 +1,55 @@
 from __future__ import annotations
 import typing
 import numpy as np
-from .mesh import Mesh, _Mesh
-from .field import Field, _Field
-from .mass_assignment import _LinearShapeFn
-from typing import Self
+from .mesh import Mesh
+from .field import Field
+from .sampling import FieldSampler
+from typing import Self, Iterable
 from functools import cached_property
+from dataclasses import dataclass
 from pyhipp.io import h5
 from pyhipp.core import abc
-from numba import njit
+import numba
 
 
 class FieldInterpolator(abc.HasDictRepr):
-    def __init__(self, field: Field) -> None:
+    def __init__(self, field: Field, offset: float = 0.0,
+                 scheme: str = 'cic', n_threads: int = None) -> None:
         '''
-        @field: shall be a scalar field.
+        @field: shall be a scalar field. The interpolated values have the 
+            same dtype as it (np.float64 or np.float32).
+        @offset: added to the interpolated values.
+        @scheme, n_threads: see FieldSampler.
         '''
         super().__init__()
 
         self._data = field.data
-        self._shape_fn = _LinearShapeFn(field.mesh._impl)
+        self._sampler = FieldSampler(field.mesh, scheme=scheme,
+                                     n_threads=n_threads)
+        self._offset = offset
 
     @classmethod
     def new_density_field_from_file(
-            cls, group: h5.Group, key='delta_x') -> Self:
-        delta_x, l_box, n_grids = group.datasets[key, 'l_box', 'n_grids']
-        rho_x = delta_x + 1.
+            cls, group: h5.Group, key='delta_x', dtype=None,
+            mmap=False) -> Self:
+        '''
+        @dtype: np.float64 | np.float32, dtype of the field to interpolate. 
+            None for that of the dataset.
+        @mmap: if True, memory-map the overdensity (copy-on-write) instead 
+            of reading it, if possible, and add 1 after the interpolation. 
+            Ignored if `dtype` differs from that of the dataset.
+        '''
+        l_box, n_grids = group.datasets['l_box', 'n_grids']
         mesh = Mesh.new(n_grids, l_box)
+        dset = group[key]
+        if mmap and (dtype is None or np.dtype(dtype) == dset.dtype):
+            delta_x = dset.load(mmap='c')
+            return cls(Field.new_by_data(delta_x, mesh), offset=1.0)
+
+        delta_x = dset[()]
+        if dtype is not None:
+            delta_x = np.asarray(delta_x, dtype=dtype)
+        rho_x = delta_x + 1.
         field = Field.new_by_data(rho_x, mesh)
         return cls(field)
 
@@ -36,26 +59,9 @@ class FieldInterpolator(abc.HasDictRepr):
         '''
         n = len(xs)
         assert xs.shape == (n, 3)
-        return self._value_at(xs, self._data, self._shape_fn)
-
-    @staticmethod
-    @njit
-    def _value_at(xs: np.ndarray, data: np.ndarray, shape_fn: _LinearShapeFn):
-        n = len(xs)
-        out = np.empty(n, dtype=data.dtype)
-        for i, x in enumerate(xs):
-            i0_l, i0_r, w0_l, w0_r = shape_fn.weights_at(x[0])
-            i1_l, i1_r, w1_l, w1_r = shape_fn.weights_at(x[1])
-            i2_l, i2_r, w2_l, w2_r = shape_fn.weights_at(x[2])
-
-            out[i] = data[i0_l, i1_l, i2_l] * w0_l * w1_l * w2_l \
-                + data[i0_l, i1_l, i2_r] * w0_l * w1_l * w2_r \
-                + data[i0_l, i1_r, i2_l] * w0_l * w1_r * w2_l \
-                + data[i0_l, i1_r, i2_r] * w0_l * w1_r * w2_r \
-                + data[i0_r, i1_l, i2_l] * w0_r * w1_l * w2_l \
-                + data[i0_r, i1_l, i2_r] * w0_r * w1_l * w2_r \
-                + data[i0_r, i1_r, i2_l] * w0_r * w1_r * w2_l \
-                + data[i0_r, i1_r, i2_r] * w0_r * w1_r * w2_r
+        out = self._sampler.sample(self._data, xs)
+        if self._offset != 0.0:
+            out += out.dtype.type(self._offset)
         return out
 
 
@@ -77,14 +83,71 @@ class TidalClassifier(abc.HasDictRepr):
     repr_attr_keys = ('mesh', 'lam_th', 'web_types',
                       'f_knot', 'f_filament', 'f_sheet', 'f_void')
 
-    def __init__(self, lam: np.ndarray, mesh: Mesh, *, lam_th=0.0) -> None:
-
-        lam = np.array(lam, dtype=np.float32)
+    @dataclass
+    class ManyResult:
+        '''
+        Result of run_many(), for K thresholds.
+        
+        @counts: shape (K, 4), number of grid points of each web type 
+            (indexed by its value, see `web_types`).
+        @n_lams: shape (K, N, N, N), int8, the web-type grid at each 
+            threshold. None if not kept.
+        @web_types_at: shape (n, K), int8, the web types at the given 
+            points. None if no point is given.
+        '''
+        l_box: float
+        n_grids: int
+        lam_ths: np.ndarray
+        counts: np.ndarray
+        n_lams: np.ndarray
+        web_types_at: np.ndarray
+
+        @property
+        def fractions(self) -> np.ndarray:
+            '''
+            Fraction of grid points of each web type, shape (K, 4).
+            '''
+            return self.counts / self.n_grids**3
+
+        def dump(self, group: h5.Group, flag='x'):
+            '''
+            Members that are None are not dumped.
+            '''
+            out = {
+                'l_box': self.l_box,
+                'n_grids': self.n_grids,
+                'lam_ths': self.lam_ths,
+                'counts': self.counts,
+                'n_lams': self.n_lams,
+                'web_types_at': self.web_types_at,
+            }
+            out = {k: v for k, v in out.items() if v is not None}
+            group.dump(out, flag=flag)
+
+    def __init__(self, lam: np.ndarray, mesh: Mesh, *, lam_th=0.0,
+                 validate=False) -> None:
+        '''
+        @lam: eigenvalues of the tidal tensor in ascending order, shape 
+            (N, N, N, 3). Referred, not copied, if np.float32 or np.float64 
+            (e.g., a np.memmap). Otherwise, converted to np.float32.
+        @lam_th: threshold of the eigenvalues, compared in the dtype of 
+            `lam`.
+        @validate: if True, check that the eigenvalues are in ascending 
+            order. Raise ValueError if not.
+        
+        The classification is held as an int8 grid, `n_lams`, the number of 
+        eigenvalues above `lam_th` (i.e., the web type, see `web_types`).
+        '''
+        lam = np.asanyarray(lam)
+        if lam.dtype not in (np.float32, np.float64):
+            lam = lam.astype(np.float32)
         n = mesh.n_grids
         assert lam.shape == (n, n, n, 3)
-        assert np.all(lam[:, :, :, 0] <= lam[:, :, :, 1])
-        assert np.all(lam[:, :, :, 1] <= lam[:, :, :, 2])
-        n_lams = np.count_nonzero(lam > lam_th, axis=-1)
+        n_lams, n_bad = self._n_lams_of(lam, lam.dtype.type(lam_th),
+                                        validate)
+        if n_bad > 0:
+            raise ValueError(f'Eigenvalues at {n_bad} grid points are not '
+                             'in ascending order.')
 
         self.lam = lam
         self.n_lams = n_lams
@@ -92,10 +155,60 @@ class TidalClassifier(abc.HasDictRepr):
         self.lam_th = lam_th
 
     @classmethod
-    def new_from_file(cls, group: h5.Group, *, lam_th=0.0) -> Self:
-        n_grids, l_box, lam = group.datasets['n_grids', 'l_box', 'lam']
+    def new_from_file(cls, group: h5.Group, *, lam_th=0.0,
+                      mmap=False, validate=False) -> Self:
+        '''
+        @mmap: if True, memory-map `lam` (read-only) instead of reading it, 
+            if possible. Pages are then loaded on access, and only the int8 
+            `n_lams` grid is held in memory.
+        '''
+        n_grids, l_box = group.datasets['n_grids', 'l_box']
+        lam = group['lam'].load(mmap=mmap)
         mesh = Mesh.new(n_grids, l_box)
-        return cls(lam, mesh, lam_th=lam_th)
+        return cls(lam, mesh, lam_th=lam_th, validate=validate)
+
+    @classmethod
+    def run_many(cls, lam: np.ndarray, mesh: Mesh, lam_ths: Iterable[float],
+                 *, xs: np.ndarray = None, keep_grids=False,
+                 validate=False) -> ManyResult:
+        '''
+        Classify at multiple thresholds, in a single parallel pass over the 
+        grid, instead of constructing a classifier for each.
+        
+        @lam, validate: see __init__().
+        @lam_ths: thresholds, shape (K,).
+        @xs: optional, positions of shape (n, 3), whose web types at each 
+            threshold are found (by NGP, as web_type_at()).
+        @keep_grids: if True, keep the web-type grid of each threshold, 
+            taking K bytes per grid point.
+        '''
+        lam = np.asanyarray(lam)
+        if lam.dtype not in (np.float32, np.float64):
+            lam = lam.astype(np.float32)
+        n = mesh.n_grids
+        assert lam.shape == (n, n, n, 3)
+        lam_ths = np.array(lam_ths, dtype=np.float64)
+        assert lam_ths.ndim == 1
+        ths = lam_ths.astype(lam.dtype)
+
+        n_lams = None
+        if keep_grids:
+            n_lams = np.empty((len(ths), n, n, n), dtype=np.int8)
+        counts, n_bad = cls._count_many(lam, ths, validate, n_lams)
+        if n_bad > 0:
+            raise ValueError(f'Eigenvalues at {n_bad} grid points are not '
+                             'in ascending order.')
+
+        web_types_at = None
+        if xs is not None:
+            xs = np.asarray(xs)
+            assert xs.shape == (len(xs), 3)
+            lam_xs = FieldSampler(mesh, scheme='ngp').sample(lam, xs)
+            web_types_at = cls._n_lams_at_many(lam_xs, ths)
+
+        return cls.ManyResult(l_box=mesh.l_box, n_grids=n, lam_ths=lam_ths,
+                              counts=counts, n_lams=n_lams,
+                              web_types_at=web_types_at)
 
     def web_type_at(self, xs: np.ndarray):
         '''
@@ -104,79 +217,161 @@ class TidalClassifier(abc.HasDictRepr):
         xs = np.asarray(xs)
         n_xs = len(xs)
         assert xs.shape == (n_xs, 3)
-        return self._web_type_at(xs, self.mesh._impl, self.n_lams)
+        sampler = FieldSampler(self.mesh, scheme='ngp')
+        return sampler.sample(self.n_lams, xs).astype(np.int64)
 
-    def lam_at(self, xs: np.ndarray):
+    def lam_at(self, xs: np.ndarray, scheme: str = 'ngp'):
+        '''
+        @scheme: see FieldSampler. Other than 'ngp', the eigenvalues are 
+            interpolated component-wise.
+        
+        Return the eigenvalues, shape (n, 3), as np.float32.
+        '''
         xs = np.asarray(xs)
         n_xs = len(xs)
         assert xs.shape == (n_xs, 3)
-        return self._lam_at(xs, self.mesh._impl, self.lam)
-
-    @staticmethod
-    @njit
-    def _web_type_at(xs: np.ndarray, mesh: _Mesh, n_lams: np.ndarray):
-        n_xs = len(xs)
-        web_types = np.empty(n_xs, dtype=np.int64)
-        for i, x in enumerate(xs):
-            i0, i1, i2 = mesh.x_to_xi_nd(x)
-            web_types[i] = n_lams[i0, i1, i2]
-        return web_types
-
-    @staticmethod
-    @njit
-    def _lam_at(xs: np.ndarray, mesh: _Mesh, lam: np.ndarray):
-        n_xs = len(xs)
-        lam_out = np.empty((n_xs, 3), dtype=np.float32)
-        for i, x in enumerate(xs):
-            i0, i1, i2 = mesh.x_to_xi_nd(x)
-            lam_out[i] = lam[i0, i1, i2]
-        return lam_out
-
-    def grid_points_of_web_type(self, web_type: str):
-        sel = self.n_lams == self.web_types[web_type]
-
-        mesh = self.mesh
-        n, h = mesh.n_grids, mesh.l_grid
-
-        idx_1d = np.arange(n)
-        idx_3d = np.meshgrid(idx_1d, idx_1d, idx_1d, indexing='ij')
-        idx_3d = [idx[sel] for idx in idx_3d]
+        lam_xs = FieldSampler(self.mesh, scheme=scheme).sample(self.lam, xs)
+        return lam_xs.astype(np.float32, copy=False)
 
-        n_sel = idx_3d[0].size
+    def grid_points_of_web_type(self, web_type: str, n_slab: int = 16):
+        '''
+        Return the positions of the grid points of `web_type`, shape 
+        (n, 3), as np.float32.
+        
+        @n_slab: number of x0-planes searched in a batch.
+        '''
+        n_sel = self._counts[self.web_types[web_type]]
         x = np.empty((n_sel, 3), dtype=np.float32)
-        for i in range(3):
-            x[:, i] = idx_3d[i] * h
-
+        b = 0
+        for x_batch in self.iter_grid_points_of_web_type(web_type, n_slab):
+            e = b + len(x_batch)
+            x[b:e] = x_batch
+            b = e
+        assert b == n_sel
         return x
 
-    @cached_property
+    def iter_grid_points_of_web_type(self, web_type: str, n_slab: int = 16):
+        '''
+        Yield the positions of the grid points of `web_type`, in batches, 
+        each from `n_slab` x0-planes. See grid_points_of_web_type().
+        '''
+        t = self.web_types[web_type]
+        n, h = self.mesh.n_grids, self.mesh.l_grid
+        assert n_slab > 0
+        for b in range(0, n, n_slab):
+            idx = np.nonzero(self.n_lams[b:b+n_slab] == t)
+            x = np.empty((len(idx[0]), 3), dtype=np.float32)
+            x[:, 0] = (idx[0] + b) * h
+            x[:, 1] = idx[1] * h
+            x[:, 2] = idx[2] * h
+            yield x
+
+    @property
     def is_knot(self):
         return self.n_lams == self.web_types['knot']
 
-    @cached_property
+    @property
     def is_filament(self):
         return self.n_lams == self.web_types['filament']
 
-    @cached_property
+    @property
     def is_sheet(self):
         return self.n_lams == self.web_types['sheet']
 
-    @cached_property
+    @property
     def is_void(self):
         return self.n_lams == self.web_types['void']
 
-    @cached_property
+    @property
     def f_knot(self):
-        return self.is_knot.sum() / self.n_lams.size
+        return self._counts[self.web_types['knot']] / self.n_lams.size
 
-    @cached_property
+    @property
     def f_filament(self):
-        return self.is_filament.sum() / self.n_lams.size
+        return self._counts[self.web_types['filament']] / self.n_lams.size
 
-    @cached_property
+    @property
     def f_sheet(self):
-        return self.is_sheet.sum() / self.n_lams.size
+        return self._counts[self.web_types['sheet']] / self.n_lams.size
 
-    @cached_property
+    @property
     def f_void(self):
-        return self.is_void.sum() / self.n_lams.size
+        return self._counts[self.web_types['void']] / self.n_lams.size
+
+    @cached_property
+    def _counts(self):
+        '''
+        Number of grid points of each web type (indexed by its value).
+        '''
+        return self._count_web_types(self.n_lams)
+
+    @staticmethod
+    @numba.njit(parallel=True)
+    def _n_lams_of(lam: np.ndarray, lam_th: float, validate: bool):
+        '''
+        Return (n_lams, n_bad), where n_bad is the number of grid points 
+        whose eigenvalues are not in ascending order (0 if not validate).
+        '''
+        n0, n1, n2, _ = lam.shape
+        n_lams = np.empty((n0, n1, n2), dtype=np.int8)
+        n_bad = 0
+        for i0 in numba.prange(n0):
+            for i1 in range(n1):
+                for i2 in range(n2):
+                    l0, l1, l2 = lam[i0, i1, i2, 0], lam[i0, i1, i2, 1], \
+                        lam[i0, i1, i2, 2]
+                    if validate and not (l0 <= l1 and l1 <= l2):
+                        n_bad += 1
+                    n_lams[i0, i1, i2] = (l0 > lam_th) + (l1 > lam_th) \
+                        + (l2 > lam_th)
+        return n_lams, n_bad
+
+    @staticmethod
+    @numba.njit(parallel=True)
+    def _count_many(lam: np.ndarray, lam_ths: np.ndarray, validate: bool,
+                    n_lams: np.ndarray = None):
+        '''
+        Return (counts, n_bad). See run_many() and _n_lams_of(). 
+        @n_lams: if not None, filled.
+        '''
+        n0, n1, n2, _ = lam.shape
+        n_ths = len(lam_ths)
+        counts = np.zeros((n0, n_ths, 4), dtype=np.int64)
+        n_bad = 0
+        for i0 in numba.prange(n0):
+            for i1 in range(n1):
+                for i2 in range(n2):
+                    l0, l1, l2 = lam[i0, i1, i2, 0], lam[i0, i1, i2, 1], \
+                        lam[i0, i1, i2, 2]
+                    if validate and not (l0 <= l1 and l1 <= l2):
+                        n_bad += 1
+                    for k in range(n_ths):
+                        th = lam_ths[k]
+                        n = (l0 > th) + (l1 > th) + (l2 > th)
+                        counts[i0, k, n] += 1
+                        if n_lams is not None:
+                            n_lams[k, i0, i1, i2] = n
+        return counts.sum(axis=0), n_bad
+
+    @staticmethod
+    @numba.njit(parallel=True)
+    def _n_lams_at_many(lam_xs: np.ndarray, lam_ths: np.ndarray):
+        n_xs, n_ths = len(lam_xs), len(lam_ths)
+        out = np.empty((n_xs, n_ths), dtype=np.int8)
+        for i in numba.prange(n_xs):
+            l0, l1, l2 = lam_xs[i, 0], lam_xs[i, 1], lam_xs[i, 2]
+            for k in range(n_ths):
+                th = lam_ths[k]
+                out[i, k] = (l0 > th) + (l1 > th) + (l2 > th)
+        return out
+
+    @staticmethod
+    @numba.njit(parallel=True)
+    def _count_web_types(n_lams: np.ndarray):
+        n0, n1, n2 = n_lams.shape
+        counts = np.zeros((n0, 4), dtype=np.int64)
+        for i0 in numba.prange(n0):
+            for i1 in range(n1):
+                for i2 in range(n2):
+                    counts[i0, n_lams[i0, i1, i2]] += 1
+        return counts.sum(axis=0)
@@ -0,0 +1,512 @@
+'''
+Slab-decomposed density field and Fourier-space stages, run by local worker
+processes on grids in shared memory.
+
+The grid is split into slabs of x0-planes (and, for the FFT along axis 0,
+into slabs of k2-planes), each processed by a worker. Every grid lives in a
+multiprocessing.shared_memory block, so no process holds a private copy,
+and the work spreads over the cores and memory channels of a node.
+'''
+
+from __future__ import annotations
+import typing
+from pyhipp.core import abc
+from typing import Self
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import multiprocessing
+from .field import _Mesh, Field, Mesh, _field_impl_of
+from .fft import NdRealFFT, get_fft_backend
+from .mass_assignment import (_LinearShapeFn, _schemes, _shape_fn_of,
+                              _new_sort_args, _sort_by_first_plane)
+from .smoothing import FourierSpaceSmoothing
+from .gravity import TidalField
+from .kernels import _KSpaceKernel, _kernel_of
+from pyhipp.core.dataproc.parallel import NumbaThreads
+import numpy as np
+import numba
+
+
+class SharedArray:
+    '''
+    A numpy array in a shared memory block. Pickled by reference, i.e.,
+    unpickling in another process attaches to the same block.
+
+    @name: None for creating a new block (zero-initialized). Otherwise,
+        attach to an existing one, detached when this instance is deleted.
+    '''
+
+    # Blocks with views still in use on release, closed later.
+    _unclosed: list[shared_memory.SharedMemory] = []
+
+    def __init__(self, shape: tuple[int, ...], dtype=np.float64,
+                 name: str = None) -> None:
+
+        shape, dtype = tuple(int(n) for n in shape), np.dtype(dtype)
+        size = max(1, int(np.prod(shape)) * dtype.itemsize)
+        if name is None:
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            owned = True
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+            owned = False
+
+        self.shm = shm
+        self.owned = owned
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        if owned:
+            self.array.fill(0)
+
+    def __reduce__(self):
+        a = self.array
+        return (SharedArray, (a.shape, a.dtype, self.shm.name))
+
+    def __del__(self):
+        self.release()
+
+    def release(self) -> None:
+        '''
+        Detach from the block, and unlink it if created by this instance. 
+        Views of `array` must not be used afterwards.
+        '''
+        shm = self.shm
+        if shm is None:
+            return
+        self.shm, self.array = None, None
+        if self.owned:
+            shm.unlink()
+        unclosed = SharedArray._unclosed
+        unclosed.append(shm)
+        for shm in unclosed.copy():
+            try:
+                shm.close()
+                unclosed.remove(shm)
+            except BufferError:
+                pass
+
+
+class DistributedDensityField(abc.HasLog):
+
+    def __init__(self, l_box: float, n_grids: int, n_workers: int = 2,
+                 scheme: str = 'cic', dtype=np.float64,
+                 chunk_size: int = 4 * 1024 * 1024,
+                 fft_backend: str = None) -> None:
+        '''
+        Counterpart of DensityField followed by FourierSpaceSmoothing or
+        TidalField, where the grids are decomposed into slabs processed by
+        `n_workers` local processes (no process is launched if 1).
+
+        @scheme, dtype: see DensityField. Interlacing is not supported.
+        @chunk_size: number of points copied into shared memory at a time
+            by add().
+        @fft_backend: name of the FFT backend used by the workers, see
+            get_fft_backend(). None for the default in this process.
+
+        The grids, including those of the results, are in shared memory
+        owned by this instance, and are released by close(). Copy any
+        result to be used after that. Use as a context manager, e.g.,
+
+        with DistributedDensityField(l_box, n_grids, n_workers=8) as d:
+            d.add(xs)
+            lam = d.run_tidal(r_sm=1.0).lam.copy()
+        '''
+        if scheme not in _schemes:
+            raise ValueError(f'Unknown scheme {scheme}.')
+        dtype = np.dtype(dtype)
+        _field_impl_of(dtype)
+        n_workers = int(n_workers)
+        assert n_workers > 0 and chunk_size > 0
+        # Resolved by name here, as spawned workers have their own default.
+        fft_backend = get_fft_backend(fft_backend).name
+
+        pool = None
+        if n_workers > 1:
+            # Numba's threading layers are not fork-safe, so workers are
+            # spawned.
+            mp_context = multiprocessing.get_context('spawn')
+            pool = ProcessPoolExecutor(max_workers=n_workers,
+                                       mp_context=mp_context)
+
+        N = n_grids
+        self._mesh = _Mesh(n_grids, l_box)
+        self._scheme = scheme
+        self._dtype = dtype
+        self._chunk_size = chunk_size
+        self._fft_backend = fft_backend
+        self._pool = pool
+        self._slabs = self.__split(N, n_workers)
+        self._slabs_k = self.__split(N // 2 + 1, n_workers)
+        self._blocks: list[SharedArray] = []
+        self._rho_x = self.__new_block((N, N, N), dtype)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        for block in self._blocks:
+            block.release()
+        self._blocks.clear()
+
+    def add(self, xs: np.ndarray, weights: np.ndarray = None):
+        '''
+        Deposit points. The points of each chunk are bucketed once by the
+        first x0-planes of their stencils, and each worker adds, to its own
+        slab, only those reaching it, in the input order. Hence the result
+        is bit-identical to the serial DensityField.add().
+        '''
+        assert xs.ndim == 2 and xs.shape[1] == 3
+        if weights is not None:
+            assert weights.shape == (len(xs),)
+
+        S = _shape_fn_of_args(self.__mesh_args)
+        n, cs = len(xs), self._chunk_size
+        for b in range(0, n, cs):
+            e = min(b + cs, n)
+            xs_sh = SharedArray((e - b, 3), xs.dtype)
+            xs_sh.array[...] = xs[b:e]
+            ws_sh = None
+            if weights is not None:
+                ws_sh = SharedArray((e - b,), weights.dtype)
+                ws_sh.array[...] = weights[b:e]
+            args_sh = SharedArray((e - b,), _new_sort_args(e - b).dtype)
+            firsts = _sort_by_first_plane(S, xs_sh.array, args_sh.array,
+                                          numba.get_num_threads())
+            self.__map(_task_deposit, [
+                (self._rho_x, self.__mesh_args, xs_sh, ws_sh, args_sh,
+                 firsts, b0, e0)
+                for b0, e0 in self._slabs])
+            for block in (xs_sh, ws_sh, args_sh):
+                if block is not None:
+                    block.release()
+
+    def run_smoothing(self, r_sm: float = 1.0, method: str = 'gaussian',
+                      correct_shape: bool = True):
+        '''
+        Distributed FourierSpaceSmoothing.run().
+
+        @correct_shape: whether to deconvolve the `scheme` of the deposit.
+
+        Return a FourierSpaceSmoothing.Result, whose arrays are in shared
+        memory (see close()).
+        '''
+        if method not in ('gaussian', 'tophat'):
+            raise ValueError(f'Unknown method {method}.')
+        delta_x, delta_k = self.__forward_delta()
+        delta_sm_k = self.__new_k_block()
+        self.__map(_task_smooth, [
+            (delta_k, delta_sm_k, self.__mesh_args, b, e, r_sm, method,
+             correct_shape)
+            for b, e in self._slabs])
+        delta_sm_x = self.__backward(delta_sm_k)
+
+        mesh = self._mesh
+        return FourierSpaceSmoothing.Result(
+            l_box=mesh.l_box, n_grids=mesh.n_grids,
+            rho_x=self.data, delta_x=delta_x.array, delta_k=delta_k.array,
+            delta_sm_k=delta_sm_k.array, delta_sm_x=delta_sm_x.array)
+
+    def run_tidal(self, r_sm: float = 1.0, correct_shape: bool = True):
+        '''
+        Distributed TidalField.run(), with Gaussian smoothing of length
+        `r_sm`.
+
+        The six independent components of the tidal tensor are made in a
+        single pass over k-space, each transformed in place, and reduced
+        slab by slab into the eigenvalues. The full tensor is not made, 
+        i.e., `T_x` of the result is None.
+
+        Return a TidalField.Result, whose arrays are in shared memory (see
+        close()).
+        '''
+        delta_x, delta_k = self.__forward_delta()
+        delta_sm_k, phi_k = self.__new_k_block(), self.__new_k_block()
+        Ts = [self.__new_k_block() for _ in range(6)]
+        self.__map(_task_solve_grav_tidal, [
+            (delta_k, delta_sm_k, phi_k, Ts, self.__mesh_args, b, e, r_sm,
+             correct_shape)
+            for b, e in self._slabs])
+        delta_sm_x = self.__backward(delta_sm_k)
+
+        N, fft = self._mesh.n_grids, self._fft_backend
+        for T in Ts:
+            self.__map(_task_fft0, [
+                (T, b, e, False, fft) for b, e in self._slabs_k])
+            self.__map(_task_irfft2_inplace, [
+                (T, b, e, fft) for b, e in self._slabs])
+        lam = self.__new_block((N, N, N, 3), self._dtype)
+        self.__map(_task_eigvalsh, [(Ts, lam, b, e) for b, e in self._slabs])
+        for T in Ts:
+            self._blocks.remove(T)
+            T.release()
+
+        mesh = self._mesh
+        return TidalField.Result(
+            l_box=mesh.l_box, n_grids=mesh.n_grids,
+            rho_x=self.data, delta_x=delta_x.array, delta_k=delta_k.array,
+            delta_sm_k=delta_sm_k.array, delta_sm_x=delta_sm_x.array,
+            phi_k=phi_k.array, T_x=None, lam=lam.array)
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._rho_x.array
+
+    @property
+    def field(self) -> Field:
+        return Field.new_by_data(self.data, Mesh(self._mesh))
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dtype
+
+    @property
+    def scheme(self) -> str:
+        return self._scheme
+
+    def __forward_delta(self):
+        '''
+        Normalize the density into the overdensity, and transform it.
+        '''
+        rho_x = self._rho_x
+        sums = self.__map(_task_sum, [(rho_x, b, e) for b, e in self._slabs])
+        rho_mean = float(np.sum(sums)) / rho_x.array.size
+        if rho_mean < 1.0e-10:
+            raise ValueError(f'Mean density {rho_mean} is too low.')
+
+        N, dtype = self._mesh.n_grids, self._dtype
+        delta_x = self.__new_block((N, N, N), dtype)
+        self.__map(_task_normalize, [
+            (rho_x, delta_x, rho_mean, b, e) for b, e in self._slabs])
+
+        delta_k, fft = self.__new_k_block(), self._fft_backend
+        self.__map(_task_rfft2, [
+            (delta_x, delta_k, b, e, fft) for b, e in self._slabs])
+        self.__map(_task_fft0, [
+            (delta_k, b, e, True, fft) for b, e in self._slabs_k])
+        return delta_x, delta_k
+
+    def __backward(self, data_k: SharedArray, out: SharedArray = None):
+        '''
+        Inverse transform `data_k` into `out` (a new block if None).
+        `data_k` is kept unchanged.
+        '''
+        N, fft = self._mesh.n_grids, self._fft_backend
+        if out is None:
+            out = self.__new_block((N, N, N), self._dtype)
+        work_k = self.__new_k_block()
+        self.__map(_task_copy, [
+            (data_k, work_k, b, e) for b, e in self._slabs])
+        self.__map(_task_fft0, [
+            (work_k, b, e, False, fft) for b, e in self._slabs_k])
+        self.__map(_task_irfft2, [
+            (work_k, out, b, e, fft) for b, e in self._slabs])
+        self._blocks.remove(work_k)
+        work_k.release()
+        return out
+
+    def __new_block(self, shape, dtype) -> SharedArray:
+        block = SharedArray(shape, dtype)
+        self._blocks.append(block)
+        return block
+
+    def __new_k_block(self) -> SharedArray:
+        N = self._mesh.n_grids
+        dtype = NdRealFFT.real_to_complex[self._dtype]
+        return self.__new_block((N, N, N // 2 + 1), dtype)
+
+    def __map(self, fn, tasks: list[tuple]) -> list:
+        if self._pool is None:
+            return [fn(*task) for task in tasks]
+        return list(self._pool.map(fn, *zip(*tasks)))
+
+    @property
+    def __mesh_args(self):
+        m = self._mesh
+        return m.l_box, m.n_grids, self._scheme
+
+    @staticmethod
+    def __split(n: int, n_slabs: int) -> list[tuple[int, int]]:
+        bs = [i * n // n_slabs for i in range(n_slabs + 1)]
+        return [(b, e) for b, e in zip(bs[:-1], bs[1:]) if b < e]
+
+
+def _shape_fn_of_args(mesh_args: tuple):
+    l_box, n_grids, scheme = mesh_args
+    return _shape_fn_of(scheme, _Mesh(n_grids, l_box))
+
+
+def _kernel_of_args(mesh_args: tuple, method: str, r: float = 0.0,
+                    correct_shape: bool = False):
+    l_box, n_grids, scheme = mesh_args
+    return _kernel_of(n_grids, l_box, method, r,
+                      scheme if correct_shape else None)
+
+
+def _real_view(data_k: SharedArray) -> np.ndarray:
+    '''
+    Real array sharing the memory of a k-space block, i.e., the `x` of
+    NdRealFFT.new_inplace_buffer().
+    '''
+    a = data_k.array
+    N = a.shape[0]
+    return a.view(a.real.dtype)[..., :N]
+
+
+def _ids_in_slab(args: np.ndarray, firsts: np.ndarray, n_support: int,
+                 b: int, e: int) -> np.ndarray:
+    '''
+    Indices, in the input order, of the points bucketed by
+    _sort_by_first_plane() whose stencils reach x0-planes [b, e), i.e.,
+    whose first planes are in [b - n_support + 1, e), periodically.
+    '''
+    n = len(firsts) - 1
+    p_b = b - n_support + 1
+    if e - p_b >= n:
+        ids = args
+    elif p_b >= 0:
+        ids = args[firsts[p_b]:firsts[e]]
+    else:
+        ids = np.concatenate([args[firsts[p_b + n]:], args[:firsts[e]]])
+    return np.sort(ids)
+
+
+def _task_deposit(rho_x: SharedArray, mesh_args: tuple, xs: SharedArray,
+                  weights: SharedArray | None, args: SharedArray,
+                  firsts: np.ndarray, b: int, e: int):
+    S = _shape_fn_of_args(mesh_args)
+    ids = _ids_in_slab(args.array, firsts, S.n_support, b, e)
+    ws = None if weights is None else weights.array
+    _deposit_slab(rho_x.array, S, xs.array, ws, ids, b, e)
+
+
+def _task_sum(data: SharedArray, b: int, e: int):
+    return _sum_slab(data.array[b:e])
+
+
+def _task_normalize(rho_x: SharedArray, delta_x: SharedArray,
+                    rho_mean: float, b: int, e: int):
+    d = delta_x.array[b:e]
+    np.divide(rho_x.array[b:e], rho_mean, out=d)
+    d -= 1.0
+
+
+def _task_copy(src: SharedArray, dst: SharedArray, b: int, e: int):
+    dst.array[b:e] = src.array[b:e]
+
+
+def _task_rfft2(data_x: SharedArray, data_k: SharedArray, b: int, e: int,
+                fft_backend: str):
+    get_fft_backend(fft_backend).rfftn(
+        data_x.array[b:e], axes=(1, 2), norm='ortho',
+        out=data_k.array[b:e])
+
+
+def _task_irfft2(data_k: SharedArray, data_x: SharedArray, b: int, e: int,
+                 fft_backend: str):
+    N = data_x.array.shape[1]
+    get_fft_backend(fft_backend).irfftn(
+        data_k.array[b:e], s=(N, N), axes=(1, 2), norm='ortho',
+        out=data_x.array[b:e])
+
+
+def _task_irfft2_inplace(data_k: SharedArray, b: int, e: int,
+                         fft_backend: str):
+    '''
+    In-place counterpart of _task_irfft2(), into the real view of `data_k`.
+    '''
+    N = data_k.array.shape[0]
+    get_fft_backend(fft_backend).irfftn(
+        data_k.array[b:e], s=(N, N), axes=(1, 2), norm='ortho',
+        overwrite_x=True, out=_real_view(data_k)[b:e])
+
+
+def _task_fft0(data_k: SharedArray, b: int, e: int, forward: bool,
+               fft_backend: str):
+    '''
+    In-place transform along axis 0, of the slab of k2-planes [b, e).
+    '''
+    d = data_k.array[:, :, b:e]
+    backend = get_fft_backend(fft_backend)
+    fn = backend.fftn if forward else backend.ifftn
+    fn(d, axes=(0,), norm='ortho', out=d)
+
+
+def _task_smooth(delta_k: SharedArray, delta_sm_k: SharedArray,
+                 mesh_args: tuple, b: int, e: int, r_sm: float, method: str,
+                 correct_shape: bool):
+    K = _kernel_of_args(mesh_args, method, r_sm, correct_shape)
+    _smooth_slab(delta_k.array, delta_sm_k.array, K, b, e)
+
+
+def _task_solve_grav_tidal(delta_k: SharedArray, delta_sm_k: SharedArray,
+                           phi_k: SharedArray, Ts: list[SharedArray],
+                           mesh_args: tuple, b: int, e: int, r_sm: float,
+                           correct_shape: bool):
+    K = _kernel_of_args(mesh_args, 'gaussian', r_sm, correct_shape)
+    G = _kernel_of_args(mesh_args, 'green')
+    Ts_k = tuple(T.array[b:e] for T in Ts)
+    with NumbaThreads(1):
+        TidalField._solve_grav_tidal(
+            delta_k.array[b:e], K, G, Ts_k, delta_sm_k.array[b:e],
+            phi_k.array[b:e], b)
+
+
+def _task_eigvalsh(Ts: list[SharedArray], lam: SharedArray, b: int, e: int):
+    Ts_x = [_real_view(T)[b:e] for T in Ts]
+    with NumbaThreads(1):
+        TidalField._eigvalsh_3x3(*Ts_x, lam.array[b:e])
+
+
+@numba.njit(nogil=True)
+def _deposit_slab(data: np.ndarray, shape_fn: _LinearShapeFn,
+                  xs: np.ndarray, weights: np.ndarray, ids: np.ndarray,
+                  b: int, e: int):
+    '''
+    Add points xs[ids] to x0-planes [b, e) of `data`, skipping the
+    contributions to other planes.
+    '''
+    n = shape_fn.mesh.n_grids
+    for i in ids:
+        i0, ws0 = shape_fn.stencil_at(xs[i, 0])
+        if weights is None:
+            weight = 1.0
+        else:
+            weight = weights[i]
+        i1, ws1 = shape_fn.stencil_at(xs[i, 1])
+        i2, ws2 = shape_fn.stencil_at(xs[i, 2])
+        for j0 in range(len(ws0)):
+            k0 = (i0 + j0) % n
+            if k0 < b or k0 >= e:
+                continue
+            for j1 in range(len(ws1)):
+                k1 = (i1 + j1) % n
+                for j2 in range(len(ws2)):
+                    k2 = (i2 + j2) % n
+                    data[k0, k1, k2] += ws0[j0] * ws1[j1] * ws2[j2] * weight
+
+
+@numba.njit(nogil=True)
+def _sum_slab(data: np.ndarray):
+    out = 0.0
+    for v in data.flat:
+        out += v
+    return out
+
+
+@numba.njit(nogil=True)
+def _smooth_slab(delta_k: np.ndarray, delta_sm_k: np.ndarray,
+                 K: _KSpaceKernel, b: int, e: int):
+    '''
+    FourierSpaceSmoothing._smooth() over k0-planes [b, e).
+    '''
+    N = K.n_grids
+    for i0 in range(b, e):
+        for i1 in range(N):
+            for i2 in range(N // 2 + 1):
+                delta_sm_k[i0, i1, i2] = delta_k[i0, i1, i2] * K.at(
+                    i0, i1, i2)
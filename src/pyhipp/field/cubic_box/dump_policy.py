@@ -0,0 +1,120 @@
+'''
+Policy of dumping the (large) results of field pipelines into HDF5.
+'''
+
+from __future__ import annotations
+import typing
+from typing import Iterable, Mapping
+from pyhipp.core import abc
+from pyhipp.io import h5
+import numpy as np
+
+
+class DumpPolicy(abc.HasDictRepr):
+
+    repr_attr_keys = ('keys', 'dtype', 'chunks', 'compression',
+                      'compression_opts', 'shuffle', 'n_slab')
+
+    def __init__(self, keys: Iterable[str] = None, dtype: np.dtype = None,
+                 chunks: bool | tuple = None, compression: str = None,
+                 compression_opts=None, shuffle: bool = False,
+                 n_slab: int = None) -> None:
+        '''
+        Which fields of a result to dump, and how they are stored.
+
+        Only "fields", i.e., arrays with ndim >= 3 (grids, their transforms,
+        tensors on them, ...), are affected. Other entries (l_box, n_grids,
+        ...) are always dumped as is.
+
+        @keys: fields to dump. None for all.
+        @dtype: floating-point dtype to store the floating-point fields, e.g.,
+            np.float32. Complex fields are stored with the complex dtype of
+            the same precision. Other fields are not converted. None for
+            not converting.
+        @chunks, compression, compression_opts, shuffle: storage options
+            of the fields, passed to h5py. E.g., compression='gzip',
+            compression_opts=4, shuffle=True. If compression is used and
+            chunks is None, h5py guesses the chunk shape.
+        @n_slab: fields are written slab by slab along the first axis, each
+            of `n_slab` planes (None for about 64 MB), so that the
+            conversion needs no copy of the whole field.
+        '''
+        super().__init__()
+
+        self.keys = None if keys is None else tuple(keys)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.chunks = chunks
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.n_slab = n_slab
+
+    def selects(self, key: str) -> bool:
+        '''
+        Whether the field `key` is to be dumped.
+        '''
+        return self.keys is None or key in self.keys
+
+    def dtype_of(self, dtype: np.dtype) -> np.dtype:
+        '''
+        The dtype to store a field of `dtype`.
+        '''
+        dtype, dst = np.dtype(dtype), self.dtype
+        if dst is None:
+            return dtype
+        if dtype.kind == 'f':
+            return dst
+        if dtype.kind == 'c':
+            return np.result_type(dst, np.complex64)
+        return dtype
+
+    def create_dataset(self, group: h5.Group, key: str,
+                       shape: tuple[int, ...], dtype: np.dtype,
+                       flag='x') -> h5.Dataset:
+        '''
+        Create an empty dataset for the field `key` of given shape and dtype
+        (before the conversion by the policy), under `group`.
+        '''
+        kw = {}
+        if self.chunks is not None:
+            kw['chunks'] = self.chunks
+        if self.compression is not None:
+            kw['compression'] = self.compression
+            kw['compression_opts'] = self.compression_opts
+        if self.shuffle:
+            kw['shuffle'] = True
+        return group.datasets.create_empty(key, shape, self.dtype_of(dtype),
+                                           flag=flag, **kw)
+
+    def dump(self, group: h5.Group, data: Mapping, flag='x') -> None:
+        '''
+        Dump `data` (a mapping from keys to values) under `group`, following
+        the policy. Values that are None are not dumped.
+        '''
+        others = {}
+        for key, val in data.items():
+            if val is None:
+                continue
+            if not (isinstance(val, np.ndarray) and val.ndim >= 3):
+                others[key] = val
+                continue
+            if not self.selects(key):
+                continue
+            dset = self.create_dataset(group, key, val.shape, val.dtype,
+                                       flag=flag)
+            self.write(dset, val)
+        group.dump(others, flag=flag)
+
+    def write(self, dset: h5.Dataset, val: np.ndarray) -> None:
+        '''
+        Write `val` into `dset`, slab by slab.
+        '''
+        n_planes = len(val)
+        plane_size = max(val[0].nbytes, 1) if n_planes > 0 else 1
+        n_slab = self.n_slab
+        if n_slab is None:
+            n_slab = max(64 * 1024 * 1024 // plane_size, 1)
+        dtype = dset.dtype
+        for b in range(0, n_planes, n_slab):
+            e = min(b + n_slab, n_planes)
+            dset[b:e] = val[b:e].astype(dtype, copy=False)
@@ -1,43 +1,564 @@
 from __future__ import annotations
 import typing
 from typing import Self, Tuple
+from collections import OrderedDict
+import os
+import tempfile
+import threading
 import numpy as np
 import scipy.fft as scipy_fft
 
 
+class FFTBackend:
+    '''
+    Backend of the FFTs, used through NdRealFFT or get_fft_backend().
+
+    Arguments of the methods follow scipy.fft, except:
+    @workers: number of threads. None for 1. Negative for a wrap around
+        from os.cpu_count().
+    @out: optional, a preallocated array to store the result. It may
+        overlap with the input (e.g., an in-place transform through a real
+        and a complex view of the same buffer).
+    '''
+
+    name: str = None
+
+    def rfftn(self, x: np.ndarray, s=None, axes=None, norm=None,
+              workers=None, overwrite_x=False,
+              out: np.ndarray = None) -> np.ndarray:
+        raise NotImplementedError()
+
+    def irfftn(self, x: np.ndarray, s=None, axes=None, norm=None,
+               workers=None, overwrite_x=False,
+               out: np.ndarray = None) -> np.ndarray:
+        raise NotImplementedError()
+
+    def fftn(self, x: np.ndarray, axes=None, norm=None, workers=None,
+             overwrite_x=False, out: np.ndarray = None) -> np.ndarray:
+        raise NotImplementedError()
+
+    def ifftn(self, x: np.ndarray, axes=None, norm=None, workers=None,
+              overwrite_x=False, out: np.ndarray = None) -> np.ndarray:
+        raise NotImplementedError()
+
+    @staticmethod
+    def _to_out(y: np.ndarray, out: np.ndarray | None) -> np.ndarray:
+        if out is None:
+            return y
+        out[...] = y
+        return out
+
+
+class ScipyFFTBackend(FFTBackend):
+    '''
+    scipy.fft, which caches its plans internally. The result is always
+    made in a newly allocated array, i.e., a transform to `out` (even an
+    in-place one) allocates a temporary of the size of the output and
+    copies it.
+    '''
+
+    name = 'scipy'
+
+    def rfftn(self, x, s=None, axes=None, norm=None, workers=None,
+              overwrite_x=False, out=None):
+        y = scipy_fft.rfftn(x, s=s, axes=axes, norm=norm,
+                            overwrite_x=overwrite_x, workers=workers)
+        return self._to_out(y, out)
+
+    def irfftn(self, x, s=None, axes=None, norm=None, workers=None,
+               overwrite_x=False, out=None):
+        y = scipy_fft.irfftn(x, s=s, axes=axes, norm=norm,
+                             overwrite_x=overwrite_x, workers=workers)
+        return self._to_out(y, out)
+
+    def fftn(self, x, axes=None, norm=None, workers=None,
+             overwrite_x=False, out=None):
+        y = scipy_fft.fftn(x, axes=axes, norm=norm, overwrite_x=overwrite_x,
+                           workers=workers)
+        return self._to_out(y, out)
+
+    def ifftn(self, x, axes=None, norm=None, workers=None,
+              overwrite_x=False, out=None):
+        y = scipy_fft.ifftn(x, axes=axes, norm=norm, overwrite_x=overwrite_x,
+                            workers=workers)
+        return self._to_out(y, out)
+
+
+class PyfftwFFTBackend(FFTBackend):
+    '''
+    FFTW through pyfftw. Plans are executed on the arrays of the caller,
+    i.e., the input and `out` (a new aligned array if None), so that an
+    in-place transform (through a real and a complex view of the same
+    buffer) needs no other memory. A copy is made only if the input or
+    `out` does not fit a plan (a dtype other than that of the transform,
+    negative strides, a partial overlap, or a shape to be padded or
+    cropped by `s`), or, for irfftn() not allowed to `overwrite_x`, to
+    keep the input which FFTW destroys.
+
+    A plan refers to the arrays it last ran on. Plans are cached by the
+    layouts (shape, strides, dtype, alignment) of the arrays, and the most
+    recently used are kept as long as the arrays they refer to total no
+    more than `max_bytes`. A plan not cached is made again on the next
+    call, which is cheap with 'FFTW_ESTIMATE', or with FFTW's wisdom
+    accumulated by the first one.
+
+    @planner_effort: e.g., 'FFTW_ESTIMATE' (fast planning) or
+        'FFTW_MEASURE' (slower planning, faster transforms, worth it for
+        many transforms of the same shape). Planning with measurement
+        overwrites the arrays, so it runs on scratch arrays of the same
+        layout, released once the plan is run.
+    '''
+
+    name = 'pyfftw'
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024,
+                 planner_effort: str = 'FFTW_ESTIMATE') -> None:
+
+        import pyfftw
+
+        self.max_bytes = max_bytes
+        self.planner_effort = planner_effort
+        self._FFTW = pyfftw.FFTW
+        self._empty_aligned = pyfftw.empty_aligned
+        self._alignment = pyfftw.simd_alignment
+        self._plans: OrderedDict[tuple, tuple] = OrderedDict()
+        self._n_bytes = 0
+        self._wise: set[tuple] = set()
+        self._lock = threading.Lock()
+
+    def rfftn(self, x, s=None, axes=None, norm=None, workers=None,
+              overwrite_x=False, out=None):
+        return self.__run('rfftn', x, out, s, axes, norm, workers,
+                          overwrite_x)
+
+    def irfftn(self, x, s=None, axes=None, norm=None, workers=None,
+               overwrite_x=False, out=None):
+        return self.__run('irfftn', x, out, s, axes, norm, workers,
+                          overwrite_x)
+
+    def fftn(self, x, axes=None, norm=None, workers=None,
+             overwrite_x=False, out=None):
+        return self.__run('fftn', x, out, None, axes, norm, workers,
+                          overwrite_x)
+
+    def ifftn(self, x, axes=None, norm=None, workers=None,
+              overwrite_x=False, out=None):
+        return self.__run('ifftn', x, out, None, axes, norm, workers,
+                          overwrite_x)
+
+    @property
+    def n_cached_bytes(self) -> int:
+        '''
+        Total size of the arrays referred to by the cached plans.
+        '''
+        return self._n_bytes
+
+    def clear(self) -> None:
+        '''
+        Release the cached plans.
+        '''
+        with self._lock:
+            self._plans.clear()
+            self._n_bytes = 0
+
+    def __run(self, kind: str, x: np.ndarray, out: np.ndarray | None,
+              s, axes, norm, workers, overwrite_x: bool):
+        if norm not in (None, 'backward', 'ortho', 'forward'):
+            raise ValueError(f'Unknown norm {norm}.')
+        x = np.asarray(x)
+        forward = kind in ('rfftn', 'fftn')
+        ndim = x.ndim
+        if axes is None:
+            axes = range(ndim) if s is None else range(ndim - len(s), ndim)
+        axes = tuple(int(axis) % ndim for axis in axes)
+
+        f_dtype = np.finfo(np.result_type(x.dtype, np.float32)).dtype
+        c_dtype = np.result_type(f_dtype, np.complex64)
+        dtype_in = f_dtype if kind == 'rfftn' else c_dtype
+        dtype_out = f_dtype if kind == 'irfftn' else c_dtype
+        shape_in, shape_out = self.__shapes_of(kind, x.shape, s, axes)
+
+        # Fit the input and output into arrays a plan can run on.
+        owned = False
+        if shape_in != x.shape:
+            x, owned = self.__padded(x, shape_in, dtype_in), True
+        elif x.dtype != dtype_in or not self.__is_plannable(x):
+            x, owned = self.__copy(x, dtype_in), True
+        if out is not None:
+            assert out.shape == shape_out, f'Invalid out shape {out.shape}'
+        y = out
+        if y is None or y.dtype != dtype_out or not self.__is_plannable(y):
+            y = self._empty_aligned(shape_out, dtype=dtype_out)
+        inplace = not owned and np.may_share_memory(x, y)
+        if inplace and x.ctypes.data != y.ctypes.data:
+            x, owned, inplace = self.__copy(x, dtype_in), True, False
+        if kind == 'irfftn' and not (owned or inplace or overwrite_x):
+            x, owned = self.__copy(x, dtype_in), True
+
+        threads = self.__n_threads(workers)
+        key = (kind, axes, threads, inplace, *self.__layout_of(x),
+               *self.__layout_of(y))
+        with self._lock:
+            plan, n_bytes = self._plans.pop(key, (None, 0))
+            self._n_bytes -= n_bytes
+            if plan is None:
+                plan = self.__new_plan(key, x, y, axes, forward, threads)
+            # With normalise_idft=False, pyfftw scales the forward
+            # transform instead, i.e., norm='forward'.
+            plan(x, y, normalise_idft=norm in (None, 'backward'),
+                 ortho=norm == 'ortho')
+            self.__cache(key, plan, x, y, inplace)
+
+        if out is None:
+            return y
+        if y is not out:
+            out[...] = y
+        return out
+
+    def __new_plan(self, key: tuple, x: np.ndarray, y: np.ndarray,
+                   axes: tuple, forward: bool, threads: int):
+        effort = self.planner_effort
+        kw = {'axes': axes, 'threads': threads,
+              'direction': 'FFTW_FORWARD' if forward else 'FFTW_BACKWARD'}
+        if effort == 'FFTW_ESTIMATE':
+            # Estimation does not touch the arrays.
+            return self._FFTW(x, y, flags=(effort,), **kw)
+        if key in self._wise:
+            try:
+                return self._FFTW(x, y, flags=(effort, 'FFTW_WISDOM_ONLY'),
+                                  **kw)
+            except RuntimeError:
+                pass
+        x_s, y_s = self.__scratch_like(x, y)
+        plan = self._FFTW(x_s, y_s, flags=(effort,), **kw)
+        self._wise.add(key)
+        return plan
+
+    def __cache(self, key: tuple, plan, x: np.ndarray, y: np.ndarray,
+                inplace: bool) -> None:
+        n_bytes = self.__extent_of(y)
+        if not inplace:
+            n_bytes += self.__extent_of(x)
+        if n_bytes > self.max_bytes:
+            return
+        plans = self._plans
+        plans[key] = (plan, n_bytes)
+        self._n_bytes += n_bytes
+        while self._n_bytes > self.max_bytes:
+            _, (_, n_bytes) = plans.popitem(last=False)
+            self._n_bytes -= n_bytes
+
+    def __scratch_like(self, x: np.ndarray, y: np.ndarray):
+        '''
+        Arrays of the layouts of `x` and `y`, including the alignment and,
+        for an in-place transform, the sharing of memory.
+        '''
+        if x.ctypes.data != y.ctypes.data:
+            return self.__scratch_of(x)[0], self.__scratch_of(y)[0]
+        return self.__scratch_of(x, y)
+
+    def __scratch_of(self, *arrays: np.ndarray) -> tuple[np.ndarray, ...]:
+        n_bytes = max(self.__extent_of(a) for a in arrays)
+        off = arrays[0].ctypes.data % self._alignment
+        buf = self._empty_aligned(n_bytes + off, dtype=np.uint8)[off:]
+        return tuple(np.ndarray(a.shape, dtype=a.dtype, buffer=buf,
+                                strides=a.strides) for a in arrays)
+
+    def __layout_of(self, a: np.ndarray) -> tuple:
+        return (a.shape, a.strides, a.dtype.str,
+                a.ctypes.data % self._alignment == 0)
+
+    def __copy(self, x: np.ndarray, dtype: np.dtype) -> np.ndarray:
+        out = self._empty_aligned(x.shape, dtype=dtype)
+        out[...] = x
+        return out
+
+    def __padded(self, x: np.ndarray, shape: tuple,
+                 dtype: np.dtype) -> np.ndarray:
+        '''
+        `x` zero-padded or cropped (at the end of each axis) into `shape`.
+        '''
+        out = self._empty_aligned(shape, dtype=dtype)
+        out.fill(0)
+        sl = tuple(slice(0, min(n1, n2)) for n1, n2 in zip(x.shape, shape))
+        out[sl] = x[sl]
+        return out
+
+    @staticmethod
+    def __shapes_of(kind: str, shape: tuple, s, axes: tuple):
+        '''
+        Return (shape_in, shape_out) of the arrays of a transform.
+        '''
+        shape_in = list(shape)
+        if kind == 'irfftn':
+            if s is None:
+                s = [shape[ax] for ax in axes[:-1]] + \
+                    [2 * (shape[axes[-1]] - 1)]
+            shape_out = list(shape)
+            for ax, n in zip(axes, s):
+                shape_out[ax] = shape_in[ax] = int(n)
+            shape_in[axes[-1]] = int(s[-1]) // 2 + 1
+        else:
+            if s is not None:
+                for ax, n in zip(axes, s):
+                    shape_in[ax] = int(n)
+            shape_out = list(shape_in)
+            if kind == 'rfftn':
+                shape_out[axes[-1]] = shape_in[axes[-1]] // 2 + 1
+        return tuple(shape_in), tuple(shape_out)
+
+    @staticmethod
+    def __is_plannable(a: np.ndarray) -> bool:
+        return all(st >= 0 for st in a.strides)
+
+    @staticmethod
+    def __extent_of(a: np.ndarray) -> int:
+        '''
+        Number of bytes spanned by `a` (with non-negative strides).
+        '''
+        return sum((n - 1) * st for n, st in zip(a.shape, a.strides)) + \
+            a.itemsize
+
+    @staticmethod
+    def __n_threads(workers: int | None) -> int:
+        if workers is None:
+            return 1
+        workers = int(workers)
+        if workers < 0:
+            workers = max(os.cpu_count() + 1 + workers, 1)
+        return workers
+
+
+fft_backends = {
+    'scipy': ScipyFFTBackend,
+    'pyfftw': PyfftwFFTBackend,
+}
+_backend_instances: dict[str, FFTBackend] = {}
+_default_backend = 'scipy'
+
+
+def get_fft_backend(name: str | FFTBackend = None) -> FFTBackend:
+    '''
+    @name: 'scipy' | 'pyfftw' | 'auto' (pyfftw if importable, otherwise
+        scipy), or an FFTBackend instance (returned as is). None for the
+        default (see set_default_fft_backend()).
+
+    Instances are shared, so that the plans cached by a backend are reused
+    by all the callers.
+    '''
+    if isinstance(name, FFTBackend):
+        return name
+    if name is None:
+        name = _default_backend
+    if name == 'auto':
+        try:
+            return get_fft_backend('pyfftw')
+        except ImportError:
+            return get_fft_backend('scipy')
+    if name not in fft_backends:
+        raise ValueError(f'Unknown FFT backend {name}.')
+    backend = _backend_instances.get(name)
+    if backend is None:
+        backend = fft_backends[name]()
+        _backend_instances[name] = backend
+    return backend
+
+
+def set_default_fft_backend(name: str) -> None:
+    '''
+    Set the backend used by NdRealFFT (hence by all the field stages) when
+    not specified. See get_fft_backend().
+    '''
+    global _default_backend
+    get_fft_backend(name)
+    _default_backend = name
+
+
 class NdRealFFT:
     '''
     N-dimensional FFT for real input.
-    
-    @shape: shape of the input array. If larger than input, pad input with 
+
+    @shape: shape of the input array. If larger than input, pad input with
             zeros; if smaller, crop.
-    @axes: target axes to transform. Default: all axes, or last len(shape) axes 
+    @axes: target axes to transform. Default: all axes, or last len(shape) axes
            if specified shape. A repeated axis will be transformed multiple times.
     @norm: 'forward' | 'backward' | 'ortho' | None (means 'backward').
     @overwrite_input: whether input can be overwritten as temporary space.
-    @n_workers: number of workers for parallel computation. Negative for a wrap 
+    @n_workers: number of workers for parallel computation. Negative for a wrap
                 around from os.cpu_count().
+    @dtype: real dtype of the transform, np.float64 (with complex128) or
+            np.float32 (with complex64). Input of another dtype is converted.
+            None for following the input.
+    @backend: see get_fft_backend(). None for the default.
     '''
 
+    real_to_complex = {
+        np.dtype(np.float64): np.dtype(np.complex128),
+        np.dtype(np.float32): np.dtype(np.complex64),
+    }
+
     def __init__(self, shape: Tuple[int, ...] = None,
                  axes: Tuple[int, ...] = None,
                  norm: str = None,
                  overwrite_input: bool = False,
-                 n_workers: int = None) -> None:
+                 n_workers: int = None,
+                 dtype: np.dtype = None,
+                 backend: str | FFTBackend = None) -> None:
+
+        if dtype is not None:
+            dtype = np.dtype(dtype)
+            if dtype not in self.real_to_complex:
+                raise ValueError(f'Unsupported dtype {dtype}.')
 
         self.shape = shape
         self.axes = axes
         self.norm = norm
         self.overwrite_input = overwrite_input
         self.n_workers = n_workers
+        self.dtype = dtype
+        self.backend = get_fft_backend(backend)
 
-    def forward(self, x: np.ndarray) -> np.ndarray:
+    def forward(self, x: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        '''
+        @out: optional, preallocated complex array for the result. See
+            FFTBackend.
+        '''
         kw = self.__impl_kw
-        return scipy_fft.rfftn(x, **kw)
+        if self.dtype is not None:
+            x = np.asarray(x, dtype=self.dtype)
+        return self.backend.rfftn(x, out=out, **kw)
 
-    def backward(self, x: np.ndarray) -> np.ndarray:
+    def backward(self, x: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        '''
+        @out: optional, preallocated real array for the result. See
+            FFTBackend.
+        '''
         kw = self.__impl_kw
-        return scipy_fft.irfftn(x, **kw)
+        if self.dtype is not None:
+            x = np.asarray(x, dtype=self.real_to_complex[self.dtype])
+        return self.backend.irfftn(x, out=out, **kw)
+
+    @staticmethod
+    def new_inplace_buffer(shape: Tuple[int, ...], dtype=np.float64):
+        '''
+        Return (x, x_k), a real array of `shape` and a complex array for
+        its transform over all axes, sharing the same memory. Pass them as
+        `out` for in-place transforms.
+        '''
+        dtype = np.dtype(dtype)
+        c_dtype = NdRealFFT.real_to_complex[dtype]
+        *lead, n = shape
+        shape_k = (*lead, n // 2 + 1)
+        x_k = np.empty(shape_k, dtype=c_dtype)
+        x = x_k.view(dtype)[..., :n]
+        return x, x_k
+
+    @staticmethod
+    def new_scratch_buffer(shape: Tuple[int, int, int], dtype=np.float64,
+                           dir: str = None):
+        '''
+        Out-of-core counterpart of new_inplace_buffer(), where the buffer is
+        a np.memmap of an anonymous temporary file under `dir` (None for
+        the system default), removed once no longer referred.
+        '''
+        dtype = np.dtype(dtype)
+        c_dtype = NdRealFFT.real_to_complex[dtype]
+        n0, n1, n2 = shape
+        with tempfile.TemporaryFile(dir=dir) as f:
+            x_k = np.memmap(f, dtype=c_dtype, mode='w+',
+                            shape=(n0, n1, n2 // 2 + 1))
+        x = x_k.view(dtype)[..., :n2]
+        return x, x_k
+
+    def forward_slabs(self, x: np.ndarray, out: np.ndarray,
+                      n_slab: int = None, map_x=None) -> np.ndarray:
+        '''
+        Out-of-core forward transform of a 3-D grid, e.g., of np.memmap or 
+        h5py.Dataset too large for memory. Transform along axes (1, 2) each 
+        slab of x0-planes into `out`, then along axis 0 each slab of 
+        k1-planes of `out`, in place. Return `out`.
+        
+        @x: shape (N, N, N).
+        @out: shape (N, N, N // 2 + 1), of the complex dtype. May share the
+            memory with x, e.g., by new_scratch_buffer().
+        @n_slab: number of planes in a slab. None for slabs of about 64 MB.
+        @map_x: optional, called as map_x(x_slab, b, e) for each slab of 
+            x0-planes [b, e), returning the slab to transform, e.g., a 
+            normalization.
+        
+        `shape` and `axes` of this instance must be None. Memory held is 
+        about two slabs.
+        '''
+        assert self.shape is None and self.axes is None
+        N = x.shape[0]
+        assert x.shape == (N, N, N) and out.shape == (N, N, N // 2 + 1)
+        kw = dict(norm=self.norm, workers=self.n_workers)
+        dtype = self.dtype if self.dtype is not None else np.dtype(x.dtype)
+
+        for b, e in self._slabs(N, N * N * dtype.itemsize, n_slab):
+            x_slab = np.array(x[b:e], dtype=dtype)
+            if map_x is not None:
+                x_slab = np.asarray(map_x(x_slab, b, e), dtype=dtype)
+            out[b:e] = self.backend.rfftn(x_slab, axes=(1, 2), **kw)
+        self.__fft0_slabs(out, True, n_slab)
+        return out
+
+    def backward_slabs(self, x_k: np.ndarray, out: np.ndarray,
+                       n_slab: int = None, scratch_dir: str = None
+                       ) -> np.ndarray:
+        '''
+        Out-of-core backward transform, the inverse of forward_slabs(). 
+        Transform along axis 0 each slab of k1-planes of `x_k`, then along 
+        axes (1, 2) each slab of x0-planes into `out`. Return `out`.
+        
+        @x_k: shape (N, N, N // 2 + 1). Used as the intermediate, i.e., 
+            destroyed, if `overwrite_input`. Otherwise, it is copied into a 
+            scratch file under `scratch_dir`.
+        @out: shape (N, N, N). May share the memory with x_k (e.g., by 
+            new_scratch_buffer()) if `overwrite_input`.
+        '''
+        assert self.shape is None and self.axes is None
+        N = x_k.shape[0]
+        assert x_k.shape == (N, N, N // 2 + 1) and out.shape == (N, N, N)
+        kw = dict(s=(N, N), norm=self.norm, workers=self.n_workers)
+        dtype = self.dtype if self.dtype is not None else np.dtype(
+            out.dtype)
+        c_dtype = self.real_to_complex[dtype]
+        itemsize = N * (N // 2 + 1) * c_dtype.itemsize
+
+        if not self.overwrite_input:
+            _, work_k = self.new_scratch_buffer((N, N, N), dtype, scratch_dir)
+            for b, e in self._slabs(N, itemsize, n_slab):
+                work_k[b:e] = x_k[b:e]
+            x_k = work_k
+        self.__fft0_slabs(x_k, False, n_slab)
+        for b, e in self._slabs(N, itemsize, n_slab):
+            x_k_slab = np.array(x_k[b:e], dtype=c_dtype)
+            out[b:e] = self.backend.irfftn(x_k_slab, axes=(1, 2), **kw)
+        return out
+
+    def __fft0_slabs(self, x_k: np.ndarray, forward: bool, n_slab: int):
+        '''
+        In-place transform along axis 0, for each slab of k1-planes. 
+        '''
+        N, _, n2 = x_k.shape
+        fn = self.backend.fftn if forward else self.backend.ifftn
+        for b, e in self._slabs(N, N * n2 * x_k.dtype.itemsize, n_slab):
+            slab = np.array(x_k[:, b:e])
+            x_k[:, b:e] = fn(slab, axes=(0,), norm=self.norm,
+                             workers=self.n_workers, overwrite_x=True)
+
+    @staticmethod
+    def _slabs(n_planes: int, plane_size: int, n_slab: int | None):
+        '''
+        Yield the ranges [b, e) of slabs, each of `n_slab` planes (None for
+        about 64 MB, given the size of a plane in bytes).
+        '''
+        if n_slab is None:
+            n_slab = max(64 * 1024 * 1024 // plane_size, 1)
+        assert n_slab > 0
+        for b in range(0, n_planes, n_slab):
+            yield b, min(b + n_slab, n_planes)
 
     @property
     def __impl_kw(self):
@@ -5,9 +5,23 @@ from typing import Union, Sequence, Tuple, Self
 from numba.experimental import jitclass
 import numba
 from .mesh import _Mesh, Mesh
+from .fft import NdRealFFT
 
 
-@jitclass
+_specializable_defs = {}
+
+
+def _specializable(cls):
+    '''
+    Decorator, as `jitclass`, that also keeps the Python class, so that the 
+    jitclass can be _specialized().
+    '''
+    jit_cls = jitclass(cls)
+    _specializable_defs[jit_cls] = cls
+    return jit_cls
+
+
+@_specializable
 class _Field:
 
     data: numba.float64[:, :, :]
@@ -47,6 +61,34 @@ class _Field:
         return (n, n, n)
 
 
+def _specialized(jit_cls, **spec):
+    '''
+    Return a new jitclass with the same methods as `jit_cls` (made by 
+    _specializable()), but with the types of some members overridden by 
+    `spec`, e.g., for another dtype.
+    '''
+    return jitclass(_specializable_defs[jit_cls], spec)
+
+
+_Field32 = _specialized(_Field, data=numba.float32[:, :, :])
+
+_field_impls = {
+    np.dtype(np.float64): _Field,
+    np.dtype(np.float32): _Field32,
+}
+
+
+def _field_impl_of(dtype: np.dtype):
+    '''
+    Return the jitclass of a field with given dtype of data, i.e.,
+    np.float64 (_Field) or np.float32 (_Field32).
+    '''
+    impl = _field_impls.get(np.dtype(dtype))
+    if impl is None:
+        raise ValueError(f'Unsupported dtype {dtype}.')
+    return impl
+
+
 class Field(abc.HasDictRepr):
 
     def __init__(self, impl: _Field) -> None:
@@ -54,17 +96,76 @@ class Field(abc.HasDictRepr):
         self._impl = impl
 
     @classmethod
-    def new_zeros(cls, mesh: Mesh) -> Self:
+    def new_zeros(cls, mesh: Mesh, dtype=np.float64) -> Self:
+        '''
+        @dtype: np.float64 or np.float32.
+        '''
         n = mesh.n_grids
-        data = np.zeros((n, n, n), dtype=np.float64)
-        impl = _Field(data, mesh._impl)
+        data = np.zeros((n, n, n), dtype=dtype)
+        impl = _field_impl_of(dtype)(data, mesh._impl)
         return cls(impl)
 
     @classmethod
     def new_by_data(cls, data: np.ndarray, mesh: Mesh) -> Self:
-        impl = _Field(data, mesh._impl)
+        '''
+        @data: referred, not copied. Its dtype must be np.float64 or 
+            np.float32.
+        '''
+        impl = _field_impl_of(data.dtype)(data, mesh._impl)
         return cls(impl)
 
+    @classmethod
+    def new_by_data_k(cls, data_k: np.ndarray, mesh: Mesh,
+                      n_grids: int = None, n_workers: int = None,
+                      dtype=None) -> Self:
+        '''
+        Create a field from its Fourier transform, resampled to `n_grids` 
+        by truncating or zero-padding in Fourier space, i.e., by band-limited 
+        interpolation. See resampled().
+
+        @data_k: transform of a field on `mesh`, by NdRealFFT with 
+            norm='ortho' (e.g., `delta_k` in the results of the smoothing 
+            and gravity stages). Shape (N, N, N//2+1).
+        @n_grids: number of grids per side of the new field. None for N.
+        @n_workers: workers of the backward transform.
+        @dtype: np.float64 or np.float32. None for the precision of `data_k`.
+        '''
+        N = mesh.n_grids
+        assert data_k.shape == (N, N, N // 2 + 1)
+        if n_grids is None:
+            n_grids = N
+        M = int(n_grids)
+        assert M > 0
+        if dtype is None:
+            dtype = np.float32 if data_k.dtype == np.complex64 \
+                else np.float64
+        dtype = np.dtype(dtype)
+
+        fft = NdRealFFT(shape=(M, M, M), norm='ortho', overwrite_input=True,
+                        n_workers=n_workers, dtype=dtype)
+        y_k = np.empty((M, M, M // 2 + 1), dtype=fft.real_to_complex[dtype])
+        _resample_k(data_k, y_k, (M / N)**1.5)
+        data = fft.backward(y_k)
+        return cls.new_by_data(data, Mesh.new(M, mesh.l_box))
+
+    def resampled(self, n_grids: int, n_workers: int = None) -> Self:
+        '''
+        Return the field resampled to `n_grids` per side, on the same box, 
+        by truncating (n_grids < N) or zero-padding (n_grids > N) its 
+        Fourier transform. 
+        
+        Modes at or beyond the Nyquist frequency of the coarser of the two 
+        meshes are dropped, so the result is real and band-limited; a field 
+        without such modes is exactly interpolated by upsampling, and 
+        recovered by downsampling back.
+
+        @n_workers: workers of the transforms.
+        '''
+        fft = NdRealFFT(norm='ortho', n_workers=n_workers, dtype=self.dtype)
+        data_k = fft.forward(self.data)
+        return self.new_by_data_k(data_k, self.mesh, n_grids,
+                                  n_workers=n_workers, dtype=self.dtype)
+
     def copied(self) -> Self:
         return self.new_by_data(self.data.copy(), self.mesh)
 
@@ -87,3 +188,25 @@ class Field(abc.HasDictRepr):
     @property
     def shape(self) -> Tuple[int, int, int]:
         return self._impl.shape
+
+
+@numba.njit(parallel=True)
+def _resample_k(x_k: np.ndarray, y_k: np.ndarray, scale: float):
+    '''
+    Fill `y_k` (M, M, M//2+1) by the modes of `x_k` (N, N, N//2+1) with 
+    |k_i| below the Nyquist frequency of min(N, M), times `scale`. Others 
+    are zero.
+    '''
+    N, M = x_k.shape[0], y_k.shape[0]
+    k_max = (min(N, M) - 1) // 2
+    for i0 in numba.prange(M):
+        k0 = np.int64(i0)
+        if k0 > M // 2:
+            k0 -= M
+        for i1 in range(M):
+            k1 = i1 if i1 <= M // 2 else i1 - M
+            for i2 in range(M // 2 + 1):
+                if abs(k0) > k_max or abs(k1) > k_max or i2 > k_max:
+                    y_k[i0, i1, i2] = 0.
+                else:
+                    y_k[i0, i1, i2] = x_k[k0 % N, k1 % N, i2] * scale
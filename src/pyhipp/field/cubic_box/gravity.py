@@ -1,34 +1,20 @@
 from __future__ import annotations
 import typing
-from pyhipp.core import abc
+from pyhipp.core.dataproc.parallel import NumbaThreads
 from pyhipp.io import h5
 from typing import Self, Iterable
-from .field import _Field, _Mesh, Field
+from .field import Field
 from .fft import NdRealFFT
-from .mass_assignment import _LinearShapeFn, _NoneShapeFn
+from .mass_assignment import _interlace_k
+from .kernels import _KSpaceKernel, _kernel_of
+from .smoothing import FFTSmoothing, _slab_normalizer
+from .dump_policy import DumpPolicy
 import numpy as np
 from numba.experimental import jitclass
 import numba
-from .smoothing import _Gaussian
 from dataclasses import dataclass
 
 
-@jitclass
-class _GreenFn3d:
-
-    def __init__(self) -> None:
-        '''
-        Three dimensional Green's function.
-        '''
-        pass
-
-    def at_ki(self, ki: np.ndarray):
-        ki_sq = np.sum(ki*ki)
-        if ki_sq < 1.0e-6:
-            return 0.0
-        return -1.0 / ki_sq
-
-
 @jitclass
 class _TidalTensor:
 
@@ -59,8 +45,14 @@ class TidalField:
         T_x: np.ndarray
         lam: np.ndarray
 
-        def dump(self, group: h5.Group, flag='x'):
-            group.dump({
+        def dump(self, group: h5.Group, flag='x', policy: DumpPolicy = None):
+            '''
+            Intermediates not kept (i.e., None) are not dumped.
+            
+            @policy: which fields to dump and how they are stored. None for 
+                all, as is.
+            '''
+            out = {
                 'l_box': self.l_box,
                 'n_grids': self.n_grids,
                 'rho_x': self.rho_x,
@@ -71,117 +63,318 @@ class TidalField:
                 'phi_k': self.phi_k,
                 'T_x': self.T_x,
                 'lam': self.lam
-            }, flag=flag)
+            }
+            if policy is None:
+                policy = DumpPolicy()
+            policy.dump(group, out, flag=flag)
+
+    intermediates = ('rho_x', 'delta_x', 'delta_k', 'delta_sm_k',
+                     'delta_sm_x', 'phi_k', 'T_x')
 
-    def __init__(self, n_workers=None, r_sm=1.0, correct_shape='cic') -> None:
+    def __init__(self, n_workers=None, r_sm=1.0, correct_shape='cic',
+                 keep=None) -> None:
         '''
         @r_sm: Gaussian smooth length.
+        @correct_shape: mass-assignment scheme of the input density field,
+            'ngp' | 'cic' | 'tsc' | 'pcs', to deconvolve. None or False for 
+            no correction.
+        @keep: names of the intermediates (see `intermediates`) to keep in 
+            the Result. The others are None, and are released as soon as 
+            possible. None for all.
+            
+            Without 'T_x', the run is memory-lean: the eigenvalues are 
+            solved in closed form by a parallel kernel, instead of by 
+            np.linalg.eigvalsh() on a (N, N, N, 3, 3) tensor. E.g., 
+            keep=('delta_sm_x',) takes about 10 real grids at peak besides 
+            the input, compared to about 20 for keeping all.
+        
+        The smoothing, potential and the six tidal components are made in 
+        a single parallel pass over k-space, and each component is 
+        transformed in place. The parallel kernels use `n_workers` threads
+        if it is positive.
         '''
         self._n_workers = n_workers
         self._r_sm = r_sm
         
-        assert correct_shape in (False, 'cic')
+        assert correct_shape in (None, False, 'ngp', 'cic', 'tsc', 'pcs')
         self._correct_shape = correct_shape
 
-    def run(self, rho_x: Field):
+        keep = self.intermediates if keep is None else tuple(keep)
+        for key in keep:
+            if key not in self.intermediates:
+                raise ValueError(f'Unknown intermediate {key}.')
+        self._keep = frozenset(keep)
+
+    def run(self, rho_x: Field, rho_x_shifted: Field = None):
         '''
         @rho_x: density field obtained by mass_assignment.DensityField, 
-        i.e., assigned with CIC, without shape correction. Can be arbitrarily 
-        normalized.
+        i.e., assigned with the scheme `correct_shape`, without shape 
+        correction. Can be arbitrarily normalized.
+        @rho_x_shifted: optional, the density field on the grid shifted by 
+        half a cell, e.g., DensityField(interlace=True).field_shifted. If 
+        provided, it is interlaced with `rho_x` in Fourier space, and 
+        `delta_k` in the result is the interlaced one.
         '''
-
+        keep = self._keep
         rho_x, mesh = rho_x.data, rho_x.mesh._impl
-        fft = NdRealFFT(n_workers=self._n_workers, norm='ortho')
-        sm = _Gaussian(self._r_sm, mesh)
-        S = _LinearShapeFn(mesh) if self._correct_shape == 'cic' \
-            else _NoneShapeFn()
+        N = mesh.n_grids
+        # The shape is passed on, as the backward transform cannot tell an 
+        # odd N from the shape of the k-space array.
+        fft = NdRealFFT(shape=(N, N, N), n_workers=self._n_workers,
+                        norm='ortho')
+        K = _kernel_of(mesh.n_grids, mesh.l_box, 'gaussian', self._r_sm,
+                       self._correct_shape)
+        G = _kernel_of(mesh.n_grids, mesh.l_box, 'green')
 
         delta_x = self._normalize(rho_x)
+        dtype = delta_x.dtype
         delta_k = fft.forward(delta_x)
-        delta_sm_k, phi_k = self._solve_grav(delta_k, S, sm)
-        delta_sm_x = fft.backward(delta_sm_k)
-
-        N = mesh.n_grids
-        T_x = np.empty((N, N, N, 3, 3), dtype=np.float64)
-        for i in range(3):
-            for j in range(i+1):
-                Tij_k = self._find_tidal_ij(phi_k, i, j, mesh)
-                Tij_x = fft.backward(Tij_k)
-                T_x[..., i, j] = Tij_x
-                if i != j:
-                    T_x[..., j, i] = Tij_x
-
-        lam = np.linalg.eigvalsh(T_x)
+        if rho_x_shifted is not None:
+            delta_shifted_x = self._normalize(rho_x_shifted.data)
+            _interlace_k(delta_k, fft.forward(delta_shifted_x))
+            del delta_shifted_x
+        if 'delta_x' not in keep:
+            delta_x = None
+
+        delta_sm_k = None
+        if 'delta_sm_k' in keep or 'delta_sm_x' in keep:
+            delta_sm_k = np.empty_like(delta_k)
+        phi_k = np.empty_like(delta_k) if 'phi_k' in keep else None
+        # Each of (T00, T10, T11, T20, T21, T22) is made in k-space into a 
+        # buffer, and transformed in place into its real view.
+        bufs = [NdRealFFT.new_inplace_buffer((N, N, N), dtype)
+                for _ in range(6)]
+        Ts_k = tuple(T_k for _, T_k in bufs)
+        with NumbaThreads(self._n_threads):
+            self._solve_grav_tidal(delta_k, K, G, Ts_k, delta_sm_k, phi_k)
+        del Ts_k
+        if 'delta_k' not in keep:
+            delta_k = None
+        delta_sm_x = None
+        if 'delta_sm_x' in keep:
+            delta_sm_x = fft.backward(delta_sm_k)
+        if 'delta_sm_k' not in keep:
+            delta_sm_k = None
+
+        fft_inplace = NdRealFFT(shape=(N, N, N), n_workers=self._n_workers,
+                                norm='ortho', overwrite_input=True)
+        for T_x, T_k in bufs:
+            fft_inplace.backward(T_k, out=T_x)
+        Ts_x = [T_x for T_x, _ in bufs]
+        del bufs, T_x, T_k
+        T_x = None
+        if 'T_x' in keep:
+            T_x = np.empty((N, N, N, 3, 3), dtype=dtype)
+            ij = 0
+            for i in range(3):
+                for j in range(i+1):
+                    T_x[..., i, j] = Ts_x[ij]
+                    T_x[..., j, i] = Ts_x[ij]
+                    ij += 1
+            del Ts_x
+            lam = np.linalg.eigvalsh(T_x)
+        else:
+            lam = np.empty((N, N, N, 3), dtype=dtype)
+            with NumbaThreads(self._n_threads):
+                self._eigvalsh_3x3(*Ts_x, lam)
+            del Ts_x
+
+        if 'rho_x' not in keep:
+            rho_x = None
 
         return TidalField.Result(l_box=mesh.l_box, n_grids=mesh.n_grids,
             rho_x=rho_x, delta_x=delta_x, delta_k=delta_k,
             delta_sm_k=delta_sm_k, delta_sm_x=delta_sm_x,
             phi_k=phi_k, T_x=T_x, lam=lam)
 
+    def run_out_of_core(self, rho_x: Field, out: h5.Group, flag='x',
+                        n_slab: int = None, scratch_dir: str = None,
+                        policy: DumpPolicy = None) -> None:
+        '''
+        Out-of-core counterpart of run(), for a field too large for memory, 
+        e.g., memory-mapped by DensityField.load(group, mmap=True). 
+        
+        'lam', and 'delta_sm_x' if kept (see `keep`), are written slab by 
+        slab into `out` (created with `flag`). Other intermediates are not 
+        made. Transforms are held in scratch files under `scratch_dir` 
+        (None for the system default), of about 7 times (8 if 
+        'delta_sm_x' is kept) the size of the field at peak, and removed 
+        finally.
+        
+        @n_slab: see NdRealFFT.forward_slabs().
+        @policy: storage of the written fields, see TidalField.Result.dump(). 
+            A field not selected by it is not made.
+        '''
+        if policy is None:
+            policy = DumpPolicy()
+        mesh = rho_x.mesh._impl
+        N, dtype = mesh.n_grids, rho_x.dtype
+        fft = NdRealFFT(n_workers=self._n_workers, norm='ortho',
+                        overwrite_input=True)
+        K = _kernel_of(mesh.n_grids, mesh.l_box, 'gaussian', self._r_sm,
+                       self._correct_shape)
+        G = _kernel_of(mesh.n_grids, mesh.l_box, 'green')
+
+        def new_buffer():
+            return NdRealFFT.new_scratch_buffer((N, N, N), dtype, scratch_dir)
+
+        map_x = _slab_normalizer(rho_x.data, n_slab)
+        _, delta_k = new_buffer()
+        fft.forward_slabs(rho_x.data, delta_k, n_slab, map_x)
+
+        keep_sm = 'delta_sm_x' in self._keep and policy.selects('delta_sm_x')
+        delta_sm_k = new_buffer()[1] if keep_sm else None
+        bufs = [new_buffer() for _ in range(6)]
+        plane_size = delta_k[0].nbytes
+        with NumbaThreads(self._n_threads):
+            for b, e in NdRealFFT._slabs(N, plane_size, n_slab):
+                Ts_k = tuple(T_k[b:e] for _, T_k in bufs)
+                self._solve_grav_tidal(
+                    delta_k[b:e], K, G, Ts_k,
+                    None if delta_sm_k is None else delta_sm_k[b:e],
+                    None, b)
+        del delta_k, Ts_k
+
+        out.dump({'l_box': mesh.l_box, 'n_grids': N}, flag=flag)
+        if keep_sm:
+            dset = policy.create_dataset(out, 'delta_sm_x', (N, N, N), dtype,
+                                         flag=flag)
+            fft.backward_slabs(delta_sm_k, dset, n_slab)
+            del delta_sm_k
+        if not policy.selects('lam'):
+            return
+        for T_x, T_k in bufs:
+            fft.backward_slabs(T_k, T_x, n_slab)
+        Ts_x = [T_x for T_x, _ in bufs]
+        del bufs
+
+        dset = policy.create_dataset(out, 'lam', (N, N, N, 3), dtype,
+                                     flag=flag)
+        for b, e in NdRealFFT._slabs(N, 4 * N * N * dtype.itemsize, n_slab):
+            Ts = [np.array(T_x[b:e]) for T_x in Ts_x]
+            lam = np.empty((e - b, N, N, 3), dtype=dtype)
+            with NumbaThreads(self._n_threads):
+                self._eigvalsh_3x3(*Ts, lam)
+            dset[b:e] = lam
+
+    _n_threads = FFTSmoothing._n_threads
+
     @staticmethod
     @numba.njit
     def _normalize(rho_x: np.ndarray):
-        rho_mean = rho_x.mean()
+        '''
+        Return the overdensity with the same dtype as `rho_x`. The mean is 
+        accumulated in double precision.
+        '''
+        n0, n1, n2 = rho_x.shape
+        rho_mean = 0.0
+        for i0 in range(n0):
+            for i1 in range(n1):
+                for i2 in range(n2):
+                    rho_mean += rho_x[i0, i1, i2]
+        rho_mean /= rho_x.size
         if rho_mean < 1.0e-10:
             raise ValueError(f'Mean density {rho_mean} is too low.')
 
-        delta_x = rho_x / rho_mean - 1.0
+        delta_x = np.empty_like(rho_x)
+        for i0 in range(n0):
+            for i1 in range(n1):
+                for i2 in range(n2):
+                    delta_x[i0, i1, i2] = rho_x[i0, i1, i2] / rho_mean - 1.0
         return delta_x
 
     @staticmethod
-    @numba.njit
-    def _solve_grav(delta_k: np.ndarray, S: _LinearShapeFn, sm: _Gaussian):
-        mesh = sm.mesh
-        N = mesh.n_grids
-        Nd2 = N // 2
-        Nd2p1 = Nd2 + 1
-        assert delta_k.shape == (N, N, Nd2p1)
-
-        G = _GreenFn3d()
-
-        phi_k = np.empty_like(delta_k)
-        delta_sm_k = np.empty_like(delta_k)
-
-        ki = np.empty(3, dtype=np.float64)
-        for i0 in range(N):
-            ki[0] = np.float64(i0 - N if i0 > Nd2 else i0)
-            for i1 in range(N):
-                ki[1] = np.float64(i1 - N if i1 > Nd2 else i1)
-                for i2 in range(Nd2p1):
-                    ki[2] = np.float64(i2)
-
-                    w_S = 1.0 / S.shape_at_ki_nd(ki)
-                    w_sm = sm.window_at_ki(ki)
-                    w_G = G.at_ki(ki)
-
-                    _delta_k = delta_k[i0, i1, i2]
-                    _delta_sm_k = _delta_k * w_S * w_sm
-                    _phi_k = _delta_sm_k * w_G
-
-                    delta_sm_k[i0, i1, i2] = _delta_sm_k
-                    phi_k[i0, i1, i2] = _phi_k
-
-        return delta_sm_k, phi_k
-
-    @staticmethod
-    @numba.njit
-    def _find_tidal_ij(phi_k: np.ndarray, i: int, j: int, mesh: _Mesh):
-
-        N = mesh.n_grids
+    @numba.njit(parallel=True)
+    def _solve_grav_tidal(delta_k: np.ndarray, K: _KSpaceKernel,
+                          G: _KSpaceKernel, Ts_k: tuple,
+                          delta_sm_k: np.ndarray = None,
+                          phi_k: np.ndarray = None, i0_begin: int = 0):
+        '''
+        Smooth the overdensity, solve the potential, and find the six 
+        independent components of the tidal tensor, in a single pass over 
+        k-space.
+        
+        @K: the smoothing window divided by the shape.
+        @G: the Green's function.
+        @Ts_k: six arrays, filled with (T00, T10, T11, T20, T21, T22).
+        @delta_sm_k, phi_k: if not None, filled with the smoothed 
+            overdensity and the potential, respectively.
+        @i0_begin: index of the first k0-plane, if the arrays are slabs of 
+            k0-planes.
+        '''
+        N = K.n_grids
         Nd2 = N // 2
         Nd2p1 = Nd2 + 1
-        assert phi_k.shape == (N, N, Nd2p1)
+        n0 = delta_k.shape[0]
+        assert delta_k.shape[1:] == (N, Nd2p1) and i0_begin + n0 <= N
+        T00, T10, T11, T20, T21, T22 = Ts_k
 
         T = _TidalTensor()
-
-        Tij_k = phi_k.copy()
-        ki = np.empty(3, dtype=np.float64)
-        for i0 in range(N):
-            ki[0] = np.float64(i0 - N if i0 > Nd2 else i0)
+        for i0 in numba.prange(n0):
+            j0 = np.int64(i0_begin + i0)
+            ki = np.empty(3, dtype=np.float64)
+            ki[0] = np.float64(j0 - N if j0 > Nd2 else j0)
             for i1 in range(N):
                 ki[1] = np.float64(i1 - N if i1 > Nd2 else i1)
                 for i2 in range(Nd2p1):
                     ki[2] = np.float64(i2)
-                    Tij_k[i0, i1, i2] = T.at_ki(ki, phi_k[i0, i1, i2], i, j)
+                    _delta_sm_k = delta_k[i0, i1, i2] * K.at(j0, i1, i2)
+                    if delta_sm_k is not None:
+                        delta_sm_k[i0, i1, i2] = _delta_sm_k
+                    _phi_k = _delta_sm_k * G.at(j0, i1, i2)
+                    if phi_k is not None:
+                        phi_k[i0, i1, i2] = _phi_k
+                    T00[i0, i1, i2] = T.at_ki(ki, _phi_k, 0, 0)
+                    T10[i0, i1, i2] = T.at_ki(ki, _phi_k, 1, 0)
+                    T11[i0, i1, i2] = T.at_ki(ki, _phi_k, 1, 1)
+                    T20[i0, i1, i2] = T.at_ki(ki, _phi_k, 2, 0)
+                    T21[i0, i1, i2] = T.at_ki(ki, _phi_k, 2, 1)
+                    T22[i0, i1, i2] = T.at_ki(ki, _phi_k, 2, 2)
 
-        return Tij_k
+    @staticmethod
+    @numba.njit(parallel=True)
+    def _eigvalsh_3x3(T00: np.ndarray, T10: np.ndarray, T11: np.ndarray,
+                      T20: np.ndarray, T21: np.ndarray, T22: np.ndarray,
+                      lam: np.ndarray):
+        '''
+        Fill `lam` with the eigenvalues, in ascending order, of the 
+        symmetric tensor at each grid point.
+        '''
+        n0, n1, n2 = T00.shape
+        for i0 in numba.prange(n0):
+            for i1 in range(n1):
+                for i2 in range(n2):
+                    l0, l1, l2 = _eigvalsh_sym3(
+                        T00[i0, i1, i2], T10[i0, i1, i2], T20[i0, i1, i2],
+                        T11[i0, i1, i2], T21[i0, i1, i2], T22[i0, i1, i2])
+                    lam[i0, i1, i2, 0] = l0
+                    lam[i0, i1, i2, 1] = l1
+                    lam[i0, i1, i2, 2] = l2
+
+
+@numba.njit
+def _eigvalsh_sym3(a00: float, a01: float, a02: float,
+                   a11: float, a12: float, a22: float):
+    '''
+    Eigenvalues, in ascending order, of a symmetric 3x3 matrix, by the 
+    trigonometric closed form (Smith 1961). Computed in double precision.
+    '''
+    a00, a01, a02 = np.float64(a00), np.float64(a01), np.float64(a02)
+    a11, a12, a22 = np.float64(a11), np.float64(a12), np.float64(a22)
+
+    p1 = a01 * a01 + a02 * a02 + a12 * a12
+    q = (a00 + a11 + a22) / 3.0
+    b00, b11, b22 = a00 - q, a11 - q, a22 - q
+    p2 = b00 * b00 + b11 * b11 + b22 * b22 + 2.0 * p1
+    if p2 <= 0.0:
+        return q, q, q
+    p = np.sqrt(p2 / 6.0)
+    det_b = b00 * (b11 * b22 - a12 * a12) - a01 * (a01 * b22 - a12 * a02) \
+        + a02 * (a01 * a12 - b11 * a02)
+    r = 0.5 * det_b / (p * p * p)
+    r = min(max(r, -1.0), 1.0)
+    phi = np.arccos(r) / 3.0
+    l2 = q + 2.0 * p * np.cos(phi)
+    l0 = q + 2.0 * p * np.cos(phi + 2.0 * np.pi / 3.0)
+    l1 = 3.0 * q - l0 - l2
+    return l0, l1, l2
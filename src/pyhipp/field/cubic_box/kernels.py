@@ -0,0 +1,195 @@
+'''
+Kernels in Fourier space, i.e., smoothing windows, Green's function and 
+shape deconvolution, and the cache of their tabulated grids.
+'''
+
+from __future__ import annotations
+import typing
+from functools import lru_cache
+from numba.experimental import jitclass
+from .mesh import _Mesh
+from .mass_assignment import _shape_fn_of
+import numpy as np
+import numba
+
+
+@jitclass
+class _Gaussian:
+
+    r: float
+    mesh: _Mesh
+    scale: float
+
+    def __init__(self, r: float, mesh: _Mesh) -> None:
+        '''
+        N-dimension Gaussian smoothing.
+        '''
+
+        l_box = mesh.l_box
+        scale = -0.5 * (2.0 * np.pi * r / l_box)**2
+
+        self.r = r
+        self.mesh = mesh
+        self.scale = scale
+
+    def window_at_ki(self, ki: np.ndarray):
+        '''
+        @ki: wave vector, e.g., (i, j, k) in 3D, where i, j, k are 
+            integer indices of the grid points in fourier space.
+        '''
+        return self.window_at_ki_sq(np.sum(ki*ki))
+
+    def window_at_ki_sq(self, ki_sq: float):
+        '''
+        @ki_sq: squared norm of the wave vector in grid indices.
+        '''
+        return np.exp(self.scale * ki_sq)
+
+    def volume(self):
+        return (2 * np.pi * self.r**2)**(3.0/2.0)
+
+
+@jitclass
+class _Tophat:
+
+    r: float
+    mesh: _Mesh
+    scale: float
+
+    def __init__(self, r: float, mesh: _Mesh) -> None:
+        '''
+        N-dimension tophat smoothing.
+        '''
+
+        l_box = mesh.l_box
+        scale = 2.0*np.pi*r / l_box
+
+        self.r = r
+        self.mesh = mesh
+        self.scale = scale
+
+    def window_at_ki(self, ki: np.ndarray):
+        '''
+        @ki: wave vector, e.g., (i, j, k) in 3D, where i, j, k are 
+            integer indices of the grid points in fourier space.
+        '''
+        return self.window_at_ki_sq(np.sum(ki*ki))
+
+    def window_at_ki_sq(self, ki_sq: float):
+        '''
+        @ki_sq: squared norm of the wave vector in grid indices.
+        '''
+        kr = np.sqrt(ki_sq) * self.scale
+        if kr < 1.0e-6:
+            return 1.0
+
+        return 3.0 * (np.sin(kr) - kr * np.cos(kr)) / kr**3
+
+    def volume(self):
+        return 4.0/3.0 * np.pi * self.r**3
+
+
+@jitclass
+class _GreenFn3d:
+
+    def __init__(self) -> None:
+        '''
+        Three dimensional Green's function.
+        '''
+        pass
+
+    def at_ki(self, ki: np.ndarray):
+        return self.at_ki_sq(np.sum(ki*ki))
+
+    def at_ki_sq(self, ki_sq: float):
+        if ki_sq < 1.0e-6:
+            return 0.0
+        return -1.0 / ki_sq
+
+
+@jitclass
+class _KSpaceKernel:
+
+    n_grids: int
+    radial: numba.float64[:]
+    axis: numba.float64[:]
+
+    def __init__(self, radial: np.ndarray, axis: np.ndarray) -> None:
+        '''
+        Kernel on the grid of a real-to-complex transform, tabulated as 
+        radial[ki_sq] * axis[i0] * axis[i1] * axis[i2], where ki_sq is the 
+        (integer) squared norm of the wave vector in grid indices.
+        '''
+        self.n_grids = len(axis)
+        self.radial = radial
+        self.axis = axis
+
+    def at(self, i0: int, i1: int, i2: int) -> float:
+        '''
+        @i0, i1, i2: indices of a grid point in Fourier space.
+        '''
+        N = self.n_grids
+        Nd2 = N // 2
+        # Signed, as the indices of a prange loop may be unsigned.
+        i0, i1, i2 = np.int64(i0), np.int64(i1), np.int64(i2)
+        k0 = i0 - N if i0 > Nd2 else i0
+        k1 = i1 - N if i1 > Nd2 else i1
+        k2 = i2 - N if i2 > Nd2 else i2
+        ax = self.axis
+        return self.radial[k0*k0 + k1*k1 + k2*k2] * (ax[i0] * ax[i1] * ax[i2])
+
+
+@lru_cache(maxsize=64)
+def _kernel_of(n_grids: int, l_box: float, method: str = None,
+               r: float = 0.0, correct_shape: str = None) -> _KSpaceKernel:
+    '''
+    Return the kernel `window / shape`, built on the first call with the 
+    same arguments and cached thereafter. Tables are O(n_grids^2) in size.
+    Clear the cache by _kernel_of.cache_clear().
+    
+    @method: 'gaussian' | 'tophat' with radius `r`, 'green' for the Green's 
+        function, or None for unity.
+    @correct_shape: mass-assignment scheme to deconvolve. None or False for 
+        no correction.
+    '''
+    mesh = _Mesh(n_grids, l_box)
+    n_ki_sq = 3 * (n_grids // 2)**2 + 1
+    if method == 'gaussian':
+        radial = _window_table(_Gaussian(r, mesh), n_ki_sq)
+    elif method == 'tophat':
+        radial = _window_table(_Tophat(r, mesh), n_ki_sq)
+    elif method == 'green':
+        radial = _green_table(_GreenFn3d(), n_ki_sq)
+    elif method is None:
+        radial = np.ones(n_ki_sq)
+    else:
+        raise ValueError(f'Unknown method {method}.')
+    S = _shape_fn_of(correct_shape, mesh)
+    axis = _deconv_table(S, n_grids)
+    return _KSpaceKernel(radial, axis)
+
+
+@numba.njit
+def _window_table(sm: _Gaussian, n_ki_sq: int):
+    out = np.empty(n_ki_sq, dtype=np.float64)
+    for ki_sq in range(n_ki_sq):
+        out[ki_sq] = sm.window_at_ki_sq(np.float64(ki_sq))
+    return out
+
+
+@numba.njit
+def _green_table(G: _GreenFn3d, n_ki_sq: int):
+    out = np.empty(n_ki_sq, dtype=np.float64)
+    for ki_sq in range(n_ki_sq):
+        out[ki_sq] = G.at_ki_sq(np.float64(ki_sq))
+    return out
+
+
+@numba.njit
+def _deconv_table(S, n_grids: int):
+    N, Nd2 = n_grids, n_grids // 2
+    out = np.empty(N, dtype=np.float64)
+    for i in range(N):
+        ki = np.float64(i - N if i > Nd2 else i)
+        out[i] = 1.0 / S.shape_at_ki(ki)
+    return out
@@ -1,9 +1,15 @@
 from __future__ import annotations
 import typing
 from pyhipp.core import abc
+from pyhipp.core.dataproc.parallel import NumbaThreads
 from pyhipp.io import h5
 from typing import Self, Iterable
-from .field import _Field, _Mesh, Field, Mesh
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import warnings
+from .field import (
+    _Field, _Mesh, Field, Mesh, _specializable, _specialized,
+    _field_impl_of)
 import numpy as np
 from numba.experimental import jitclass
 import numba
@@ -13,6 +19,7 @@ import numba
 class _LinearShapeFn:
 
     mesh: _Mesh
+    n_support: int
 
     def __init__(self, mesh: _Mesh) -> None:
         '''
@@ -20,6 +27,7 @@ class _LinearShapeFn:
         i.e., cloud-in-a-Cell (CIC).
         '''
         self.mesh = mesh
+        self.n_support = 2
 
     def shape_at_xi(self, xi: float):
         return max(1.0 - np.abs(xi), 0.0)
@@ -62,6 +70,191 @@ class _LinearShapeFn:
 
         return i_l, i_r, w_l, w_r
 
+    def stencil_at(self, x: float):
+        '''
+        Return (i, ws), where ws[j] is the weight at grid point 
+        (i + j) % n_grids, for j in range(n_support).
+        '''
+        i_l, _, w_l, w_r = self.weights_at(x)
+        return i_l, (w_l, w_r)
+
+
+@jitclass
+class _ConstantShapeFn:
+
+    mesh: _Mesh
+    n_support: int
+
+    def __init__(self, mesh: _Mesh) -> None:
+        '''
+        Assignment algorithm using a constant shape function, 
+        i.e., nearest grid point (NGP).
+        '''
+        self.mesh = mesh
+        self.n_support = 1
+
+    def shape_at_xi(self, xi: float):
+        return 1.0 if np.abs(xi) < 0.5 else 0.0
+
+    def shape_at_x(self, x: float) -> float:
+        xi = x / self.mesh.l_grid
+        return self.shape_at_xi(xi)
+
+    def shape_at_ki(self, ki: float) -> float:
+        '''
+        @k: integer grid index in Fourier space.
+        '''
+        if np.abs(ki) < 1.0e-6:
+            return 1.0
+        x = np.pi * ki / self.mesh.n_grids
+        return np.sin(x) / x
+
+    def shape_at_ki_nd(self, ki: np.ndarray):
+        s = 1.0
+        for _ki in ki:
+            s *= self.shape_at_ki(_ki)
+        return s
+
+    def shape_at_k(self, k: float):
+        ki = k * self.mesh.l_box / (2.0 * np.pi)
+        return self.shape_at_ki(ki)
+
+    def stencil_at(self, x: float):
+        '''
+        See _LinearShapeFn.stencil_at().
+        '''
+        l_grid, n_grids = self.mesh.l_grid, self.mesh.n_grids
+        i = np.int64(np.floor(x / l_grid + 0.5)) % n_grids
+        return i, (1.0, )
+
+
+@jitclass
+class _QuadraticShapeFn:
+
+    mesh: _Mesh
+    n_support: int
+
+    def __init__(self, mesh: _Mesh) -> None:
+        '''
+        Assignment algorithm using a quadratic shape function, 
+        i.e., triangular-shaped cloud (TSC).
+        '''
+        self.mesh = mesh
+        self.n_support = 3
+
+    def shape_at_xi(self, xi: float):
+        a = np.abs(xi)
+        if a < 0.5:
+            return 0.75 - a * a
+        if a < 1.5:
+            return 0.5 * (1.5 - a)**2
+        return 0.0
+
+    def shape_at_x(self, x: float) -> float:
+        xi = x / self.mesh.l_grid
+        return self.shape_at_xi(xi)
+
+    def shape_at_ki(self, ki: float) -> float:
+        '''
+        @k: integer grid index in Fourier space.
+        '''
+        if np.abs(ki) < 1.0e-6:
+            return 1.0
+        x = np.pi * ki / self.mesh.n_grids
+        sinc = np.sin(x) / x
+        return sinc * sinc * sinc
+
+    def shape_at_ki_nd(self, ki: np.ndarray):
+        s = 1.0
+        for _ki in ki:
+            s *= self.shape_at_ki(_ki)
+        return s
+
+    def shape_at_k(self, k: float):
+        ki = k * self.mesh.l_box / (2.0 * np.pi)
+        return self.shape_at_ki(ki)
+
+    def stencil_at(self, x: float):
+        '''
+        See _LinearShapeFn.stencil_at().
+        '''
+        l_grid, n_grids = self.mesh.l_grid, self.mesh.n_grids
+
+        x = x / l_grid
+        x_c = np.floor(x + 0.5)
+        dx = x - x_c
+        w_l = 0.5 * (0.5 - dx)**2
+        w_c = 0.75 - dx * dx
+        w_r = 0.5 * (0.5 + dx)**2
+
+        i_l = (np.int64(x_c) - 1) % n_grids
+        return i_l, (w_l, w_c, w_r)
+
+
+@jitclass
+class _CubicShapeFn:
+
+    mesh: _Mesh
+    n_support: int
+
+    def __init__(self, mesh: _Mesh) -> None:
+        '''
+        Assignment algorithm using a cubic shape function, 
+        i.e., piecewise cubic spline (PCS).
+        '''
+        self.mesh = mesh
+        self.n_support = 4
+
+    def shape_at_xi(self, xi: float):
+        a = np.abs(xi)
+        if a < 1.0:
+            return (4.0 - 6.0 * a * a + 3.0 * a * a * a) / 6.0
+        if a < 2.0:
+            return (2.0 - a)**3 / 6.0
+        return 0.0
+
+    def shape_at_x(self, x: float) -> float:
+        xi = x / self.mesh.l_grid
+        return self.shape_at_xi(xi)
+
+    def shape_at_ki(self, ki: float) -> float:
+        '''
+        @k: integer grid index in Fourier space.
+        '''
+        if np.abs(ki) < 1.0e-6:
+            return 1.0
+        x = np.pi * ki / self.mesh.n_grids
+        sinc_sq = (np.sin(x) / x)**2
+        return sinc_sq * sinc_sq
+
+    def shape_at_ki_nd(self, ki: np.ndarray):
+        s = 1.0
+        for _ki in ki:
+            s *= self.shape_at_ki(_ki)
+        return s
+
+    def shape_at_k(self, k: float):
+        ki = k * self.mesh.l_box / (2.0 * np.pi)
+        return self.shape_at_ki(ki)
+
+    def stencil_at(self, x: float):
+        '''
+        See _LinearShapeFn.stencil_at().
+        '''
+        l_grid, n_grids = self.mesh.l_grid, self.mesh.n_grids
+
+        x = x / l_grid
+        x_l = np.floor(x)
+        t = x - x_l
+        s = 1.0 - t
+        w_0 = s * s * s / 6.0
+        w_1 = (4.0 - 6.0 * t * t + 3.0 * t * t * t) / 6.0
+        w_2 = (4.0 - 6.0 * s * s + 3.0 * s * s * s) / 6.0
+        w_3 = t * t * t / 6.0
+
+        i_0 = (np.int64(x_l) - 1) % n_grids
+        return i_0, (w_0, w_1, w_2, w_3)
+
 
 @jitclass
 class _NoneShapeFn:
@@ -74,7 +267,7 @@ class _NoneShapeFn:
     def shape_at_ki_nd(self, ki: np.ndarray) -> float:
         return 1.0
 
-@jitclass
+@_specializable
 class _Linear:
 
     data: numba.float64[:, :, :]
@@ -117,16 +310,375 @@ class _Linear:
                 self.add_1(x)
 
 
+@numba.njit
+def _add_1_by_stencil(data: np.ndarray, shape_fn: _LinearShapeFn,
+                      x: np.ndarray, weight: float):
+    '''
+    Add a point to `data`, using the stencil of any shape function.
+    '''
+    n = shape_fn.mesh.n_grids
+    i0, ws0 = shape_fn.stencil_at(x[0])
+    i1, ws1 = shape_fn.stencil_at(x[1])
+    i2, ws2 = shape_fn.stencil_at(x[2])
+    for j0 in range(len(ws0)):
+        k0 = (i0 + j0) % n
+        for j1 in range(len(ws1)):
+            k1 = (i1 + j1) % n
+            for j2 in range(len(ws2)):
+                k2 = (i2 + j2) % n
+                data[k0, k1, k2] += ws0[j0] * ws1[j1] * ws2[j2] * weight
+
+
+@numba.njit(parallel=True, nogil=True)
+def _sort_by_first_plane(shape_fn: _LinearShapeFn, xs: np.ndarray,
+                         args: np.ndarray, n_chunks: int):
+    '''
+    Stable counting sort of points by the first x0-plane in their stencils.
+    Fill `args` (shape (N,), int32 or int64, see _new_sort_args()) and 
+    return `firsts`, so that points args[firsts[p]:firsts[p+1]] have the 
+    first plane p, in their input order.
+
+    Points are split into `n_chunks` contiguous chunks (e.g., one per 
+    thread), which are histogrammed and scattered in parallel. 
+    '''
+    n_xs = len(xs)
+    i0s = np.empty(n_xs, dtype=np.int32)
+    for i in numba.prange(n_xs):
+        i0s[i] = shape_fn.stencil_at(xs[i, 0])[0]
+    return _sort_by_plane(i0s, shape_fn.mesh.n_grids, args, n_chunks)
+
+
+@numba.njit(parallel=True, nogil=True)
+def _sort_by_plane(i0s: np.ndarray, n: int, args: np.ndarray,
+                   n_chunks: int):
+    '''
+    Stable counting sort of points by their planes i0s, in [0, n). See
+    _sort_by_first_plane().
+    '''
+    n_xs = len(i0s)
+    heads = np.zeros((n_chunks, n), dtype=np.int64)
+    for c in numba.prange(n_chunks):
+        for i in range(c * n_xs // n_chunks, (c + 1) * n_xs // n_chunks):
+            heads[c, i0s[i]] += 1
+
+    # heads[c, p] becomes the first slot of chunk c in plane p
+    firsts = np.zeros(n + 1, dtype=np.int64)
+    for p in range(n):
+        head = firsts[p]
+        for c in range(n_chunks):
+            cnt = heads[c, p]
+            heads[c, p] = head
+            head += cnt
+        firsts[p + 1] = head
+
+    for c in numba.prange(n_chunks):
+        for i in range(c * n_xs // n_chunks, (c + 1) * n_xs // n_chunks):
+            p = i0s[i]
+            args[heads[c, p]] = i
+            heads[c, p] += 1
+    return firsts
+
+
+def _new_sort_args(n_xs: int) -> np.ndarray:
+    '''
+    Buffer of the sorted indices of _sort_by_first_plane(), with int32 if 
+    possible.
+    '''
+    dtype = np.int32 if n_xs < 2**31 else np.int64
+    return np.empty(n_xs, dtype=dtype)
+
+
+@numba.njit
+def _sph_kernel(q: float):
+    '''
+    Cubic spline kernel (unnormalized) at q = r / h, vanishing at q >= 1.
+    '''
+    if q < 0.5:
+        return 1.0 - 6.0 * q * q * (1.0 - q)
+    if q < 1.0:
+        t = 1.0 - q
+        return 2.0 * t * t * t
+    return 0.0
+
+
+@numba.njit
+def _add_1_by_sph(data: np.ndarray, shape_fn: _LinearShapeFn,
+                  x: np.ndarray, h: float, weight: float):
+    '''
+    Add a point to `data`, spread over the cubic-spline kernel of 
+    smoothing length `h`, normalized over the covered grid points. Fall back 
+    to the stencil of `shape_fn` if no grid point is covered.
+    '''
+    w_scale = _sph_scale(shape_fn, x, h, weight)
+    if np.isnan(w_scale):
+        _add_1_by_stencil(data, shape_fn, x, weight)
+    else:
+        _add_1_by_sph_in(data, shape_fn, x, h, w_scale, 0, 
+                         shape_fn.mesh.n_grids)
+
+
+@numba.njit(inline='always')
+def _sph_bounds(x: float, h: float, l_grid: float):
+    '''
+    Range [lb, ub) of the (unwrapped) grid indices within distance `h` 
+    from `x`, along an axis.
+    '''
+    lb = np.int64(np.ceil((x - h) / l_grid))
+    ub = np.int64(np.floor((x + h) / l_grid)) + 1
+    return lb, ub
+
+
+@numba.njit
+def _sph_scale(shape_fn: _LinearShapeFn, x: np.ndarray, h: float,
+               weight: float) -> float:
+    '''
+    `weight` divided by the sum of the kernel over the covered grid points.
+    NaN if no grid point is covered, i.e., the point falls back to the 
+    stencil.
+    '''
+    if not h > 0.0:
+        return np.nan
+    l_grid = shape_fn.mesh.l_grid
+    x0, x1, x2 = x[0], x[1], x[2]
+    lb0, ub0 = _sph_bounds(x0, h, l_grid)
+    lb1, ub1 = _sph_bounds(x1, h, l_grid)
+    lb2, ub2 = _sph_bounds(x2, h, l_grid)
+    h_inv = 1.0 / h
+
+    w_sum = 0.0
+    for j0 in range(lb0, ub0):
+        d0 = x0 - j0 * l_grid
+        for j1 in range(lb1, ub1):
+            d1 = x1 - j1 * l_grid
+            for j2 in range(lb2, ub2):
+                d2 = x2 - j2 * l_grid
+                q = np.sqrt(d0 * d0 + d1 * d1 + d2 * d2) * h_inv
+                w_sum += _sph_kernel(q)
+    if not w_sum > 0.0:
+        return np.nan
+    return weight / w_sum
+
+
+@numba.njit
+def _add_1_by_sph_in(data: np.ndarray, shape_fn: _LinearShapeFn,
+                     x: np.ndarray, h: float, w_scale: float, b: int, e: int):
+    '''
+    Add the part of a point (see _add_1_by_sph()) on x0-planes [b, e), 
+    with `w_scale` by _sph_scale().
+    '''
+    mesh = shape_fn.mesh
+    n, l_grid = mesh.n_grids, mesh.l_grid
+    x0, x1, x2 = x[0], x[1], x[2]
+    lb0, ub0 = _sph_bounds(x0, h, l_grid)
+    lb1, ub1 = _sph_bounds(x1, h, l_grid)
+    lb2, ub2 = _sph_bounds(x2, h, l_grid)
+    h_inv = 1.0 / h
+
+    for j0 in range(lb0, ub0):
+        k0 = j0 % n
+        if k0 < b or k0 >= e:
+            continue
+        d0 = x0 - j0 * l_grid
+        for j1 in range(lb1, ub1):
+            d1 = x1 - j1 * l_grid
+            k1 = j1 % n
+            for j2 in range(lb2, ub2):
+                d2 = x2 - j2 * l_grid
+                q = np.sqrt(d0 * d0 + d1 * d1 + d2 * d2) * h_inv
+                w = _sph_kernel(q)
+                if w > 0.0:
+                    data[k0, k1, j2 % n] += w * w_scale
+
+
+@numba.njit
+def _add_1_by_stencil_in(data: np.ndarray, shape_fn: _LinearShapeFn,
+                         x: np.ndarray, weight: float, b: int, e: int):
+    '''
+    Add the part of a point (see _add_1_by_stencil()) on x0-planes [b, e).
+    '''
+    n = shape_fn.mesh.n_grids
+    i0, ws0 = shape_fn.stencil_at(x[0])
+    i1, ws1 = shape_fn.stencil_at(x[1])
+    i2, ws2 = shape_fn.stencil_at(x[2])
+    for j0 in range(len(ws0)):
+        k0 = (i0 + j0) % n
+        if k0 < b or k0 >= e:
+            continue
+        for j1 in range(len(ws1)):
+            k1 = (i1 + j1) % n
+            for j2 in range(len(ws2)):
+                k2 = (i2 + j2) % n
+                data[k0, k1, k2] += ws0[j0] * ws1[j1] * ws2[j2] * weight
+
+
+@numba.njit(inline='always')
+def _planes_meet(p: int, n_planes: int, b: int, e: int, n: int) -> bool:
+    '''
+    Whether x0-planes p, p+1, ..., p+n_planes-1 (periodically, p in 
+    [0, n), n_planes > 0) meet the planes [b, e).
+    '''
+    return (b - p) % n < n_planes or (p >= b and p < e)
+
+
+@_specializable
+class _Constant:
+
+    data: numba.float64[:, :, :]
+    shape_fn: _ConstantShapeFn
+
+    def __init__(self, field: _Field) -> None:
+
+        self.data = field.data
+        self.shape_fn = _ConstantShapeFn(field.mesh)
+
+    def add_1(self, x: np.ndarray, weight: float = 1.0):
+        '''
+        Add a point to the field. See _Linear.add_1().
+        '''
+        _add_1_by_stencil(self.data, self.shape_fn, x, weight)
+
+    def add(self, xs: np.ndarray, weights: np.ndarray = None):
+        '''
+        Add multiple points to the field. See add_1().
+        '''
+        if weights is not None:
+            for x, weight in zip(xs, weights):
+                self.add_1(x, weight)
+        else:
+            for x in xs:
+                self.add_1(x)
+
+
+@_specializable
+class _Quadratic:
+
+    data: numba.float64[:, :, :]
+    shape_fn: _QuadraticShapeFn
+
+    def __init__(self, field: _Field) -> None:
+
+        self.data = field.data
+        self.shape_fn = _QuadraticShapeFn(field.mesh)
+
+    def add_1(self, x: np.ndarray, weight: float = 1.0):
+        '''
+        Add a point to the field. See _Linear.add_1().
+        '''
+        _add_1_by_stencil(self.data, self.shape_fn, x, weight)
+
+    def add(self, xs: np.ndarray, weights: np.ndarray = None):
+        '''
+        Add multiple points to the field. See add_1().
+        '''
+        if weights is not None:
+            for x, weight in zip(xs, weights):
+                self.add_1(x, weight)
+        else:
+            for x in xs:
+                self.add_1(x)
+
+
+@_specializable
+class _Cubic:
+
+    data: numba.float64[:, :, :]
+    shape_fn: _CubicShapeFn
+
+    def __init__(self, field: _Field) -> None:
+
+        self.data = field.data
+        self.shape_fn = _CubicShapeFn(field.mesh)
+
+    def add_1(self, x: np.ndarray, weight: float = 1.0):
+        '''
+        Add a point to the field. See _Linear.add_1().
+        '''
+        _add_1_by_stencil(self.data, self.shape_fn, x, weight)
+
+    def add(self, xs: np.ndarray, weights: np.ndarray = None):
+        '''
+        Add multiple points to the field. See add_1().
+        '''
+        if weights is not None:
+            for x, weight in zip(xs, weights):
+                self.add_1(x, weight)
+        else:
+            for x in xs:
+                self.add_1(x)
+
+
+_f32_spec = dict(data=numba.float32[:, :, :])
+_Constant32 = _specialized(_Constant, **_f32_spec)
+_Linear32 = _specialized(_Linear, **_f32_spec)
+_Quadratic32 = _specialized(_Quadratic, **_f32_spec)
+_Cubic32 = _specialized(_Cubic, **_f32_spec)
+
+# scheme -> (shape function, {dtype -> assignment})
+_schemes = {
+    'ngp': (_ConstantShapeFn, {np.dtype(np.float64): _Constant,
+                               np.dtype(np.float32): _Constant32}),
+    'cic': (_LinearShapeFn, {np.dtype(np.float64): _Linear,
+                             np.dtype(np.float32): _Linear32}),
+    'tsc': (_QuadraticShapeFn, {np.dtype(np.float64): _Quadratic,
+                                np.dtype(np.float32): _Quadratic32}),
+    'pcs': (_CubicShapeFn, {np.dtype(np.float64): _Cubic,
+                            np.dtype(np.float32): _Cubic32}),
+}
+
+
+def _shape_fn_of(scheme: str | None, mesh: _Mesh):
+    '''
+    Return the shape function of a mass-assignment scheme, e.g., for the 
+    correction in Fourier space.
+    
+    @scheme: 'ngp' | 'cic' | 'tsc' | 'pcs'. None or False for no correction.
+    '''
+    if scheme is None or scheme is False:
+        return _NoneShapeFn()
+    if scheme not in _schemes:
+        raise ValueError(f'Unknown scheme {scheme}.')
+    return _schemes[scheme][0](mesh)
+
+
 class DensityField(abc.HasLog):
 
-    def __init__(self, l_box: float, n_grids: int) -> None:
+    def __init__(self, l_box: float, n_grids: int,
+                 n_threads: int = None, scheme: str = 'cic',
+                 interlace: bool = False, dtype=np.float64) -> None:
+        '''
+        @n_threads: None for the serial deposit by, e.g., _Linear.add(). 
+            Otherwise, particles are deposited in parallel with up to 
+            `n_threads` threads, each owning a set of x0-planes of the grid. 
+            The result is bit-identical to the serial one, for any 
+            `n_threads`.
+        @scheme: mass-assignment scheme, 'ngp' | 'cic' | 'tsc' | 'pcs'. 
+            Pass the same value as `correct_shape` to the Fourier-space 
+            stages (e.g., TidalField) for deconvolution.
+        @interlace: if True, also deposit onto a second grid shifted by 
+            half a cell along each axis (`data_shifted`). Pass both fields 
+            to the Fourier-space stages to cancel the leading aliasing terms.
+        @dtype: np.float64 or np.float32, of the grid(s). The latter halves 
+            the memory, and is kept by the Fourier-space stages.
+        '''
+        if scheme not in _schemes:
+            raise ValueError(f'Unknown scheme {scheme}.')
+        dtype = np.dtype(dtype)
+        F = _field_impl_of(dtype)
+        MA = _schemes[scheme][1][dtype]
 
         mesh = _Mesh(n_grids, l_box)
-        data = np.zeros((n_grids, n_grids, n_grids), dtype=np.float64)
-        field = _Field(data, mesh)
+        data = np.zeros((n_grids, n_grids, n_grids), dtype=dtype)
+        ma = MA(F(data, mesh))
+
+        ma_shifted = None
+        if interlace:
+            data = np.zeros_like(data)
+            ma_shifted = MA(F(data, mesh))
 
-        ma = _Linear(field)
         self._ma = ma
+        self._ma_shifted = ma_shifted
+        self._n_threads = n_threads
+        self._scheme = scheme
 
     def add(self, xs: np.ndarray, weights: np.ndarray = None):
 
@@ -135,36 +687,644 @@ class DensityField(abc.HasLog):
             assert weights.ndim == 1
         assert xs.ndim == 2 and xs.shape[1] == 3
 
-        self._ma.add(xs, weights)
+        self.__add(self._ma, xs, weights)
+
+        ma = self._ma_shifted
+        if ma is not None:
+            xs = xs - 0.5 * ma.shape_fn.mesh.l_grid
+            self.__add(ma, xs, weights)
+
+    def add_sph(self, xs: np.ndarray, hs: np.ndarray = None,
+                weights: np.ndarray = None, n_ngbs: int = 32):
+        '''
+        Add points, each spread over a cubic-spline (SPH) kernel with its own 
+        smoothing length, i.e., the kernel vanishes beyond distance hs[i]. 
+        The kernel is normalized over the grid points it covers, so that 
+        the weight of each point is conserved. A point covering no grid 
+        point (i.e., hs[i] small compared to the cell size) is deposited 
+        with the `scheme` of this field instead.
+        
+        Not affected by `interlace`: only `data` is filled.
+        
+        @hs: smoothing lengths, shape (N,). Values larger than l_box/2 
+            (e.g., of sparse tracers) are clipped to it, with a warning, so 
+            that each grid point is covered by at most one image of a 
+            point. If None, use the distance to the `n_ngbs`-th neighbor 
+            among xs (which must be within the box).
+        @n_ngbs: significant only if `hs` is None.
+        
+        With `n_threads`, the grid is split into slabs of x0-planes, one 
+        per thread. Points are bucketed by their first planes, and each 
+        thread adds, in the input order, the parts of those reaching its 
+        slab. Hence the result is bit-identical to the serial one. No 
+        extra grid is made; the extra memory is a few words per point.
+        '''
+        assert xs.ndim == 2 and xs.shape[1] == 3
+        if hs is None:
+            hs = self.find_smoothing_lengths(xs, n_ngbs)
+        assert hs.shape == (len(xs),)
+        if weights is not None:
+            assert weights.shape == (len(xs),)
+
+        ma, n_threads = self._ma, self._n_threads
+        h_max = 0.5 * ma.shape_fn.mesh.l_box
+        n_clipped = np.count_nonzero(hs > h_max)
+        if n_clipped > 0:
+            warnings.warn(f'{n_clipped} smoothing lengths larger than '
+                          f'l_box/2 = {h_max} are clipped to it.')
+            hs = np.minimum(hs, h_max)
+        if n_threads is None:
+            self._add_sph(ma.data, ma.shape_fn, xs, hs, weights)
+            return
+
+        with NumbaThreads(n_threads):
+            n_slabs = numba.get_num_threads()
+            if n_slabs == 1:
+                self._add_sph(ma.data, ma.shape_fn, xs, hs, weights)
+            else:
+                self._add_sph_parallel(ma.data, ma.shape_fn, xs, hs, weights,
+                                       _new_sort_args(len(xs)), n_slabs)
+
+    def find_smoothing_lengths(self, xs: np.ndarray, n_ngbs: int = 32):
+        '''
+        Return the distance from each point to its `n_ngbs`-th neighbor in 
+        xs (excluding itself), accounting for the periodic boundary.
+        '''
+        from ..neighbor.kd_tree import PE
+
+        l_box = self._ma.shape_fn.mesh.l_box
+        n_workers = -1 if self._n_threads is None else self._n_threads
+        d, _ = PE(xs, l_box, n_workers=n_workers).query_k(xs, n_ngbs + 1)
+        return d[:, -1]
+
+    def add_from_h5(self, group: h5.Group, pos_key: str = 'x',
+                    weight_key: str = None, chunk_size: int = 1024 * 1024):
+        '''
+        Add points stored as datasets under `group`, without loading them 
+        at once. Rows are read and deposited chunk by chunk, and the next 
+        chunk is read by a background thread while the current one is being 
+        deposited. The peak memory is thus the grid(s) plus two chunks.
+        
+        @pos_key: key of the dataset of positions, shape (N, 3).
+        @weight_key: optional, key of the dataset of weights, shape (N,).
+        @chunk_size: number of rows in each chunk.
+        '''
+        dset_x = group[pos_key]
+        dset_w = None if weight_key is None else group[weight_key]
+        n = dset_x.shape[0]
+        assert dset_x.shape == (n, 3)
+        if dset_w is not None:
+            assert dset_w.shape == (n,)
+        assert chunk_size > 0
+
+        def read(b: int):
+            e = min(b + chunk_size, n)
+            xs = dset_x[b:e]
+            weights = None if dset_w is None else dset_w[b:e]
+            return xs, weights
+
+        bs = range(0, n, chunk_size)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            chunk = pool.submit(read, bs[0]) if len(bs) > 0 else None
+            for i in range(len(bs)):
+                xs, weights = chunk.result()
+                if i + 1 < len(bs):
+                    chunk = pool.submit(read, bs[i + 1])
+                self.add(xs, weights)
+                del xs, weights
 
     def dump(self, group: h5.Group, flag='x'):
 
         mesh = self._ma.shape_fn.mesh
-        group.dump({
+        out = {
             'data': self._ma.data,
             'l_box': mesh.l_box,
             'n_grids': mesh.n_grids,
-        }, flag=flag)
-        
+        }
+        if self.interlaced:
+            out['data_shifted'] = self._ma_shifted.data
+        group.dump(out, flag=flag)
+
     @property
     def data(self):
         return self._ma.data
 
+    @property
+    def data_shifted(self):
+        '''
+        Grid shifted by half a cell, i.e., its point (i0, i1, i2) is at 
+        (i0 + 1/2, i1 + 1/2, i2 + 1/2) * l_grid. None if not interlaced.
+        '''
+        ma = self._ma_shifted
+        return None if ma is None else ma.data
+
+    @property
+    def field(self) -> Field:
+        '''
+        The density field, referring to `data`.
+        '''
+        ma = self._ma
+        return Field.new_by_data(ma.data, Mesh(ma.shape_fn.mesh))
+
+    @property
+    def field_shifted(self) -> Field | None:
+        '''
+        The shifted density field, referring to `data_shifted`. None if not 
+        interlaced.
+        '''
+        ma = self._ma_shifted
+        if ma is None:
+            return None
+        return Field.new_by_data(ma.data, Mesh(ma.shape_fn.mesh))
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._ma.data.dtype
+
+    @property
+    def interlaced(self) -> bool:
+        return self._ma_shifted is not None
+
+    @property
+    def scheme(self) -> str:
+        return self._scheme
+
     @staticmethod
     def join_dumps(
             in_groups: Iterable[h5.Group],
-            out_group: h5.Group, flag='x'):
+            out_group: h5.Group, flag='x',
+            n_workers: int = None, slab_size: int = None):
+        '''
+        Sum the grids dumped by multiple DensityField instances (e.g., one 
+        for each file of a snapshot), and dump the result into `out_group`.
+        
+        @n_workers: None for loading and summing all the inputs in memory. 
+            Otherwise, the sum is made out-of-core: the grids are split into 
+            slabs of x0-planes, each slab is reduced pairwise (as a binary 
+            tree) over the inputs and written into a preallocated dataset 
+            under `out_group`. Slabs are distributed to `n_workers` 
+            processes (no pool if 1), which open the input files read-only, 
+            so the inputs must have been flushed to disk. The result does 
+            not depend on `n_workers` or `slab_size`.
+        @slab_size: number of x0-planes in each slab. Default: about 64 MB 
+            per slab.
+        '''
+        if n_workers is None:
+            for i, in_group in enumerate(in_groups):
+                if i == 0:
+                    out = in_group.load()
+                else:
+                    for key in 'data', 'data_shifted':
+                        if key in out:
+                            data = out[key]
+                            data += in_group.datasets[key]
+            out_group.dump(out, flag=flag)
+            return
+
+        in_groups = list(in_groups)
+        srcs = [(g.file_name, g.name) for g in in_groups]
+        g0 = in_groups[0]
+        keys = [k for k in ('data', 'data_shifted') if k in g0.datasets]
+        dset = g0['data']
+        shape, dtype = dset.shape, dset.dtype
+        for g in in_groups[1:]:
+            for key in keys:
+                assert g[key].shape == shape
+
+        n = shape[0]
+        if slab_size is None:
+            slab_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+            slab_size = max(1, (64 << 20) // slab_bytes)
+        bs = range(0, n, slab_size)
+
+        dsets = g0.datasets
+        out_group.dump({k: dsets[k] for k in dsets.keys() if k not in keys},
+                       flag=flag)
+        out_dsets = {
+            k: out_group.datasets.create_empty(k, shape, dtype, flag=flag)
+            for k in keys}
+        tasks = [(srcs, k, b, min(b + slab_size, n)) for k in keys for b in bs]
+        if n_workers == 1:
+            for task in tasks:
+                _, k, b, e = task
+                out_dsets[k][b:e] = _join_dumps_slab(*task)
+            return
 
-        for i, in_group in enumerate(in_groups):
-            if i == 0:
-                out = in_group.load()
+        # Numba's threading layers are not fork-safe, so workers are spawned.
+        mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=mp_context) as pool:
+            slabs = pool.map(_join_dumps_slab, *zip(*tasks))
+            for (_, k, b, e), slab in zip(tasks, slabs):
+                out_dsets[k][b:e] = slab
+
+    def __add(self, ma: _Linear, xs: np.ndarray, weights: np.ndarray):
+        n_threads = self._n_threads
+        if n_threads is None:
+            self._add_serial(ma, xs, weights)
+            return
+
+        with NumbaThreads(n_threads):
+            if numba.get_num_threads() == 1:
+                self._add_serial(ma, xs, weights)
+            else:
+                self._add_parallel(ma.data, ma.shape_fn, xs, weights,
+                                   _new_sort_args(len(xs)))
+
+    @staticmethod
+    @numba.njit(nogil=True)
+    def _add_serial(ma: _Linear, xs: np.ndarray, weights: np.ndarray = None):
+        '''
+        Call ma.add() with the GIL released, e.g., to overlap with the I/O in 
+        add_from_h5().
+        '''
+        ma.add(xs, weights)
+
+    @staticmethod
+    @numba.njit(nogil=True)
+    def _add_sph(data: np.ndarray, shape_fn: _LinearShapeFn,
+                 xs: np.ndarray, hs: np.ndarray, weights: np.ndarray):
+        for i in range(len(xs)):
+            if weights is None:
+                weight = 1.0
+            else:
+                weight = weights[i]
+            _add_1_by_sph(data, shape_fn, xs[i], hs[i], weight)
+
+    @staticmethod
+    @numba.njit(parallel=True, nogil=True)
+    def _add_sph_parallel(data: np.ndarray, shape_fn: _LinearShapeFn,
+                          xs: np.ndarray, hs: np.ndarray,
+                          weights: np.ndarray, args: np.ndarray,
+                          n_slabs: int):
+        '''
+        Slab-parallel version of _add_sph(), with a bit-identical result.
+
+        The grid is split into `n_slabs` slabs of x0-planes, each filled by 
+        a thread, with the points reaching it in their input order. 
+
+        @args: buffer for the sort, see _new_sort_args().
+        '''
+        n, n_xs = shape_fn.mesh.n_grids, len(xs)
+
+        # The normalization, and the range of x0-planes, of each point.
+        l_grid, n_sup = shape_fn.mesh.l_grid, shape_fn.n_support
+        w_scales = np.empty(n_xs, dtype=np.float64)
+        i0s = np.empty(n_xs, dtype=np.int32)
+        n_planes = np.empty(n_xs, dtype=np.int32)
+        for i in numba.prange(n_xs):
+            if weights is None:
+                weight = 1.0
+            else:
+                weight = weights[i]
+            w_scale = _sph_scale(shape_fn, xs[i], hs[i], weight)
+            w_scales[i] = w_scale
+            if np.isnan(w_scale):
+                lb = shape_fn.stencil_at(xs[i, 0])[0]
+                ub = lb + n_sup
             else:
-                data = out['data']
-                data += in_group.datasets['data']
-        out_group.dump(out, flag=flag)
+                lb, ub = _sph_bounds(xs[i, 0], hs[i], l_grid)
+            i0s[i] = lb % n
+            n_planes[i] = min(ub - lb, n)
 
+        # Bucket by the first plane, with the widest range of each bucket.
+        firsts = _sort_by_plane(i0s, n, args, n_slabs)
+        max_planes = np.zeros(n, dtype=np.int64)
+        for p in numba.prange(n):
+            for a in range(firsts[p], firsts[p + 1]):
+                max_planes[p] = max(max_planes[p], n_planes[args[a]])
+
+        for c in numba.prange(n_slabs):
+            b, e = c * n // n_slabs, (c + 1) * n // n_slabs
+            if b == e:
+                continue
+            n_ids = 0
+            for p in range(n):
+                if _planes_meet(p, max_planes[p], b, e, n):
+                    n_ids += firsts[p + 1] - firsts[p]
+            ids = np.empty(n_ids, dtype=args.dtype)
+            n_ids = 0
+            for p in range(n):
+                if not _planes_meet(p, max_planes[p], b, e, n):
+                    continue
+                for a in range(firsts[p], firsts[p + 1]):
+                    i = args[a]
+                    if _planes_meet(p, n_planes[i], b, e, n):
+                        ids[n_ids] = i
+                        n_ids += 1
+            ids = np.sort(ids[:n_ids])
+            for i in ids:
+                w_scale = w_scales[i]
+                if np.isnan(w_scale):
+                    if weights is None:
+                        weight = 1.0
+                    else:
+                        weight = weights[i]
+                    _add_1_by_stencil_in(data, shape_fn, xs[i], weight, b, e)
+                else:
+                    _add_1_by_sph_in(data, shape_fn, xs[i], hs[i], w_scale,
+                                     b, e)
 
     @staticmethod
-    def load(group: h5.Group):
-        data, l_box, n_grids = group.datasets['data', 'l_box', 'n_grids']
-        return Field.new_by_data(data, Mesh.new(n_grids, l_box))
\ No newline at end of file
+    @numba.njit(parallel=True, nogil=True)
+    def _add_parallel(data: np.ndarray, shape_fn: _LinearShapeFn,
+                      xs: np.ndarray, weights: np.ndarray, args: np.ndarray):
+        '''
+        Slab-parallel version of, e.g., _Linear.add(). 
+        
+        Particles are stably sorted by their first x0-plane in the stencil. 
+        Each x0-plane p is then filled by a single thread, which merges the 
+        particles touching it (i.e., those with first plane p - j, for j in 
+        range(n_support)) in their input order. Hence, every cell receives 
+        exactly the same sequence of additions as in the serial loop.
+
+        @args: buffer for the sort, see _new_sort_args().
+        '''
+        n = shape_fn.mesh.n_grids
+        n_sup = shape_fn.n_support
+        n_xs = len(xs)
+        firsts = _sort_by_first_plane(shape_fn, xs, args,
+                                      numba.get_num_threads())
+
+        for p in numba.prange(n):
+            bs = np.empty(n_sup, dtype=np.int64)
+            es = np.empty(n_sup, dtype=np.int64)
+            for j in range(n_sup):
+                q = (p - j) % n
+                bs[j], es[j] = firsts[q], firsts[q + 1]
+            while True:
+                # Pick the earliest particle. On a tie (only if n < n_sup), 
+                # the smaller offset j goes first, as in the serial loop.
+                j_min, i = -1, n_xs
+                for j in range(n_sup):
+                    if bs[j] < es[j] and args[bs[j]] < i:
+                        j_min, i = j, args[bs[j]]
+                if j_min < 0:
+                    break
+                bs[j_min] += 1
+
+                if weights is None:
+                    weight = 1.0
+                else:
+                    weight = weights[i]
+                w0 = shape_fn.stencil_at(xs[i, 0])[1][j_min]
+                i1, ws1 = shape_fn.stencil_at(xs[i, 1])
+                i2, ws2 = shape_fn.stencil_at(xs[i, 2])
+                for j1 in range(len(ws1)):
+                    k1 = (i1 + j1) % n
+                    for j2 in range(len(ws2)):
+                        k2 = (i2 + j2) % n
+                        data[p, k1, k2] += w0 * ws1[j1] * ws2[j2] * weight
+
+    @staticmethod
+    def load(group: h5.Group, shifted=False, mmap=False):
+        '''
+        @shifted: if True, load the grid shifted by half a cell (dumped by an
+            interlaced DensityField).
+        @mmap: if True, memory-map the grid (copy-on-write) instead of 
+            reading it, if possible. See h5.Dataset.load().
+        '''
+        key = 'data_shifted' if shifted else 'data'
+        l_box, n_grids = group.datasets['l_box', 'n_grids']
+        data = group[key].load(mmap='c' if mmap else False)
+        return Field.new_by_data(data, Mesh.new(n_grids, l_box))
+
+
+class MultiDensityField(abc.HasLog):
+
+    def __init__(self, l_box: float, n_grids: int, n_quantities: int,
+                 n_threads: int = None, scheme: str = 'cic',
+                 interlace: bool = False, dtype=np.float64) -> None:
+        '''
+        K = `n_quantities` fields deposited from the same points in a single 
+        sweep, e.g., mass and momentum (K = 4) for a velocity field. The 
+        stencil of each point is found only once and applied to the K 
+        weights.
+        
+        Each field is identical to that filled by a DensityField with the 
+        same arguments, using the corresponding column of weights. See 
+        DensityField for other arguments.
+        '''
+        if scheme not in _schemes:
+            raise ValueError(f'Unknown scheme {scheme}.')
+        n_quantities = int(n_quantities)
+        assert n_quantities > 0
+        dtype = np.dtype(dtype)
+        _field_impl_of(dtype)
+
+        mesh = _Mesh(n_grids, l_box)
+        shape = (n_quantities, n_grids, n_grids, n_grids)
+        data = np.zeros(shape, dtype=dtype)
+        data_shifted = np.zeros_like(data) if interlace else None
+
+        self._shape_fn = _schemes[scheme][0](mesh)
+        self._data = data
+        self._data_shifted = data_shifted
+        self._n_threads = n_threads
+        self._scheme = scheme
+
+    def add(self, xs: np.ndarray, weights: np.ndarray):
+        '''
+        @xs: positions, shape (N, 3).
+        @weights: shape (N, K), column q for the q-th field.
+        '''
+        assert xs.ndim == 2 and xs.shape[1] == 3
+        assert weights.shape == (len(xs), self.n_quantities)
+
+        self.__add(self._data, xs, weights)
+
+        data = self._data_shifted
+        if data is not None:
+            xs = xs - 0.5 * self._shape_fn.mesh.l_grid
+            self.__add(data, xs, weights)
+
+    def dump(self, group: h5.Group, flag='x'):
+        '''
+        The dumps can be summed by DensityField.join_dumps().
+        '''
+        mesh = self._shape_fn.mesh
+        out = {
+            'data': self._data,
+            'l_box': mesh.l_box,
+            'n_grids': mesh.n_grids,
+        }
+        if self.interlaced:
+            out['data_shifted'] = self._data_shifted
+        group.dump(out, flag=flag)
+
+    @property
+    def data(self):
+        '''
+        Shape (K, n_grids, n_grids, n_grids).
+        '''
+        return self._data
+
+    @property
+    def data_shifted(self):
+        '''
+        Grids shifted by half a cell. None if not interlaced.
+        '''
+        return self._data_shifted
+
+    @property
+    def fields(self) -> list[Field]:
+        '''
+        The K fields, referring to `data`.
+        '''
+        mesh = Mesh(self._shape_fn.mesh)
+        return [Field.new_by_data(d, mesh) for d in self._data]
+
+    @property
+    def fields_shifted(self) -> list[Field] | None:
+        data = self._data_shifted
+        if data is None:
+            return None
+        mesh = Mesh(self._shape_fn.mesh)
+        return [Field.new_by_data(d, mesh) for d in data]
+
+    @property
+    def n_quantities(self) -> int:
+        return self._data.shape[0]
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._data.dtype
+
+    @property
+    def interlaced(self) -> bool:
+        return self._data_shifted is not None
+
+    @property
+    def scheme(self) -> str:
+        return self._scheme
+
+    def __add(self, data: np.ndarray, xs: np.ndarray, weights: np.ndarray):
+        n_threads = self._n_threads
+        if n_threads is None:
+            self._add_serial(data, self._shape_fn, xs, weights)
+            return
+
+        with NumbaThreads(n_threads):
+            if numba.get_num_threads() == 1:
+                self._add_serial(data, self._shape_fn, xs, weights)
+            else:
+                self._add_parallel(data, self._shape_fn, xs, weights,
+                                   _new_sort_args(len(xs)))
+
+    @staticmethod
+    @numba.njit(nogil=True)
+    def _add_serial(data: np.ndarray, shape_fn: _LinearShapeFn,
+                    xs: np.ndarray, weights: np.ndarray):
+        n, n_q = shape_fn.mesh.n_grids, data.shape[0]
+        for i in range(len(xs)):
+            i0, ws0 = shape_fn.stencil_at(xs[i, 0])
+            i1, ws1 = shape_fn.stencil_at(xs[i, 1])
+            i2, ws2 = shape_fn.stencil_at(xs[i, 2])
+            for j0 in range(len(ws0)):
+                k0 = (i0 + j0) % n
+                for j1 in range(len(ws1)):
+                    k1 = (i1 + j1) % n
+                    for j2 in range(len(ws2)):
+                        k2 = (i2 + j2) % n
+                        w = ws0[j0] * ws1[j1] * ws2[j2]
+                        for q in range(n_q):
+                            data[q, k0, k1, k2] += w * weights[i, q]
+
+    @staticmethod
+    @numba.njit(parallel=True, nogil=True)
+    def _add_parallel(data: np.ndarray, shape_fn: _LinearShapeFn,
+                      xs: np.ndarray, weights: np.ndarray, args: np.ndarray):
+        '''
+        Slab-parallel version of _add_serial(). See 
+        DensityField._add_parallel().
+        '''
+        n, n_q = shape_fn.mesh.n_grids, data.shape[0]
+        n_sup = shape_fn.n_support
+        n_xs = len(xs)
+        firsts = _sort_by_first_plane(shape_fn, xs, args,
+                                      numba.get_num_threads())
+
+        for p in numba.prange(n):
+            bs = np.empty(n_sup, dtype=np.int64)
+            es = np.empty(n_sup, dtype=np.int64)
+            for j in range(n_sup):
+                q = (p - j) % n
+                bs[j], es[j] = firsts[q], firsts[q + 1]
+            while True:
+                j_min, i = -1, n_xs
+                for j in range(n_sup):
+                    if bs[j] < es[j] and args[bs[j]] < i:
+                        j_min, i = j, args[bs[j]]
+                if j_min < 0:
+                    break
+                bs[j_min] += 1
+
+                w0 = shape_fn.stencil_at(xs[i, 0])[1][j_min]
+                i1, ws1 = shape_fn.stencil_at(xs[i, 1])
+                i2, ws2 = shape_fn.stencil_at(xs[i, 2])
+                for j1 in range(len(ws1)):
+                    k1 = (i1 + j1) % n
+                    for j2 in range(len(ws2)):
+                        k2 = (i2 + j2) % n
+                        w = w0 * ws1[j1] * ws2[j2]
+                        for q in range(n_q):
+                            data[q, p, k1, k2] += w * weights[i, q]
+
+    @staticmethod
+    def load(group: h5.Group, shifted=False, mmap=False) -> list[Field]:
+        '''
+        Load the K fields. See DensityField.load().
+        '''
+        key = 'data_shifted' if shifted else 'data'
+        l_box, n_grids = group.datasets['l_box', 'n_grids']
+        data = group[key].load(mmap='c' if mmap else False)
+        mesh = Mesh.new(n_grids, l_box)
+        return [Field.new_by_data(d, mesh) for d in data]
+
+
+def _join_dumps_slab(srcs: list[tuple[str, str]], key: str, b: int, e: int):
+    '''
+    Sum dataset[b:e] over the source groups, given as (file name, group 
+    name) pairs, by pairwise reduction. See DensityField.join_dumps().
+    '''
+    stack = []
+    for file_name, name in srcs:
+        with h5.File(file_name) as f:
+            slab = f[name][key][b:e]
+        level = 0
+        while len(stack) > 0 and stack[-1][0] == level:
+            _, slab_prev = stack.pop()
+            slab_prev += slab
+            slab = slab_prev
+            level += 1
+        stack.append((level, slab))
+    _, out = stack.pop()
+    while len(stack) > 0:
+        _, slab_prev = stack.pop()
+        slab_prev += out
+        out = slab_prev
+    return out
+
+
+@numba.njit
+def _interlace_k(data_k: np.ndarray, data_shifted_k: np.ndarray):
+    '''
+    Combine, in place into `data_k`, the real-to-complex transforms of a grid 
+    and its copy shifted by half a cell (see DensityField(interlace=True)),
+    so that the leading aliasing images of the two cancel.
+    '''
+    N = data_k.shape[0]
+    Nd2 = N // 2
+    Nd2p1 = Nd2 + 1
+    assert data_k.shape == (N, N, Nd2p1)
+    assert data_shifted_k.shape == data_k.shape
+
+    for i0 in range(N):
+        k0 = i0 - N if i0 > Nd2 else i0
+        for i1 in range(N):
+            k1 = i1 - N if i1 > Nd2 else i1
+            for i2 in range(Nd2p1):
+                a = np.pi * (k0 + k1 + i2) / N
+                phase = np.cos(a) - 1.0j * np.sin(a)
+                data_k[i0, i1, i2] = 0.5 * (
+                    data_k[i0, i1, i2] + data_shifted_k[i0, i1, i2] * phase)
\ No newline at end of file
@@ -0,0 +1,322 @@
+'''
+Binned auto- and cross-power spectra of fields in a periodic cubic box.
+'''
+
+from __future__ import annotations
+import typing
+from functools import lru_cache
+from typing import Self, Iterable
+from pyhipp.core.dataproc.parallel import NumbaThreads
+from pyhipp.io import h5
+from .field import Field
+from .fft import NdRealFFT
+from .mass_assignment import _interlace_k
+from .kernels import _KSpaceKernel, _kernel_of
+from .smoothing import FourierSpaceSmoothing
+import numpy as np
+import numba
+from dataclasses import dataclass
+
+
+class PowerSpectrumEstimator:
+
+    @dataclass
+    class Result:
+        '''
+        @k_edges, mu_edges: edges of the bins. mu_edges is None if not
+            binned in mu.
+        @k, mu: mean |k| and mean |mu| of the modes in each bin.
+        @n_modes: number of modes (over the full k-space) in each bin.
+        @P: power spectrum in each bin, with shot noise subtracted. NaN for
+            an empty bin.
+
+        k, mu, n_modes and P have shape (n_k,), or (n_k, n_mu) if binned in
+        mu.
+        '''
+        l_box: float
+        n_grids: int
+        k_edges: np.ndarray
+        mu_edges: np.ndarray
+        k: np.ndarray
+        mu: np.ndarray
+        n_modes: np.ndarray
+        P: np.ndarray
+        shot_noise: float
+
+        def dump(self, group: h5.Group, flag='x'):
+            '''
+            Members that are None are not dumped.
+            '''
+            out = {
+                'l_box': self.l_box,
+                'n_grids': self.n_grids,
+                'k_edges': self.k_edges,
+                'mu_edges': self.mu_edges,
+                'k': self.k,
+                'mu': self.mu,
+                'n_modes': self.n_modes,
+                'P': self.P,
+                'shot_noise': self.shot_noise,
+            }
+            out = {k: v for k, v in out.items() if v is not None}
+            group.dump(out, flag=flag)
+
+    def __init__(self, n_workers=None, k_edges: Iterable[float] = None,
+                 n_mu_bins: int = None, los: int = 2,
+                 correct_shape='cic', as_density=True) -> None:
+        '''
+        @k_edges: edges of the |k| bins, in the unit of 1 / l_box (i.e.,
+            k = 2 pi / wavelength). None for bins of width k_f = 2 pi /
+            l_box, centered at k_f, 2 k_f, ..., up to the Nyquist
+            frequency.
+        @n_mu_bins: if not None, also bin in |mu| = |k_los| / |k|, with
+            `n_mu_bins` bins evenly spaced in [0, 1].
+        @los: axis of the line of sight, 0 | 1 | 2.
+        @correct_shape: mass-assignment scheme of the input fields, 'ngp'
+            | 'cic' | 'tsc' | 'pcs', to deconvolve. None or False for no
+            correction.
+        @as_density: if True, the input fields are densities (e.g., by
+            DensityField, arbitrarily normalized) and are converted into
+            overdensities. Otherwise, they are used as is.
+
+        The index grid of the bins is built on the first run with a mesh,
+        and cached thereafter, so that repeated runs (e.g., over snapshots
+        or mocks) take little more than the FFTs.
+        '''
+        if k_edges is not None:
+            k_edges = np.array(k_edges, dtype=np.float64)
+            assert k_edges.ndim == 1 and len(k_edges) >= 2
+            assert (np.diff(k_edges) > 0.).all()
+        if n_mu_bins is not None:
+            n_mu_bins = int(n_mu_bins)
+            assert n_mu_bins > 0
+        assert los in (0, 1, 2)
+        assert correct_shape in (None, False, 'ngp', 'cic', 'tsc', 'pcs')
+
+        self._n_workers = n_workers
+        self._k_edges = k_edges
+        self._n_mu_bins = n_mu_bins
+        self._los = los
+        self._correct_shape = correct_shape
+        self._as_density = as_density
+
+    def run(self, field: Field, field2: Field = None,
+            field_shifted: Field = None, field2_shifted: Field = None,
+            shot_noise: float = 0.0) -> Result:
+        '''
+        Find the auto-power spectrum of `field`, or the cross-power
+        spectrum of `field` and `field2` if the latter is provided.
+
+        @field_shifted, field2_shifted: optional, the fields on the grid
+            shifted by half a cell, e.g.,
+            DensityField(interlace=True).field_shifted, to interlace with.
+        @shot_noise: subtracted from the power spectrum, e.g.,
+            l_box**3 / n_particles for the auto-power spectrum of a
+            density field of n_particles unweighted particles.
+        '''
+        mesh = field.mesh._impl
+        N, l_box = mesh.n_grids, mesh.l_box
+        a_k = self._transform(field, field_shifted)
+        b_k = a_k
+        if field2 is not None:
+            assert field2.mesh.n_grids == N and field2.mesh.l_box == l_box
+            b_k = self._transform(field2, field2_shifted)
+        K = _kernel_of(N, l_box, correct_shape=self._correct_shape)
+
+        k_edges = self._k_edges_of(N, l_box)
+        mu_edges = self._mu_edges
+        bins = _bins_of(N, l_box, tuple(k_edges),
+                        None if mu_edges is None else tuple(mu_edges),
+                        self._los)
+        with NumbaThreads(self.__n_threads):
+            sums = _bin_cross_power(a_k, b_k, K, bins.index, bins.n_bins)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            P = sums * mesh.cell_volume / bins.n_modes - shot_noise
+        shape = bins.shape
+        mu = None if mu_edges is None else bins.mu.reshape(shape)
+        return self.Result(l_box=l_box, n_grids=N, k_edges=k_edges,
+                           mu_edges=mu_edges, k=bins.k.reshape(shape), mu=mu,
+                           n_modes=bins.n_modes.reshape(shape),
+                           P=P.reshape(shape), shot_noise=shot_noise)
+
+    def _transform(self, field: Field, field_shifted: Field | None):
+        '''
+        Return the transform of the (over)density, normalized by 'ortho'.
+        '''
+        fft = NdRealFFT(n_workers=self._n_workers, norm='ortho',
+                        overwrite_input=self._as_density)
+        data_k = fft.forward(self._overdensity(field))
+        if field_shifted is not None:
+            _interlace_k(data_k, fft.forward(self._overdensity(field_shifted)))
+        return data_k
+
+    def _overdensity(self, field: Field) -> np.ndarray:
+        if self._as_density:
+            return FourierSpaceSmoothing._normalize(field.data)
+        return field.data
+
+    def _k_edges_of(self, n_grids: int, l_box: float) -> np.ndarray:
+        k_edges = self._k_edges
+        if k_edges is None:
+            k_f = 2.0 * np.pi / l_box
+            k_edges = (np.arange(n_grids // 2 + 1) + 0.5) * k_f
+        return k_edges
+
+    @property
+    def _mu_edges(self) -> np.ndarray | None:
+        n = self._n_mu_bins
+        return None if n is None else np.linspace(0., 1., n + 1)
+
+    @property
+    def __n_threads(self):
+        n_workers = self._n_workers
+        if n_workers is not None and n_workers > 0:
+            return n_workers
+        return None
+
+
+@dataclass
+class _Bins:
+    '''
+    @index: bin index of each grid point of a real-to-complex transform,
+        i_k * n_mu + i_mu, or -1 if not in any bin (including k = 0).
+    @shape: (n_k,) or (n_k, n_mu).
+    @n_modes, k, mu: flattened, of size n_bins.
+    '''
+    index: np.ndarray
+    shape: tuple[int, ...]
+    n_modes: np.ndarray
+    k: np.ndarray
+    mu: np.ndarray
+
+    @property
+    def n_bins(self) -> int:
+        return len(self.n_modes)
+
+
+@lru_cache(maxsize=16)
+def _bins_of(n_grids: int, l_box: float, k_edges: tuple[float, ...],
+             mu_edges: tuple[float, ...] | None, los: int) -> _Bins:
+    '''
+    Return the bins, built on the first call with the same arguments and
+    cached thereafter. Clear the cache by _bins_of.cache_clear().
+    '''
+    k_edges = np.array(k_edges)
+    n_k = len(k_edges) - 1
+    if mu_edges is None:
+        mu_edges, shape = np.array([0., 1.]), (n_k,)
+    else:
+        mu_edges = np.array(mu_edges)
+        shape = (n_k, len(mu_edges) - 1)
+    index = _bin_index(n_grids, l_box, k_edges, mu_edges, los)
+    n_bins = n_k * (len(mu_edges) - 1)
+    n_modes, k_sum, mu_sum = _bin_modes(index, n_bins, l_box, los)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        k, mu = k_sum / n_modes, mu_sum / n_modes
+    return _Bins(index=index, shape=shape, n_modes=n_modes, k=k, mu=mu)
+
+
+@numba.njit
+def _ki_of(i: int, n_grids: int) -> int:
+    i = np.int64(i)
+    return i - n_grids if i > n_grids // 2 else i
+
+
+@numba.njit
+def _mode_weight(i2: int, n_grids: int) -> float:
+    '''
+    Number of modes in the full k-space represented by a grid point of
+    the real-to-complex transform, i.e., 1 for the plane i2 = 0 or the
+    Nyquist plane, 2 otherwise (for the point and its conjugate).
+    '''
+    if i2 == 0 or (n_grids % 2 == 0 and i2 == n_grids // 2):
+        return 1.0
+    return 2.0
+
+
+@numba.njit(parallel=True)
+def _bin_index(n_grids: int, l_box: float, k_edges: np.ndarray,
+               mu_edges: np.ndarray, los: int):
+    N = n_grids
+    Nd2p1 = N // 2 + 1
+    n_k, n_mu = len(k_edges) - 1, len(mu_edges) - 1
+    k_f = 2.0 * np.pi / l_box
+    index = np.empty((N, N, Nd2p1), dtype=np.int32)
+    for i0 in numba.prange(N):
+        ki = np.empty(3, dtype=np.float64)
+        ki[0] = _ki_of(i0, N)
+        for i1 in range(N):
+            ki[1] = _ki_of(i1, N)
+            for i2 in range(Nd2p1):
+                ki[2] = i2
+                ki_sq = np.sum(ki * ki)
+                index[i0, i1, i2] = -1
+                if ki_sq == 0.:
+                    continue
+                ki_norm = np.sqrt(ki_sq)
+                i_k = np.searchsorted(k_edges, ki_norm * k_f,
+                                      side='right') - 1
+                if i_k < 0 or i_k >= n_k:
+                    continue
+                mu = abs(ki[los]) / ki_norm
+                i_mu = min(np.searchsorted(mu_edges, mu, side='right') - 1,
+                           n_mu - 1)
+                index[i0, i1, i2] = i_k * n_mu + i_mu
+    return index
+
+
+@numba.njit(parallel=True)
+def _bin_modes(index: np.ndarray, n_bins: int, l_box: float, los: int):
+    '''
+    Return the number of modes, sum of |k| and sum of |mu| in each bin.
+    '''
+    N = index.shape[0]
+    Nd2p1 = index.shape[2]
+    k_f = 2.0 * np.pi / l_box
+    n_chunks = min(numba.get_num_threads(), N)
+    out = np.zeros((n_chunks, 3, n_bins), dtype=np.float64)
+    for c in numba.prange(n_chunks):
+        ki = np.empty(3, dtype=np.float64)
+        for i0 in range(c * N // n_chunks, (c + 1) * N // n_chunks):
+            ki[0] = _ki_of(i0, N)
+            for i1 in range(N):
+                ki[1] = _ki_of(i1, N)
+                for i2 in range(Nd2p1):
+                    b = index[i0, i1, i2]
+                    if b < 0:
+                        continue
+                    ki[2] = i2
+                    ki_norm = np.sqrt(np.sum(ki * ki))
+                    w = _mode_weight(i2, N)
+                    out[c, 0, b] += w
+                    out[c, 1, b] += w * ki_norm * k_f
+                    out[c, 2, b] += w * abs(ki[los]) / ki_norm
+    out = out.sum(axis=0)
+    return out[0], out[1], out[2]
+
+
+@numba.njit(parallel=True)
+def _bin_cross_power(a_k: np.ndarray, b_k: np.ndarray, K: _KSpaceKernel,
+                     index: np.ndarray, n_bins: int):
+    '''
+    Return the sum, over the modes in each bin, of Re(a_k b_k^*) K^2.
+    Each thread accumulates into its own row of partial sums.
+    '''
+    N = index.shape[0]
+    Nd2p1 = index.shape[2]
+    assert a_k.shape == index.shape and b_k.shape == index.shape
+    n_chunks = min(numba.get_num_threads(), N)
+    out = np.zeros((n_chunks, n_bins), dtype=np.float64)
+    for c in numba.prange(n_chunks):
+        for i0 in range(c * N // n_chunks, (c + 1) * N // n_chunks):
+            for i1 in range(N):
+                for i2 in range(Nd2p1):
+                    b = index[i0, i1, i2]
+                    if b < 0:
+                        continue
+                    a, bb = a_k[i0, i1, i2], b_k[i0, i1, i2]
+                    p = a.real * bb.real + a.imag * bb.imag
+                    w = K.at(i0, i1, i2)
+                    out[c, b] += _mode_weight(i2, N) * p * (w * w)
+    return out.sum(axis=0)
@@ -1,127 +1,230 @@
 from __future__ import annotations
 import typing
-from typing import Self
-from numba.experimental import jitclass
-from .mesh import _Mesh
-from .field import _Field, _Mesh, Field
+from typing import Self, Iterable
+from pyhipp.core.dataproc.parallel import NumbaThreads
+from .mesh import _Mesh, Mesh
+from .field import Field
 from .fft import NdRealFFT
-from .mass_assignment import _LinearShapeFn
+from .mass_assignment import _interlace_k
+from .kernels import _Gaussian, _Tophat, _KSpaceKernel, _kernel_of
+from .cosmic_web import FieldInterpolator
+from .dump_policy import DumpPolicy
 import numpy as np
 import numba
 from pyhipp.io import h5
 from dataclasses import dataclass, fields
 
 
-@jitclass
-class _Gaussian:
+@dataclass
+class MultiScaleResult:
+    '''
+    Result of run_many() of the smoothing stages.
+    
+    @smoothed: smoothed field at each scale, or None if written into a 
+        group.
+    @values: values of the smoothed fields sampled at the given positions, 
+        shape (n_scales, n), or None if no position is given.
+    '''
+    l_box: float
+    n_grids: int
+    r_sms: np.ndarray
+    methods: list[str]
+    smoothed: list[np.ndarray] | None
+    values: np.ndarray | None
+
+    def dump(self, group: h5.Group, flag='x'):
+        out = {
+            'l_box': self.l_box,
+            'n_grids': self.n_grids,
+            'r_sms': self.r_sms,
+            'methods': np.array(self.methods, dtype='S'),
+        }
+        if self.smoothed is not None:
+            out['smoothed'] = np.stack(self.smoothed)
+        if self.values is not None:
+            out['values'] = self.values
+        group.dump(out, flag=flag)
+
+
+def _run_many(stage: FFTSmoothing, data_k: np.ndarray, mesh: _Mesh, dtype,
+              r_sms: Iterable[float], methods: str | Iterable[str],
+              xs: np.ndarray, out: h5.Group, flag):
+    '''
+    Implementation of run_many() of the smoothing stages, given the 
+    transform `data_k` of the field to smooth.
+    '''
+    r_sms = np.array(r_sms, dtype=np.float64)
+    n_scales = len(r_sms)
+    assert r_sms.ndim == 1
+    if methods is None:
+        methods = stage._method
+    if isinstance(methods, str):
+        methods = [methods] * n_scales
+    methods = list(methods)
+    assert len(methods) == n_scales
+    Ks = [stage._kernel(mesh, r_sm, method)
+          for r_sm, method in zip(r_sms, methods)]
+
+    values = None
+    if xs is not None:
+        assert xs.ndim == 2 and xs.shape[1] == 3
+        values = np.empty((n_scales, len(xs)), dtype=dtype)
+
+    N = mesh.n_grids
+    smoothed, dset = [], None
+    if out is not None:
+        smoothed = None
+        dset = out.datasets.create_empty(
+            'smoothed', (n_scales, N, N, N), dtype, flag=flag)
+
+    fft = NdRealFFT(shape=(N, N, N), n_workers=stage._n_workers,
+                    norm='ortho', overwrite_input=True, dtype=dtype)
+    m = Mesh(mesh)
+    data_sm_k = np.empty_like(data_k)
+    for i, K in enumerate(Ks):
+        with NumbaThreads(stage._n_threads):
+            stage._smooth(data_k, K, data_sm_k)
+        data_sm = fft.backward(data_sm_k)
+        if values is not None:
+            interp = FieldInterpolator(Field.new_by_data(data_sm, m))
+            values[i] = interp.value_at(xs)
+        if dset is not None:
+            dset[i] = data_sm
+        else:
+            smoothed.append(data_sm)
+        del data_sm
+
+    res = MultiScaleResult(l_box=mesh.l_box, n_grids=N, r_sms=r_sms,
+                           methods=methods, smoothed=smoothed, values=values)
+    if out is not None:
+        res.dump(out, flag=flag)
+    return res
+
+
+def _slab_normalizer(rho_x: np.ndarray, n_slab: int = None):
+    '''
+    Return `map_x` for NdRealFFT.forward_slabs(), which converts slabs of 
+    the density `rho_x` into the overdensity. The mean is found slab by 
+    slab, in double precision.
+    '''
+    N = rho_x.shape[0]
+    plane_size = N * N * rho_x.dtype.itemsize
+    rho_mean = 0.0
+    for b, e in NdRealFFT._slabs(N, plane_size, n_slab):
+        rho_mean += np.sum(rho_x[b:e], dtype=np.float64)
+    rho_mean /= N**3
+    if rho_mean < 1.0e-10:
+        raise ValueError(f'Mean density {rho_mean} is too low.')
+
+    def map_x(x: np.ndarray, b: int, e: int):
+        x /= rho_mean
+        x -= 1.0
+        return x
+    return map_x
 
-    r: float
-    mesh: _Mesh
-    scale: float
 
-    def __init__(self, r: float, mesh: _Mesh) -> None:
+class FFTSmoothing:
+    
+    def __init__(self, n_workers=None, r_sm=1.0, method='gaussian',
+                 correct_shape=None) -> None:
         '''
-        N-dimension Gaussian smoothing.
+        @r_sm: smooth length.
+        @correct_shape: mass-assignment scheme to deconvolve, 'ngp' | 'cic' 
+            | 'tsc' | 'pcs'. None (default) for no correction.
         '''
+        self._n_workers = n_workers
+        self._r_sm = r_sm
+        self._method = method
+        self._correct_shape = correct_shape
 
-        l_box = mesh.l_box
-        scale = -0.5 * (2.0 * np.pi * r / l_box)**2
-
-        self.r = r
-        self.mesh = mesh
-        self.scale = scale
-
-    def window_at_ki(self, ki: np.ndarray):
+    def run(self, field: Field, field_shifted: Field = None):
         '''
-        @ki: wave vector, e.g., (i, j, k) in 3D, where i, j, k are 
-            integer indices of the grid points in fourier space.
+        @field_shifted: optional, the same field sampled on the grid shifted 
+            by half a cell, e.g., DensityField(interlace=True).field_shifted. 
+            If provided, the two are interlaced in Fourier space.
         '''
-        scale = self.scale
-        ki_sq = np.sum(ki*ki)
-        return np.exp(scale * ki_sq)
-
-    def volume(self):
-        return (2 * np.pi * self.r**2)**(3.0/2.0)
-
-
-@jitclass
-class _Tophat:
+        data, mesh = field.data, field.mesh._impl
+        fft = NdRealFFT(shape=data.shape, n_workers=self._n_workers,
+                        norm='ortho')
+        K = self._kernel(mesh)
 
-    r: float
-    mesh: _Mesh
-    scale: float
+        data_k = fft.forward(data)
+        if field_shifted is not None:
+            _interlace_k(data_k, fft.forward(field_shifted.data))
+        with NumbaThreads(self._n_threads):
+            data_sm_k = self._smooth(data_k, K)
+        data_sm = fft.backward(data_sm_k)
+        return Field.new_by_data(data_sm, mesh=field.mesh)
 
-    def __init__(self, r: float, mesh: _Mesh) -> None:
+    def run_many(self, field: Field, r_sms: Iterable[float],
+                 methods: str | Iterable[str] = None,
+                 field_shifted: Field = None, xs: np.ndarray = None,
+                 out: h5.Group = None, flag='x') -> MultiScaleResult:
         '''
-        N-dimension tophat smoothing.
+        Smooth the field at multiple scales, with a single forward 
+        transform. The smoothed fields are made one at a time.
+        
+        @r_sms: smoothing lengths.
+        @methods: smoothing method for each of `r_sms`, or a single one for 
+            all. None for the `method` of this instance.
+        @xs: optional, positions of shape (n, 3), at which each smoothed 
+            field is sampled (by CIC interpolation).
+        @out: optional. If provided, each smoothed field is written, once 
+            made, into out['smoothed'][i] (the dataset is created with 
+            `flag`), and is not kept in memory. Other members of the result
+            are dumped into `out` finally.
         '''
+        data, mesh = field.data, field.mesh._impl
+        fft = NdRealFFT(n_workers=self._n_workers, norm='ortho')
+        data_k = fft.forward(data)
+        if field_shifted is not None:
+            _interlace_k(data_k, fft.forward(field_shifted.data))
+        return _run_many(self, data_k, mesh, data.dtype, r_sms, methods, xs,
+                         out, flag)
 
-        l_box = mesh.l_box
-        scale = 2.0*np.pi*r / l_box
-
-        self.r = r
-        self.mesh = mesh
-        self.scale = scale
-
-    def window_at_ki(self, ki: np.ndarray):
+    def _kernel(self, mesh: _Mesh, r_sm: float = None,
+                method: str = None) -> _KSpaceKernel:
         '''
-        @ki: wave vector, e.g., (i, j, k) in 3D, where i, j, k are 
-            integer indices of the grid points in fourier space.
+        The smoothing window divided by the shape, cached across runs.
+        
+        @r_sm, method: None for those of this instance.
         '''
-        kr = np.sqrt(np.sum(ki*ki)) * self.scale
-        if kr < 1.0e-6:
-            return 1.0
-
-        return 3.0 * (np.sin(kr) - kr * np.cos(kr)) / kr**3
-
-    def volume(self):
-        return 4.0/3.0 * np.pi * self.r**3
+        r_sm = self._r_sm if r_sm is None else r_sm
+        method = self._method if method is None else method
+        if method not in ('gaussian', 'tophat'):
+            raise ValueError(f'Unknown method {method}.')
+        return _kernel_of(mesh.n_grids, mesh.l_box, method, r_sm,
+                          self._correct_shape)
 
-class FFTSmoothing:
-    
-    def __init__(self, n_workers=None, r_sm=1.0, method='gaussian') -> None:
+    @property
+    def _n_threads(self):
         '''
-        Correction of shape function is NOT made.
-        @r_sm: smooth length.
+        Number of threads of the parallel kernels, None for numba's default.
         '''
-        self._n_workers = n_workers
-        self._r_sm = r_sm
-        self._method = method
-
-    def run(self, field: Field):
-        data, mesh = field.data, field.mesh._impl
-        fft = NdRealFFT(n_workers=self._n_workers, norm='ortho')
-        method = self._method
-        if method == 'gaussian':
-            sm = _Gaussian(self._r_sm, mesh)
-        elif method == 'tophat':
-            sm = _Tophat(self._r_sm, mesh)
-        else:
-            raise ValueError(f'Unknown method {method}.')
-
-        data_k = fft.forward(data)
-        data_sm_k = self._smooth(data_k, sm)
-        data_sm = fft.backward(data_sm_k)
-        return Field.new_by_data(data_sm, mesh=field.mesh)
+        n_workers = self._n_workers
+        if n_workers is not None and n_workers > 0:
+            return n_workers
+        return None
 
     @staticmethod
-    @numba.njit
-    def _smooth(data_k: np.ndarray, sm: _Gaussian):
-        mesh = sm.mesh
-        N = mesh.n_grids
-        Nd2 = N // 2
-        Nd2p1 = Nd2 + 1
-        assert data_k.shape == (N, N, Nd2p1)
+    @numba.njit(parallel=True)
+    def _smooth(data_k: np.ndarray, K: _KSpaceKernel,
+                out: np.ndarray = None, i0_begin: int = 0):
+        '''
+        @out: if not None, filled and returned. May be `data_k` itself.
+        @i0_begin: index of the first k0-plane, if `data_k` is a slab of 
+            k0-planes.
+        '''
+        N = K.n_grids
+        Nd2p1 = N // 2 + 1
+        n0 = data_k.shape[0]
+        assert data_k.shape[1:] == (N, Nd2p1) and i0_begin + n0 <= N
         
-        data_sm_k = np.empty_like(data_k)
-        ki = np.empty(3, dtype=np.float64)
-        for i0 in range(N):
-            ki[0] = np.float64(i0 - N if i0 > Nd2 else i0)
+        data_sm_k = np.empty_like(data_k) if out is None else out
+        for i0 in numba.prange(n0):
             for i1 in range(N):
-                ki[1] = np.float64(i1 - N if i1 > Nd2 else i1)
                 for i2 in range(Nd2p1):
-                    ki[2] = np.float64(i2)
-                    w = sm.window_at_ki(ki)
+                    w = K.at(i0_begin + i0, i1, i2)
                     data_sm_k[i0, i1, i2] = data_k[i0, i1, i2] * w
         return data_sm_k
     
@@ -137,78 +240,144 @@ class FourierSpaceSmoothing:
         delta_sm_k: np.ndarray
         delta_sm_x: np.ndarray
 
-        def dump(self, group: h5.Group, flag='x'):
+        def dump(self, group: h5.Group, flag='x', policy: DumpPolicy = None):
+            '''
+            @policy: which fields to dump and how they are stored. None for 
+                all, as is.
+            '''
             out = {f.name: getattr(self, f.name) for f in fields(self)}
-            group.dump(out, flag=flag)
+            if policy is None:
+                policy = DumpPolicy()
+            policy.dump(group, out, flag=flag)
 
-    def __init__(self, n_workers=None, r_sm=1.0, method='gaussian') -> None:
+    def __init__(self, n_workers=None, r_sm=1.0, method='gaussian',
+                 correct_shape='cic') -> None:
         '''
         @r_sm: smooth length.
+        @correct_shape: mass-assignment scheme of the input density field,
+            'ngp' | 'cic' | 'tsc' | 'pcs', to deconvolve. None or False for 
+            no correction.
         '''
         self._n_workers = n_workers
         self._r_sm = r_sm
         self._method = method
+        self._correct_shape = correct_shape
 
-    def run(self, rho_x: Field):
+    def run(self, rho_x: Field, rho_x_shifted: Field = None):
         '''
         @rho_x: density field obtained by mass_assignment.DensityField, 
-        i.e., assigned with CIC, without shape correction. Can be arbitrarily 
-        normalized.
+        i.e., assigned with the scheme `correct_shape`, without shape 
+        correction. Can be arbitrarily normalized.
+        @rho_x_shifted: optional, the density field on the grid shifted by 
+        half a cell, e.g., DensityField(interlace=True).field_shifted. If 
+        provided, it is interlaced with `rho_x` in Fourier space, and 
+        `delta_k` in the result is the interlaced one.
         '''
 
         rho_x, mesh = rho_x.data, rho_x.mesh._impl
-        fft = NdRealFFT(n_workers=self._n_workers, norm='ortho')
-        method = self._method
-        if method == 'gaussian':
-            sm = _Gaussian(self._r_sm, mesh)
-        elif method == 'tophat':
-            sm = _Tophat(self._r_sm, mesh)
-        else:
-            raise ValueError(f'Unknown method {method}.')
+        fft = NdRealFFT(shape=rho_x.shape, n_workers=self._n_workers,
+                        norm='ortho')
+        K = self._kernel(mesh)
 
         delta_x = self._normalize(rho_x)
         delta_k = fft.forward(delta_x)
-        delta_sm_k = self._smooth(delta_k, sm)
+        if rho_x_shifted is not None:
+            delta_shifted_x = self._normalize(rho_x_shifted.data)
+            _interlace_k(delta_k, fft.forward(delta_shifted_x))
+        with NumbaThreads(self._n_threads):
+            delta_sm_k = self._smooth(delta_k, K)
         delta_sm_x = fft.backward(delta_sm_k)
 
         return self.Result(l_box=mesh.l_box, n_grids=mesh.n_grids,
                            rho_x=rho_x, delta_x=delta_x, delta_k=delta_k,
                            delta_sm_k=delta_sm_k, delta_sm_x=delta_sm_x)
 
+    def run_out_of_core(self, rho_x: Field, out: h5.Group, flag='x',
+                        n_slab: int = None, scratch_dir: str = None,
+                        policy: DumpPolicy = None) -> None:
+        '''
+        Out-of-core counterpart of run(), for a field too large for memory, 
+        e.g., memory-mapped by DensityField.load(group, mmap=True). 
+        
+        Only the smoothed overdensity is made, written slab by slab into 
+        out['delta_sm_x'] (created with `flag`). The transform is held in 
+        a scratch file under `scratch_dir` (None for the system default), 
+        of about the size of the field, and removed finally.
+        
+        @n_slab: see NdRealFFT.forward_slabs().
+        @policy: storage of 'delta_sm_x', see Result.dump(). Its selection 
+            of fields is ignored.
+        '''
+        if policy is None:
+            policy = DumpPolicy()
+        mesh = rho_x.mesh._impl
+        N, dtype = mesh.n_grids, rho_x.dtype
+        fft = NdRealFFT(n_workers=self._n_workers, norm='ortho',
+                        overwrite_input=True)
+        K = self._kernel(mesh)
+
+        map_x = _slab_normalizer(rho_x.data, n_slab)
+        _, delta_k = NdRealFFT.new_scratch_buffer((N, N, N), dtype,
+                                                  scratch_dir)
+        fft.forward_slabs(rho_x.data, delta_k, n_slab, map_x)
+        plane_size = delta_k[0].nbytes
+        with NumbaThreads(self._n_threads):
+            for b, e in NdRealFFT._slabs(N, plane_size, n_slab):
+                self._smooth(delta_k[b:e], K, delta_k[b:e], b)
+
+        out.dump({'l_box': mesh.l_box, 'n_grids': N}, flag=flag)
+        dset = policy.create_dataset(out, 'delta_sm_x', (N, N, N), dtype,
+                                     flag=flag)
+        fft.backward_slabs(delta_k, dset, n_slab)
+
+    def run_many(self, rho_x: Field, r_sms: Iterable[float],
+                 methods: str | Iterable[str] = None,
+                 rho_x_shifted: Field = None, xs: np.ndarray = None,
+                 out: h5.Group = None, flag='x') -> MultiScaleResult:
+        '''
+        Find the overdensity smoothed at multiple scales, with a single 
+        normalization and forward transform. See run() and 
+        FFTSmoothing.run_many().
+        '''
+        mesh = rho_x.mesh._impl
+        fft = NdRealFFT(n_workers=self._n_workers, norm='ortho')
+        delta_x = self._normalize(rho_x.data)
+        dtype = delta_x.dtype
+        delta_k = fft.forward(delta_x)
+        del delta_x
+        if rho_x_shifted is not None:
+            delta_shifted_x = self._normalize(rho_x_shifted.data)
+            _interlace_k(delta_k, fft.forward(delta_shifted_x))
+            del delta_shifted_x
+        return _run_many(self, delta_k, mesh, dtype, r_sms, methods, xs,
+                         out, flag)
+
     @staticmethod
     @numba.njit
     def _normalize(rho_x: np.ndarray):
-        rho_mean = rho_x.mean()
+        '''
+        Return the overdensity with the same dtype as `rho_x`. The mean is 
+        accumulated in double precision.
+        '''
+        n0, n1, n2 = rho_x.shape
+        rho_mean = 0.0
+        for i0 in range(n0):
+            for i1 in range(n1):
+                for i2 in range(n2):
+                    rho_mean += rho_x[i0, i1, i2]
+        rho_mean /= rho_x.size
         if rho_mean < 1.0e-10:
             raise ValueError(f'Mean density {rho_mean} is too low.')
 
-        delta_x = rho_x / rho_mean - 1.0
+        delta_x = np.empty_like(rho_x)
+        for i0 in range(n0):
+            for i1 in range(n1):
+                for i2 in range(n2):
+                    delta_x[i0, i1, i2] = rho_x[i0, i1, i2] / rho_mean - 1.0
         return delta_x
 
-    @staticmethod
-    @numba.njit
-    def _smooth(delta_k: np.ndarray, sm: _Gaussian):
-        mesh = sm.mesh
-        N = mesh.n_grids
-        Nd2 = N // 2
-        Nd2p1 = Nd2 + 1
-        assert delta_k.shape == (N, N, Nd2p1)
-
-        S = _LinearShapeFn(mesh)
-
-        delta_sm_k = np.empty_like(delta_k)
-        ki = np.empty(3, dtype=np.float64)
-        for i0 in range(N):
-            ki[0] = np.float64(i0 - N if i0 > Nd2 else i0)
-            for i1 in range(N):
-                ki[1] = np.float64(i1 - N if i1 > Nd2 else i1)
-                for i2 in range(Nd2p1):
-                    ki[2] = np.float64(i2)
-
-                    w_CIC = 1.0 / S.shape_at_ki_nd(ki)
-                    w_sm = sm.window_at_ki(ki)
-                    w = w_CIC * w_sm
+    _kernel = FFTSmoothing._kernel
 
-                    delta_sm_k[i0, i1, i2] = delta_k[i0, i1, i2] * w
+    _n_threads = FFTSmoothing._n_threads
 
-        return delta_sm_k
+    _smooth = staticmethod(FFTSmoothing._smooth)
@@ -1 +1,2 @@
-from . import kd_tree, kd_mesh
\ No newline at end of file
+from . import kd_tree, kd_mesh
+from .kd_mesh import PeriodicCellIndex
@@ -1,6 +1,10 @@
 from __future__ import annotations
 import typing
 from typing import Self
+from pyhipp.core.abc import HasDictRepr
+from pyhipp.core.dataproc import periodic
+from pyhipp.core.dataproc.parallel import NumbaThreads
+from pyhipp.core.dataproc.periodic import _min_image
 import numpy as np
 from numba.experimental import jitclass
 import numba
@@ -120,3 +124,303 @@ def _PE3_from_meshing_points(mesh: _PE3Mesh, xs: np.ndarray):
         cell_firsts[i_f+1] = e
         b = e
     return _PE3(mesh, args, xs, cell_firsts)
+
+
+class PeriodicCellIndex(HasDictRepr):
+    '''
+    Cell-list index of points in a periodic, cubic box, for batched 
+    neighbor queries.
+    '''
+
+    repr_attr_keys = ('l_box', 'n_grids', 'n_points', 'n_threads')
+
+    def __init__(self, xs: np.ndarray, l_box: float, n_grids: int = None,
+                 n_threads: int = None) -> None:
+        '''
+        @xs: positions, shape (n, 3), must be within [0, l_box). Copied into 
+            the cell order.
+        @n_grids: number of cells per side. None for about 4 points per 
+            cell. Queries are fastest with cells about as large as the 
+            query radius.
+        @n_threads: number of threads of the queries. None for numba's 
+            default.
+        '''
+        super().__init__()
+
+        xs = np.ascontiguousarray(xs, dtype=np.float64)
+        n_xs = len(xs)
+        assert xs.shape == (n_xs, 3)
+        assert periodic.in_bounds(xs, l_box)
+        if n_grids is None:
+            n_grids = max(int(np.cbrt(n_xs / 4.0)), 1)
+        n_grids = int(n_grids)
+        assert n_grids > 0
+
+        mesh = _PE3Mesh(float(l_box), n_grids)
+        self._impl = _PE3_from_meshing_points(mesh, xs)
+        self.n_threads = n_threads
+
+    @property
+    def l_box(self) -> float:
+        return self._impl.mesh.l_box
+
+    @property
+    def n_grids(self) -> int:
+        return self._impl.mesh.n_grids
+
+    @property
+    def n_points(self) -> int:
+        return len(self._impl.inds)
+
+    def query_radius(self, xs: np.ndarray, r: float | np.ndarray,
+                     return_d=False) -> tuple[np.ndarray, ...]:
+        '''
+        Find the indexed points within (<=) a distance `r` of each point in 
+        `xs`, by minimum image.
+
+        @xs: query positions, shape (m, 3), must be within [0, l_box).
+        @r: radius, a scalar or one for each query point, shape (m,).
+
+        Return (offsets, indices), or (offsets, indices, distances) if 
+        `return_d`, in CSR layout, i.e., neighbors of xs[i] are 
+        indices[offsets[i]:offsets[i+1]], which index the points of the 
+        index. offsets has shape (m+1,).
+        '''
+        xs, rs, order = self.__prepare(xs, r)
+        impl = self._impl
+        n_xs = len(xs)
+        offsets = np.zeros(n_xs + 1, dtype=np.int64)
+        with NumbaThreads(self.n_threads):
+            _count_radius(impl, xs, rs, order, offsets[1:])
+            np.cumsum(offsets, out=offsets)
+            n_tot = offsets[-1]
+            indices = np.empty(n_tot, dtype=np.int64)
+            ds = np.empty(n_tot if return_d else 0, dtype=np.float64)
+            _query_radius(impl, xs, rs, order, offsets, return_d, indices,
+                          ds)
+        if return_d:
+            return offsets, indices, ds
+        return offsets, indices
+
+    def count_radius(self, xs: np.ndarray,
+                     r: float | np.ndarray) -> np.ndarray:
+        '''
+        Number of indexed points within (<=) a distance `r` of each point in 
+        `xs`, shape (m,). See query_radius().
+        '''
+        xs, rs, order = self.__prepare(xs, r)
+        counts = np.empty(len(xs), dtype=np.int64)
+        with NumbaThreads(self.n_threads):
+            _count_radius(self._impl, xs, rs, order, counts)
+        return counts
+
+    def query_k(self, xs: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Find the k nearest indexed points of each point in `xs`, shape 
+        (m, 3), by minimum image. 
+        
+        Return (distances, indices), each of shape (m, k), sorted by 
+        distance. Points in the index coinciding with xs are included. If 
+        there are less than k points, the missing ones have distance inf and
+        index n_points.
+
+        Cells are searched in shells of growing Chebyshev radius around the 
+        cell of each query point, until no unvisited cell can be closer than
+        the current k-th neighbor.
+        '''
+        k = int(k)
+        assert k > 0
+        xs, _, order = self.__prepare(xs, 0.)
+        n_xs = len(xs)
+        ds = np.empty((n_xs, k), dtype=np.float64)
+        inds = np.empty((n_xs, k), dtype=np.int64)
+        with NumbaThreads(self.n_threads):
+            _query_k(self._impl, xs, order, ds, inds)
+        return ds, inds
+
+    def __prepare(self, xs: np.ndarray, r: float | np.ndarray):
+        xs = np.ascontiguousarray(xs, dtype=np.float64)
+        n_xs = len(xs)
+        assert xs.shape == (n_xs, 3)
+        assert periodic.in_bounds(xs, self.l_box)
+        rs = np.broadcast_to(np.asarray(r, dtype=np.float64), (n_xs,))
+        order = _order_by_cell(self._impl.mesh, xs)
+        return xs, rs, order
+
+
+@numba.njit(parallel=True)
+def _order_by_cell(mesh: _PE3Mesh, xs: np.ndarray):
+    '''
+    Stable counting sort of points by the (x0, x1) indices of their cells. 
+    Return the order.
+    '''
+    n, n_xs = mesh.n_grids, len(xs)
+    keys = np.empty(n_xs, dtype=np.int64)
+    for i in numba.prange(n_xs):
+        i0 = mesh.x2xi_1(xs[i, 0]) % n
+        i1 = mesh.x2xi_1(xs[i, 1]) % n
+        keys[i] = i0 * n + i1
+
+    heads = np.zeros(n * n + 1, dtype=np.int64)
+    for i in range(n_xs):
+        heads[keys[i] + 1] += 1
+    for p in range(n * n):
+        heads[p + 1] += heads[p]
+    order = np.empty(n_xs, dtype=np.int64)
+    for i in range(n_xs):
+        p = keys[i]
+        order[heads[p]] = i
+        heads[p] += 1
+    return order
+
+
+@numba.njit
+def _ball_1(pe: _PE3, x: np.ndarray, r: float, fill: bool, with_d: bool,
+            b_out: int, out_inds: np.ndarray, out_ds: np.ndarray) -> int:
+    '''
+    Return the number of points within a distance `r` of `x`. If `fill`, 
+    their indices (and distances if `with_d`) are written into the outputs,
+    starting at `b_out`.
+    '''
+    mesh = pe.mesh
+    n, l_box = mesh.n_grids, mesh.l_box
+    l_half = .5 * l_box
+    r2 = r * r
+    lbs = mesh.x2xi_3(x - r)
+    ubs = mesh.x2xi_3(x + r) + 1
+    for k in range(3):
+        if ubs[k] - lbs[k] > n:                 # each cell at most once
+            ubs[k] = lbs[k] + n
+    cell_firsts, xs, inds = pe.cell_firsts, pe.xs, pe.inds
+    cnt = 0
+    for i0 in range(lbs[0], ubs[0]):
+        i0_p = i0 % n
+        for i1 in range(lbs[1], ubs[1]):
+            i1_p = i1 % n
+            for i2 in range(lbs[2], ubs[2]):
+                i_f = (i0_p * n + i1_p) * n + i2 % n
+                for j in range(cell_firsts[i_f], cell_firsts[i_f+1]):
+                    d2 = 0.
+                    for k in range(3):
+                        dv = _min_image(xs[j, k] - x[k], l_box, l_half)
+                        d2 += dv * dv
+                    if d2 > r2:
+                        continue
+                    if fill:
+                        out_inds[b_out + cnt] = inds[j]
+                        if with_d:
+                            out_ds[b_out + cnt] = np.sqrt(d2)
+                    cnt += 1
+    return cnt
+
+
+@numba.njit(parallel=True)
+def _count_radius(pe: _PE3, xs: np.ndarray, rs: np.ndarray,
+                  order: np.ndarray, counts: np.ndarray):
+    dummy_i, dummy_d = np.empty(0, np.int64), np.empty(0, np.float64)
+    for j in numba.prange(len(order)):
+        i = order[j]
+        counts[i] = _ball_1(pe, xs[i], rs[i], False, False, 0,
+                            dummy_i, dummy_d)
+
+
+@numba.njit(parallel=True)
+def _query_radius(pe: _PE3, xs: np.ndarray, rs: np.ndarray,
+                  order: np.ndarray, offsets: np.ndarray, with_d: bool,
+                  indices: np.ndarray, ds: np.ndarray):
+    for j in numba.prange(len(order)):
+        i = order[j]
+        _ball_1(pe, xs[i], rs[i], True, with_d, offsets[i], indices, ds)
+
+
+@numba.njit
+def _heap_sift_down(ds: np.ndarray, inds: np.ndarray, p: int, n: int):
+    '''
+    Max-heap of the first n items of (ds, inds), ordered by ds.
+    '''
+    d, ind = ds[p], inds[p]
+    while True:
+        c = 2 * p + 1
+        if c >= n:
+            break
+        if c + 1 < n and ds[c + 1] > ds[c]:
+            c += 1
+        if ds[c] <= d:
+            break
+        ds[p], inds[p] = ds[c], inds[c]
+        p = c
+    ds[p], inds[p] = d, ind
+
+
+@numba.njit
+def _heap_push(ds: np.ndarray, inds: np.ndarray, n: int, d: float,
+               ind: int):
+    p = n
+    while p > 0:
+        q = (p - 1) // 2
+        if ds[q] >= d:
+            break
+        ds[p], inds[p] = ds[q], inds[q]
+        p = q
+    ds[p], inds[p] = d, ind
+
+
+@numba.njit
+def _knn_1(pe: _PE3, x: np.ndarray, ds: np.ndarray, inds: np.ndarray):
+    '''
+    Fill (ds, inds), of length k, with the k nearest neighbors of x, 
+    sorted.
+    '''
+    mesh = pe.mesh
+    n, l_box, l_grid = mesh.n_grids, mesh.l_box, mesh.l_grid
+    l_half = .5 * l_box
+    cell_firsts, xs, pt_inds = pe.cell_firsts, pe.xs, pe.inds
+    k = len(ds)
+    cs = mesh.x2xi_3(x) % n
+    # offsets of cells in [-h_lo, h_hi] cover each cell once, by its 
+    # nearest image
+    h_lo, h_hi = n // 2, n - 1 - n // 2
+    cnt = 0
+    for s in range(h_lo + 1):
+        if cnt == k and ds[0] <= (s - 1) * (s - 1) * l_grid * l_grid \
+                and s > 0:
+            break
+        lo, hi = max(-s, -h_lo), min(s, h_hi)
+        for d0 in range(lo, hi + 1):
+            i0_p = (cs[0] + d0) % n
+            for d1 in range(lo, hi + 1):
+                i1_p = (cs[1] + d1) % n
+                on_shell = abs(d0) == s or abs(d1) == s
+                for d2 in range(lo, hi + 1):
+                    if not on_shell and abs(d2) != s:
+                        continue
+                    i_f = (i0_p * n + i1_p) * n + (cs[2] + d2) % n
+                    for j in range(cell_firsts[i_f], cell_firsts[i_f+1]):
+                        dd = 0.
+                        for a in range(3):
+                            dv = _min_image(xs[j, a] - x[a], l_box, l_half)
+                            dd += dv * dv
+                        if cnt < k:
+                            _heap_push(ds, inds, cnt, dd, pt_inds[j])
+                            cnt += 1
+                        elif dd < ds[0]:
+                            ds[0], inds[0] = dd, pt_inds[j]
+                            _heap_sift_down(ds, inds, 0, k)
+
+    # heap sort into ascending order
+    for e in range(cnt - 1, 0, -1):
+        ds[0], ds[e] = ds[e], ds[0]
+        inds[0], inds[e] = inds[e], inds[0]
+        _heap_sift_down(ds, inds, 0, e)
+    for j in range(cnt):
+        ds[j] = np.sqrt(ds[j])
+    for j in range(cnt, k):
+        ds[j], inds[j] = np.inf, len(pt_inds)
+
+
+@numba.njit(parallel=True)
+def _query_k(pe: _PE3, xs: np.ndarray, order: np.ndarray, ds: np.ndarray,
+             inds: np.ndarray):
+    for j in numba.prange(len(order)):
+        i = order[j]
+        _knn_1(pe, xs[i], ds[i], inds[i])
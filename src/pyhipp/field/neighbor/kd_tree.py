@@ -2,6 +2,7 @@ from __future__ import annotations
 import typing
 from typing import Self
 from pyhipp.core.abc import HasDictRepr
+from pyhipp.core.dataproc import periodic
 from scipy.spatial import KDTree
 from ..cubic_box.mesh import Mesh
 import numpy as np
@@ -34,7 +35,7 @@ class PE(HasDictRepr):
         Return indices. If return_d is True, return (indices, distances).
         '''
         x = np.asarray(x)
-        assert (x >= 0.0).all() and (x < self.l_box).all()
+        assert periodic.in_bounds(x, self.l_box)
 
         ids = self.impl.query_ball_point(x, r, workers=self.n_workers)
         ids = np.asarray(ids, dtype=np.int64)
@@ -43,10 +44,18 @@ class PE(HasDictRepr):
         d = self.__d(x, self.impl.data[ids])
         return ids, d
 
+    def query_k(self, xs: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Find the k nearest neighbors of each point in xs, shape (n, 3).
+        Return (distances, indices), each of shape (n, k), sorted by 
+        distance. Points in the tree coinciding with xs are included.
+        '''
+        xs = np.asarray(xs)
+        assert periodic.in_bounds(xs, self.l_box)
+
+        d, ids = self.impl.query(xs, k=[k] if k == 1 else k,
+                                 workers=self.n_workers)
+        return d.reshape(len(xs), k), ids.reshape(len(xs), k)
+
     def __d(self, x1: np.ndarray, x2: np.ndarray):
-        l_box = self.l_box
-        l_half = 0.5 * l_box
-        dx = x2 - x1
-        dx[dx > l_half] -= l_box
-        dx[dx < -l_half] += l_box
-        return np.linalg.norm(dx, axis=-1)
+        return periodic.distance(x1, x2, self.l_box)
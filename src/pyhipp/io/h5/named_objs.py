@@ -158,7 +158,8 @@ class DatasetManager(Obj):
     def __dir__(self) -> Iterable[str]:
         return list(super().__dir__()) + list(self.__keys())
 
-    def create(self, key, data, flag: CreateFlag = 'x') -> Dataset:
+    def create(self, key, data, flag: CreateFlag = 'x',
+               **create_kw) -> Dataset:
         '''
         Create a dataset with given data.
         
@@ -166,6 +167,9 @@ class DatasetManager(Obj):
             'x': raise ValueError.
             'ac' or 'ca': overwrite if it is an dataset, otherwise raise 
             ValueError.
+        @create_kw: storage options passed to h5py for a new dataset, e.g., 
+            chunks, compression, compression_opts, shuffle. Ignored for an 
+            overwritten one.
         '''
         if flag not in ('x', 'ac', 'ca'):
             raise ValueError(f'Invalid argument {flag=}')
@@ -178,12 +182,12 @@ class DatasetManager(Obj):
                 raise ValueError(f'key {key} does not refer to a dataset')
             val[...] = data
         else:
-            val = self._raw.create_dataset(key, data=data)
+            val = self._raw.create_dataset(key, data=data, **create_kw)
 
         return Dataset(val)
 
     def create_empty(self, key: str, shape: Tuple[int, ...], dtype: np.dtype,
-                     flag: CreateFlag = 'x') -> None:
+                     flag: CreateFlag = 'x', **create_kw) -> None:
         '''
         Create an empty dataset with given shape and dtype. Return the newly 
         created one.
@@ -193,6 +197,8 @@ class DatasetManager(Obj):
             one of:
             'x': raise ValueError.
             'ac' or 'ca': open and return the dataset.
+        @create_kw: storage options passed to h5py for a new dataset, e.g., 
+            chunks, compression, compression_opts, shuffle.
         '''
         if flag not in ('x', 'ac', 'ca'):
             raise ValueError(f'Invalid argument {flag=}')
@@ -204,7 +210,8 @@ class DatasetManager(Obj):
             if not isinstance(val, h5py.Dataset):
                 raise ValueError(f'key {key} does not refer to a dataset')
         else:
-            val = self._raw.create_dataset(key, shape=shape, dtype=dtype)
+            val = self._raw.create_dataset(key, shape=shape, dtype=dtype,
+                                           **create_kw)
 
         return Dataset(val)
 
@@ -219,9 +226,16 @@ class DatasetManager(Obj):
         for k, v in self.__items():
             yield k, v[()]
 
-    def load(self, key_re: str = None, keys: Iterable[str] = None) -> DataDict:
+    def load(self, key_re: str = None, keys: Iterable[str] = None,
+             mmap: bool | Dataset.MmapMode = False) -> DataDict:
+        '''
+        @mmap: whether to memory-map the datasets. See Dataset.load().
+        '''
         keys = self.keys() if keys is None else KeyList(keys)
-        return DataDict({k: self[k] for k in keys.matched(key_re)})
+        if not mmap:
+            return DataDict({k: self[k] for k in keys.matched(key_re)})
+        return DataDict({k: Dataset(self._raw[k]).load(mmap=mmap)
+                         for k in keys.matched(key_re)})
 
     def dump(self, data_dict: Mapping, flag: CreateFlag = 'x'):
         for k, v in data_dict.items():
@@ -263,6 +277,20 @@ class NamedObj(Obj):
     def attrs(self) -> AttrManager:
         return AttrManager(self._raw.attrs)
 
+    @property
+    def name(self) -> str:
+        '''
+        Absolute path of the object within its file.
+        '''
+        return self._raw.name
+
+    @property
+    def file_name(self) -> str:
+        '''
+        Name of the file containing the object.
+        '''
+        return self._raw.file.filename
+
     def __repr__(self) -> str:
         name = type(self).__name__
         return f'{name}(raw={self._raw})'
@@ -271,6 +299,7 @@ class NamedObj(Obj):
 class Dataset(NamedObj):
 
     Raw = h5py.Dataset
+    MmapMode = Literal['r', 'c', 'r+']
 
     def __init__(self, raw: Raw = None, **kw) -> None:
         super().__init__(raw, **kw)
@@ -282,6 +311,49 @@ class Dataset(NamedObj):
     def __setitem__(self, key, val) -> None:
         self._raw[key] = val
 
+    def load(self, mmap: bool | MmapMode = False) -> Union[np.ndarray, Any]:
+        '''
+        Load the whole dataset.
+        
+        @mmap: if True or a mode of np.memmap ('r', 'c' or 'r+'; True for 
+            'r'), return a memory map of the dataset if it is memmappable 
+            (see as_memmap()) and not a scalar. Otherwise, read the data 
+            into memory.
+        '''
+        if mmap and self.ndim > 0 and self.memmappable:
+            return self.as_memmap('r' if mmap is True else mmap)
+        return self._raw[()]
+
+    def as_memmap(self, mode: MmapMode = 'r') -> np.memmap:
+        '''
+        Map the dataset into memory without reading it, i.e., pages are 
+        loaded from the file on access.
+        
+        @mode: 'r' for read-only, 'c' for copy-on-write (changes are kept 
+            in memory, e.g., for the functions requiring writable arrays), 
+            'r+' for writing through to the file (the file must be opened 
+            writable by h5py as well, and no cached copy is updated).
+        
+        Raise ValueError if the dataset is not memmappable.
+        '''
+        if not self.memmappable:
+            raise ValueError(f'Dataset {self.name} cannot be memory-mapped. '
+                             'It must be contiguous (i.e., not chunked or '
+                             'compressed), allocated, of a fixed-size '
+                             'numeric dtype, and stored in a file on disk.')
+        raw = self._raw
+        return np.memmap(raw.file.filename, dtype=raw.dtype, mode=mode,
+                         offset=raw.id.get_offset(), shape=raw.shape)
+
+    @property
+    def memmappable(self) -> bool:
+        raw = self._raw
+        dtype = raw.dtype
+        return (raw.chunks is None and raw.external is None
+                and raw.file.driver in ('sec2', 'stdio')
+                and raw.id.get_offset() is not None
+                and dtype.fields is None and dtype.kind in 'biufc')
+
     @property
     def dtype(self):
         return self._raw.dtype
@@ -389,16 +461,18 @@ class Group(NamedObj):
             else:
                 dsets.create(k, v, flag=flag)
 
-    def load(self) -> DataDict:
+    def load(self, mmap: bool | Dataset.MmapMode = False) -> DataDict:
         '''
         Load the data group as a DataDict.
+        
+        @mmap: whether to memory-map the datasets. See Dataset.load().
         '''
         out = {}
         for k, v in self.items():
             if isinstance(v, Group):
-                v_ld = v.load()
+                v_ld = v.load(mmap=mmap)
             elif isinstance(v, Dataset):
-                v_ld = v[()]
+                v_ld = v.load(mmap=mmap)
             else:
                 raise TypeError(f'Unknown value type {type(v)} for key {k}')
             out[k] = v_ld
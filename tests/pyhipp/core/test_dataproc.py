@@ -63,3 +63,61 @@ def test_bound_np_arr_ndim0(np_arr_ndim0: np.ndarray):
     assert a1 is a
 
 
+def test_periodic():
+    from pyhipp.core.dataproc import periodic
+    from pyhipp.core.dataproc.frame import PeriodicBox
+
+    rng = np.random.default_rng(0)
+    l_box, l_half = 10.0, 5.0
+    x0 = rng.uniform(-5.0, 15.0, size=(100, 3))
+
+    x = x0.copy()
+    assert periodic.wrap_in(x, l_box) == 0
+    ref = x0.copy()
+    ref[ref < 0.] += l_box
+    ref[ref >= l_box] -= l_box
+    assert np.array_equal(x, ref) and periodic.in_bounds(x, l_box)
+    assert not periodic.in_bounds(x0, l_box)
+    assert periodic.count_out_of_bounds([1.0, np.nan, 11.0], l_box) == 2
+
+    x_ref = np.array([1.0, 5.0, 9.0])
+    x = x0.copy()
+    assert periodic.shift_to(x, x_ref, l_box) == 0
+    dx = x - x_ref
+    assert (dx >= -l_half).all() and (dx < l_half).all()
+    ref_to = x0.copy()
+    dx = x0 - x_ref
+    ref_to[dx < -l_half] += l_box
+    ref_to[dx >= l_half] -= l_box
+    assert np.array_equal(x, ref_to)
+
+    dx = periodic.displacement(x_ref, x0, l_box)
+    assert np.allclose(dx, x - x_ref)
+    d = periodic.distance(x_ref, x0, l_box)
+    assert np.allclose(d, np.linalg.norm(x - x_ref, axis=-1))
+
+    x = x0.T.copy().T                   # not C-contiguous
+    where = np.zeros((100, 1), dtype=bool)
+    where[:10] = True
+    periodic.wrap_in(x, l_box, where=where)
+    assert np.array_equal(x[:10], ref[:10])
+    assert np.array_equal(x[10:], x0[10:])
+
+    x = PeriodicBox.shift_in(x0, l_box)
+    assert np.array_equal(x, ref)
+    rows_in = ((x0 >= 0.) & (x0 < l_box)).all(axis=1)
+    assert PeriodicBox.test_bound(x0, l_box, where=rows_in)
+    assert not PeriodicBox.test_bound(x0, l_box, where=~rows_in)
+
+
+def test_periodic_scalar():
+    from pyhipp.core.dataproc import periodic
+    from pyhipp.core.dataproc.frame import PeriodicBox
+
+    x = PeriodicBox.shift_in(np.array(-1.0), 10.0)
+    assert x.shape == () and x == 9.0
+    x = PeriodicBox.shift_to(np.array(9.0), np.array(1.0), 10.0)
+    assert x.shape == () and x == -1.0
+    x = np.array(12.0)
+    assert periodic.wrap_in(x, 10.0, where=np.array(True)) == 0
+    assert x == 2.0 and periodic.in_bounds(x, 10.0)
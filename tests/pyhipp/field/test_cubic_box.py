@@ -0,0 +1,566 @@
+from pyhipp.field.cubic_box import (
+    DensityField, MultiDensityField, DistributedDensityField, Field,
+    FFTSmoothing, FourierSpaceSmoothing, TidalField, PowerSpectrumEstimator,
+    FieldSampler, TidalClassifier, DumpPolicy)
+from pyhipp.field.cubic_box.mass_assignment import (
+    _new_sort_args, _sort_by_first_plane)
+from pyhipp.io import h5
+import pytest
+import numpy as np
+
+
+@pytest.fixture
+def particles():
+    rng = np.random.default_rng(10086)
+    xs = rng.uniform(-1.0, 11.0, size=(2000, 3))
+    weights = rng.uniform(0.5, 2.0, size=2000)
+    return xs, weights
+
+
+@pytest.mark.parametrize('scheme', ['ngp', 'cic', 'tsc', 'pcs'])
+def test_parallel_deposit(particles, scheme):
+    xs, weights = particles
+    for n_grids in (1, 2, 8):
+        for ws in (None, weights):
+            d_s = DensityField(10.0, n_grids, scheme=scheme)
+            d_s.add(xs, ws)
+            d_p = DensityField(10.0, n_grids, n_threads=4, scheme=scheme)
+            d_p.add(xs, ws)
+            assert np.array_equal(d_s.data, d_p.data)
+            # the slab kernel, also when only one thread is available
+            ma = DensityField(10.0, n_grids, scheme=scheme)._ma
+            DensityField._add_parallel(ma.data, ma.shape_fn, xs, ws,
+                                       _new_sort_args(len(xs)))
+            assert np.array_equal(d_s.data, ma.data)
+    assert np.isclose(d_s.data.sum(), weights.sum())
+
+    shape_fn = DensityField(10.0, 8, scheme=scheme)._ma.shape_fn
+    args = _new_sort_args(len(xs))
+    assert args.dtype == np.int32
+    firsts = _sort_by_first_plane(shape_fn, xs, args, 3)
+    i0s = np.array([shape_fn.stencil_at(x)[0] for x in xs[:, 0]])
+    assert np.array_equal(args, np.argsort(i0s, kind='stable'))
+    assert np.array_equal(firsts, np.searchsorted(i0s[args], np.arange(9)))
+
+
+def test_interlace(particles):
+    xs, _ = particles
+    l_box, n_grids = 10.0, 16
+    d = DensityField(l_box, n_grids, scheme='tsc', interlace=True)
+    d.add(xs)
+    kw = dict(r_sm=1.0e-3, correct_shape='tsc')
+    res_i = FourierSpaceSmoothing(**kw).run(d.field, d.field_shifted)
+    res = FourierSpaceSmoothing(**kw).run(d.field)
+
+    ki = np.stack(np.meshgrid(*[np.arange(1, 7)]*3), axis=-1).reshape(-1, 3)
+    delta_k = np.exp(-2.0j * np.pi / l_box * (xs @ ki.T)).mean(0)
+    delta_k *= n_grids**1.5     # 'ortho' normalization
+    i0, i1, i2 = ki.T
+    err_i = np.abs(res_i.delta_sm_k[i0, i1, i2] - delta_k).mean()
+    err = np.abs(res.delta_sm_k[i0, i1, i2] - delta_k).mean()
+    assert err_i < 0.25 * err
+
+
+def test_float32(particles):
+    xs, weights = particles
+    fields = []
+    for dtype in (np.float64, np.float32):
+        d = DensityField(10.0, 8, dtype=dtype)
+        d.add(xs, weights)
+        assert d.data.dtype == dtype
+        fields.append(d.field)
+    res_64, res_32 = [TidalField(r_sm=2.0).run(f) for f in fields]
+    for key in 'delta_x', 'delta_sm_x', 'T_x', 'lam':
+        assert getattr(res_32, key).dtype == np.float32
+    assert res_32.phi_k.dtype == np.complex64
+    assert np.allclose(res_32.lam, res_64.lam, atol=1.0e-4)
+
+
+def test_add_from_h5(particles, tmp_path):
+    xs, weights = particles
+    with h5.File(tmp_path / 'particles.hdf5', 'w') as f:
+        f.dump({'x': xs, 'w': weights})
+        for n_threads in (None, 2):
+            d = DensityField(10.0, 8, n_threads=n_threads, scheme='tsc')
+            d.add(xs, weights)
+            d_h5 = DensityField(10.0, 8, n_threads=n_threads, scheme='tsc')
+            d_h5.add_from_h5(f, 'x', 'w', chunk_size=300)
+            assert np.array_equal(d.data, d_h5.data)
+
+
+def test_join_dumps(particles, tmp_path):
+    xs, weights = particles
+    paths = []
+    for i in range(5):
+        d = DensityField(10.0, 8, interlace=True)
+        d.add(xs[i::5], weights[i::5])
+        paths.append(tmp_path / f'dump_{i}.hdf5')
+        with h5.File(paths[-1], 'w') as f:
+            d.dump(f)
+    files = [h5.File(p) for p in paths]
+    with h5.File(tmp_path / 'joined.hdf5', 'w') as f:
+        DensityField.join_dumps(files, f.create_group('mem'))
+        DensityField.join_dumps(files, f.create_group('tree_1'),
+                                n_workers=1, slab_size=3)
+        DensityField.join_dumps(files, f.create_group('tree_2'),
+                                n_workers=2)
+        mem, tree_1, tree_2 = [f[k].load() for k in ('mem', 'tree_1', 'tree_2')]
+    for file in files:
+        file.close()
+    for key in 'data', 'data_shifted':
+        assert np.allclose(mem[key], tree_1[key])
+        assert np.array_equal(tree_1[key], tree_2[key])
+    assert tree_1['n_grids'] == 8 and tree_1['l_box'] == 10.0
+
+    with h5.File(tmp_path / 'joined.hdf5') as f:
+        field = DensityField.load(f['tree_1'], mmap=True)
+        assert isinstance(field.data, np.memmap)
+        assert np.array_equal(field.data, tree_1['data'])
+
+
+def test_add_sph(particles):
+    xs, weights = particles
+    xs = xs % 10.0
+    d_s = DensityField(10.0, 8)
+    d_s.add_sph(xs, weights=weights, n_ngbs=8)
+    d_p = DensityField(10.0, 8, n_threads=2)
+    d_p.add_sph(xs, weights=weights, n_ngbs=8)
+    assert np.isclose(d_s.data.sum(), weights.sum())
+    assert np.array_equal(d_s.data, d_p.data)
+    # the slab kernel, also when only one thread is available
+    hs = d_s.find_smoothing_lengths(xs, 8)
+    hs[:10], hs[10:20] = 0.0, 5.0
+    d_s = DensityField(10.0, 8)
+    d_s.add_sph(xs, hs, weights)
+    for n_slabs in (2, 3, 16):
+        ma = DensityField(10.0, 8)._ma
+        DensityField._add_sph_parallel(ma.data, ma.shape_fn, xs, hs, weights,
+                                       _new_sort_args(len(xs)), n_slabs)
+        assert np.array_equal(d_s.data, ma.data)
+
+    # Points covering no grid point fall back to the assignment scheme.
+    d_sph, d = DensityField(10.0, 8), DensityField(10.0, 8)
+    x_c = np.array([[0.6, 0.6, 0.6]])
+    d_sph.add_sph(x_c, np.array([0.1]))
+    d.add(x_c)
+    assert np.array_equal(d_sph.data, d.data)
+
+    # Smoothing lengths beyond l_box/2 are clipped, wrapping only once.
+    d_big, d_half = DensityField(10.0, 8), DensityField(10.0, 8)
+    with pytest.warns(UserWarning):
+        d_big.add_sph(xs[:10], np.full(10, 30.0), weights[:10])
+    d_half.add_sph(xs[:10], np.full(10, 5.0), weights[:10])
+    assert np.isclose(d_big.data.sum(), weights[:10].sum())
+    assert np.array_equal(d_big.data, d_half.data)
+
+
+@pytest.mark.parametrize('scheme', ['cic', 'pcs'])
+def test_multi_deposit(particles, scheme):
+    xs, weights = particles
+    ws = np.column_stack([weights, weights * xs[:, 0], -weights])
+    for n_threads in (None, 2):
+        d = MultiDensityField(10.0, 8, 3, n_threads=n_threads,
+                              scheme=scheme, interlace=True)
+        d.add(xs, ws)
+        for q in range(3):
+            d_q = DensityField(10.0, 8, scheme=scheme, interlace=True)
+            d_q.add(xs, ws[:, q])
+            assert np.array_equal(d.data[q], d_q.data)
+            assert np.array_equal(d.data_shifted[q], d_q.data_shifted)
+
+
+def test_distributed(particles):
+    xs, weights = particles
+    d = DensityField(10.0, 8, scheme='tsc')
+    d.add(xs, weights)
+    res_sm = FourierSpaceSmoothing(r_sm=1.0, correct_shape='tsc').run(d.field)
+    res_t = TidalField(r_sm=1.0, correct_shape='tsc').run(d.field)
+    for n_workers in (1, 2):
+        with DistributedDensityField(10.0, 8, n_workers=n_workers,
+                                     scheme='tsc', chunk_size=700) as d_d:
+            d_d.add(xs, weights)
+            assert np.array_equal(d_d.data, d.data)
+            res = d_d.run_smoothing(r_sm=1.0)
+            assert np.allclose(res.delta_sm_x, res_sm.delta_sm_x)
+            res = d_d.run_tidal(r_sm=1.0)
+            assert res.T_x is None
+            for key in 'delta_k', 'phi_k', 'delta_sm_x', 'lam':
+                assert np.allclose(getattr(res, key), getattr(res_t, key))
+
+
+def test_kernel_cache():
+    from pyhipp.field.cubic_box.kernels import _kernel_of, _Tophat
+    from pyhipp.field.cubic_box.mass_assignment import _shape_fn_of
+    from pyhipp.field.cubic_box.mesh import _Mesh
+
+    K = _kernel_of(8, 10.0, 'tophat', 2.0, 'pcs')
+    assert _kernel_of(8, 10.0, 'tophat', 2.0, 'pcs') is K
+    mesh = _Mesh(8, 10.0)
+    sm, S = _Tophat(2.0, mesh), _shape_fn_of('pcs', mesh)
+    for i0, i1, i2 in [(0, 0, 0), (1, 7, 2), (4, 5, 4), (6, 3, 1)]:
+        ki = np.array([i0 - 8 if i0 > 4 else i0, i1 - 8 if i1 > 4 else i1,
+                       i2], dtype=float)
+        w = sm.window_at_ki(ki) / S.shape_at_ki_nd(ki)
+        assert np.isclose(K.at(i0, i1, i2), w, rtol=1.0e-12)
+
+
+def test_tidal_field_lean(particles):
+    xs, weights = particles
+    d = DensityField(10.0, 8)
+    d.add(xs, weights)
+    res = TidalField(r_sm=1.0).run(d.field)
+    res_lean = TidalField(r_sm=1.0, keep=('delta_sm_x',)).run(d.field)
+    assert np.allclose(res_lean.lam, res.lam, rtol=0.0, atol=1.0e-12)
+    assert np.array_equal(res_lean.delta_sm_x, res.delta_sm_x)
+    for key in 'rho_x', 'delta_x', 'delta_k', 'delta_sm_k', 'phi_k', 'T_x':
+        assert getattr(res_lean, key) is None
+    with pytest.raises(ValueError):
+        TidalField(keep=('lam_x',))
+
+
+def test_run_many(particles, tmp_path):
+    from pyhipp.field.cubic_box.cosmic_web import FieldInterpolator
+
+    xs, weights = particles
+    d = DensityField(10.0, 8)
+    d.add(xs, weights)
+    r_sms, methods = [0.5, 1.0, 2.0], ['gaussian', 'tophat', 'gaussian']
+    sm = FourierSpaceSmoothing(r_sm=1.0)
+    res = sm.run_many(d.field, r_sms, methods, xs=xs[:10])
+    res_fft = FFTSmoothing().run_many(d.field, r_sms, methods)
+    for i, (r_sm, method) in enumerate(zip(r_sms, methods)):
+        res_1 = FourierSpaceSmoothing(r_sm=r_sm, method=method).run(d.field)
+        assert np.allclose(res.smoothed[i], res_1.delta_sm_x)
+        field = FFTSmoothing(r_sm=r_sm, method=method).run(d.field)
+        assert np.allclose(res_fft.smoothed[i], field.data)
+        field = Field.new_by_data(res_1.delta_sm_x, d.field.mesh)
+        values = FieldInterpolator(field).value_at(xs[:10])
+        assert np.allclose(res.values[i], values)
+
+    with h5.File(tmp_path / 'many.hdf5', 'w') as f:
+        res_h5 = sm.run_many(d.field, r_sms, methods, xs=xs[:10], out=f)
+        assert res_h5.smoothed is None
+        assert np.array_equal(f['smoothed'][()], np.stack(res.smoothed))
+        assert np.array_equal(f.datasets['values'], res.values)
+
+
+def test_fft_backend(particles):
+    pytest.importorskip('pyfftw')
+    from pyhipp.field.cubic_box import fft
+
+    rng = np.random.default_rng(0)
+    for dtype, atol in (np.float64, 1.0e-12), (np.float32, 1.0e-4):
+        x = rng.normal(size=(8, 8, 8)).astype(dtype)
+        f_s = fft.NdRealFFT(norm='ortho', backend='scipy')
+        f_w = fft.NdRealFFT(norm='ortho', backend='pyfftw')
+        x_k = f_w.forward(x)
+        assert x_k.dtype == f_s.forward(x).dtype
+        assert np.allclose(x_k, f_s.forward(x), atol=atol)
+        x_k_in = x_k.copy()
+        assert np.allclose(f_w.backward(x_k), x, atol=atol)
+        assert np.array_equal(x_k, x_k_in)
+
+        buf, buf_k = fft.NdRealFFT.new_inplace_buffer(x.shape, dtype)
+        buf[...] = x
+        assert f_w.forward(buf, out=buf_k) is buf_k
+        assert np.allclose(buf_k, x_k, atol=atol)
+        f_w.backward(buf_k, out=buf)
+        assert np.allclose(buf, x, atol=atol)
+
+    backend = fft.PyfftwFFTBackend(max_bytes=20000)
+    for n in (6, 8, 10, 12):
+        x = rng.normal(size=(n, n, n))
+        assert np.allclose(backend.rfftn(x), np.fft.rfftn(x))
+        assert 0 < backend.n_cached_bytes <= backend.max_bytes
+    x_k = np.fft.rfftn(x)
+    slab, x_k_in = x_k[:, :, 2:5], x_k[:, :, 2:5].copy()
+    assert backend.ifftn(slab, axes=(0,), norm='ortho', out=slab) is slab
+    assert np.allclose(slab, np.fft.ifftn(x_k_in, axes=(0,), norm='ortho'))
+    backend.clear()
+    assert backend.n_cached_bytes == 0
+
+    d = DensityField(10.0, 8)
+    d.add(*particles)
+    res = TidalField(r_sm=1.0).run(d.field)
+    fft.set_default_fft_backend('pyfftw')
+    try:
+        res_w = TidalField(r_sm=1.0).run(d.field)
+        with DistributedDensityField(10.0, 8, n_workers=1) as d_d:
+            d_d.add(*particles)
+            res_d = d_d.run_tidal(r_sm=1.0)
+            assert np.allclose(res_d.lam, res.lam)
+    finally:
+        fft.set_default_fft_backend('scipy')
+    assert np.allclose(res_w.lam, res.lam)
+
+
+def _solve_grav_tidal_ref(delta_k, K, G):
+    '''
+    Point-by-point reference of TidalField._solve_grav_tidal().
+    '''
+    N = K.n_grids
+    ki = np.array([i - N if i > N // 2 else i for i in range(N)], dtype=float)
+    delta_sm_k, phi_k = np.empty_like(delta_k), np.empty_like(delta_k)
+    Ts_k = [np.empty_like(delta_k) for _ in range(6)]
+    for i0, i1, i2 in np.ndindex(delta_k.shape):
+        delta_sm_k[i0, i1, i2] = delta_k[i0, i1, i2] * K.at(i0, i1, i2)
+        phi_k[i0, i1, i2] = delta_sm_k[i0, i1, i2] * G.at(i0, i1, i2)
+        k = ki[i0], ki[i1], float(i2)
+        for T_k, (i, j) in zip(Ts_k, [(0, 0), (1, 0), (1, 1), (2, 0),
+                                      (2, 1), (2, 2)]):
+            T_k[i0, i1, i2] = -k[i] * k[j] * phi_k[i0, i1, i2]
+    return delta_sm_k, phi_k, Ts_k
+
+
+@pytest.mark.parametrize('n_grids', [7, 8])
+def test_fused_k_space(particles, n_grids):
+    from pyhipp.field.cubic_box.kernels import _kernel_of
+
+    xs, weights = particles
+    N = n_grids
+    d = DensityField(10.0, N)
+    d.add(xs, weights)
+    delta_k = np.fft.rfftn(TidalField._normalize(d.data), norm='ortho')
+    K = _kernel_of(N, 10.0, 'gaussian', 1.0, 'cic')
+    G = _kernel_of(N, 10.0, 'green')
+    delta_sm_k, phi_k, Ts_k = _solve_grav_tidal_ref(delta_k, K, G)
+
+    outs = [np.empty_like(delta_k) for _ in range(8)]
+    TidalField._solve_grav_tidal(delta_k, K, G, tuple(outs[2:]), *outs[:2])
+    for out, ref in zip(outs, [delta_sm_k, phi_k, *Ts_k]):
+        assert np.allclose(out, ref, rtol=1.0e-12, atol=0.0)
+    assert np.array_equal(
+        FFTSmoothing._smooth(delta_k, K), FourierSpaceSmoothing._smooth(
+            delta_k, K, np.empty_like(delta_k)))
+
+
+def test_odd_n_grids(particles):
+    xs, weights = particles
+    N = 5
+    d = DensityField(10.0, N)
+    d.add(xs, weights)
+    res = FourierSpaceSmoothing(r_sm=1.0).run(d.field)
+    delta_sm_x = np.fft.irfftn(res.delta_sm_k, s=(N, N, N), axes=(0, 1, 2),
+                               norm='ortho')
+    assert np.allclose(res.delta_sm_x, delta_sm_x)
+    field = FFTSmoothing(r_sm=1.0).run(d.field)
+    assert field.data.shape == (N, N, N)
+    res_many = FourierSpaceSmoothing().run_many(d.field, [1.0, 2.0])
+    assert np.allclose(res_many.smoothed[0], delta_sm_x)
+
+    res = TidalField(r_sm=1.0).run(d.field)
+    assert res.T_x.shape == (N, N, N, 3, 3)
+    T00_k = -np.fft.fftfreq(N, 1.0 / N)[:, None, None]**2 * res.phi_k
+    assert np.allclose(res.T_x[..., 0, 0],
+                       np.fft.irfftn(T00_k, s=(N, N, N), axes=(0, 1, 2),
+                                     norm='ortho'))
+    assert np.allclose(res.lam, np.linalg.eigvalsh(res.T_x))
+    res_lean = TidalField(r_sm=1.0, keep=()).run(d.field)
+    assert np.allclose(res_lean.lam, res.lam)
+
+
+def test_power_spectrum(particles):
+    from pyhipp.field.cubic_box.mass_assignment import _shape_fn_of
+
+    xs, weights = particles
+    d = DensityField(10.0, 8, scheme='tsc')
+    d.add(xs)
+    est = PowerSpectrumEstimator(correct_shape='tsc')
+    res = est.run(d.field, shot_noise=10.0**3 / len(xs))
+
+    # Brute force over the full k-space.
+    N, l_grid = 8, 10.0 / 8
+    delta_k = np.fft.fftn(d.data / d.data.mean() - 1.0) / N**1.5
+    ki = np.fft.fftfreq(N, 1.0 / N)
+    S = _shape_fn_of('tsc', d.field.mesh._impl)
+    W = np.array([S.shape_at_ki(k) for k in ki])
+    p = np.abs(delta_k)**2 / np.einsum('i,j,k->ijk', W, W, W)**2 * l_grid**3
+    ki = np.sqrt(ki[:, None, None]**2 + ki[None, :, None]**2
+                 + ki[None, None, :]**2)
+    k = ki * 2.0 * np.pi / 10.0
+    b = np.searchsorted(res.k_edges, k, side='right') - 1
+    sel = (ki > 0.) & (b >= 0) & (b < len(res.P))
+    n_modes = np.bincount(b[sel], minlength=len(res.P))
+    P = np.bincount(b[sel], p[sel], minlength=len(res.P)) / n_modes
+    assert np.array_equal(res.n_modes, n_modes)
+    assert np.allclose(res.P, P - 10.0**3 / len(xs))
+    assert np.allclose(res.k, np.bincount(b[sel], k[sel]) / n_modes)
+
+    est = PowerSpectrumEstimator(correct_shape='tsc', n_mu_bins=3, los=0)
+    res_mu = est.run(d.field, d.field)
+    assert res_mu.P.shape == (len(res.P), 3)
+    assert np.array_equal(res_mu.n_modes.sum(1), res.n_modes)
+    P_avg = np.nansum(res_mu.P * res_mu.n_modes, axis=1) / res.n_modes
+    assert np.allclose(P_avg, P)
+
+
+def test_out_of_core(particles, tmp_path):
+    from pyhipp.field.cubic_box.fft import NdRealFFT
+
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(9, 9, 9))
+    fft = NdRealFFT(norm='ortho')
+    x_s, x_k = NdRealFFT.new_scratch_buffer(x.shape, dir=tmp_path)
+    x_s[...] = x
+    fft.forward_slabs(x_s, x_k, n_slab=2)
+    assert np.allclose(x_k, fft.forward(x))
+    out = fft.backward_slabs(x_k, np.empty_like(x), n_slab=4)
+    assert np.allclose(out, x)
+
+    xs, weights = particles
+    d = DensityField(10.0, 8)
+    d.add(xs, weights)
+    with h5.File(tmp_path / 'rho.hdf5', 'w') as f:
+        d.dump(f)
+    res_sm = FourierSpaceSmoothing(r_sm=1.0).run(d.field)
+    res_t = TidalField(r_sm=1.0).run(d.field)
+    with h5.File(tmp_path / 'rho.hdf5') as f, \
+            h5.File(tmp_path / 'out.hdf5', 'w') as g:
+        rho_x = DensityField.load(f, mmap=True)
+        FourierSpaceSmoothing(r_sm=1.0).run_out_of_core(
+            rho_x, g, n_slab=3, scratch_dir=tmp_path)
+        assert np.allclose(g['delta_sm_x'][()], res_sm.delta_sm_x)
+        TidalField(r_sm=1.0, keep=()).run_out_of_core(
+            rho_x, g.create_group('tidal'), n_slab=3, scratch_dir=tmp_path)
+        assert np.allclose(g['tidal/lam'][()], res_t.lam)
+
+
+@pytest.mark.parametrize('scheme', ['ngp', 'cic', 'tsc', 'pcs'])
+def test_field_sampler(particles, scheme):
+    xs, _ = particles
+    rng = np.random.default_rng(1)
+    data = rng.normal(size=(8, 8, 8, 3))
+    mesh = DensityField(10.0, 8).field.mesh
+    sampler = FieldSampler(mesh, scheme=scheme)
+    values = sampler.sample(data, xs)
+    assert values.shape == (len(xs), 3)
+    assert np.array_equal(
+        FieldSampler(mesh, scheme=scheme, sort=False).sample(data, xs),
+        values)
+    fields = [Field.new_by_data(np.ascontiguousarray(data[..., k]), mesh)
+              for k in range(3)]
+    assert np.array_equal(sampler.sample(fields, xs), values)
+    assert np.array_equal(sampler.sample(fields[1], xs), values[:, 1])
+
+    # Sampling is the adjoint of the assignment.
+    for x, value in zip(xs[:20], values[:20]):
+        d = DensityField(10.0, 8, scheme=scheme)
+        d.add(x[None])
+        assert np.allclose(np.einsum('ijk,ijkl->l', d.data, data), value)
+
+    lam = np.sort(data, axis=-1)
+    cls = TidalClassifier(lam, mesh)
+    lam_ngp = FieldSampler(mesh, scheme='ngp').sample(lam, xs)
+    assert np.array_equal(cls.lam_at(xs), lam_ngp.astype(np.float32))
+    assert cls.lam_at(xs).dtype == np.float32
+    assert np.array_equal(cls.web_type_at(xs),
+                          np.count_nonzero(lam_ngp > 0., axis=1))
+
+
+def test_tidal_classifier(tmp_path):
+    rng = np.random.default_rng(2)
+    lam = np.sort(rng.normal(size=(8, 8, 8, 3)), axis=-1).astype(np.float32)
+    with h5.File(tmp_path / 'lam.hdf5', 'w') as f:
+        f.dump({'lam': lam, 'n_grids': 8, 'l_box': 10.0})
+    with h5.File(tmp_path / 'lam.hdf5') as f:
+        cls = TidalClassifier.new_from_file(f, lam_th=0.1, mmap=True,
+                                            validate=True)
+        assert isinstance(cls.lam, np.memmap)
+        n_lams = np.count_nonzero(lam > np.float32(0.1), axis=-1)
+        assert cls.n_lams.dtype == np.int8
+        assert np.array_equal(cls.n_lams, n_lams)
+
+        idx = np.stack(np.meshgrid(*[np.arange(8)] * 3, indexing='ij'), -1)
+        for web_type in 'knot', 'filament', 'sheet', 'void':
+            sel = n_lams == cls.web_types[web_type]
+            assert np.isclose(getattr(cls, f'f_{web_type}'), sel.mean())
+            xs = cls.grid_points_of_web_type(web_type, n_slab=3)
+            assert np.array_equal(xs, (idx[sel] * 1.25).astype(np.float32))
+
+    with pytest.raises(ValueError):
+        TidalClassifier(lam[..., ::-1], cls.mesh, validate=True)
+
+
+def test_tidal_classifier_many(particles):
+    xs, _ = particles
+    rng = np.random.default_rng(3)
+    lam = np.sort(rng.normal(size=(8, 8, 8, 3)), axis=-1).astype(np.float32)
+    mesh = DensityField(10.0, 8).field.mesh
+    lam_ths = [-0.5, 0.0, 0.1, 0.7]
+    res = TidalClassifier.run_many(lam, mesh, lam_ths, xs=xs,
+                                   keep_grids=True)
+    assert res.counts.shape == (4, 4) and res.web_types_at.shape == (2000, 4)
+    for k, lam_th in enumerate(lam_ths):
+        cls = TidalClassifier(lam, mesh, lam_th=lam_th)
+        assert np.array_equal(res.n_lams[k], cls.n_lams)
+        assert np.array_equal(res.web_types_at[:, k], cls.web_type_at(xs))
+        assert np.isclose(res.fractions[k, 3], cls.f_knot)
+        assert np.isclose(res.fractions[k, 0], cls.f_void)
+
+
+def test_dump_policy(particles, tmp_path):
+    xs, weights = particles
+    d = DensityField(10.0, 8)
+    d.add(xs, weights)
+    res = TidalField(r_sm=1.0, keep=('delta_k', 'T_x')).run(d.field)
+    policy = DumpPolicy(keys=('delta_k', 'lam'), dtype=np.float32,
+                        compression='gzip', shuffle=True, n_slab=3)
+    with h5.File(tmp_path / 'out.hdf5', 'w') as f:
+        res.dump(f.create_group('all'))
+        res.dump(f.create_group('sel'), policy=policy)
+        g = f['sel']
+        assert set(g.keys()) == {'l_box', 'n_grids', 'delta_k', 'lam'}
+        assert g['lam'].dtype == np.float32
+        assert g['delta_k'].dtype == np.complex64
+        assert g._raw['lam'].compression == 'gzip'
+        assert np.allclose(g['lam'][()], res.lam, rtol=1e-5, atol=1e-6)
+        assert np.array_equal(f['all/T_x'][()], res.T_x)
+
+        rho_x = Field.new_by_data(d.field.data, d.field.mesh)
+        TidalField(r_sm=1.0).run_out_of_core(
+            rho_x, f.create_group('ooc'), policy=policy)
+        assert f['ooc/lam'].dtype == np.float32
+        assert 'delta_sm_x' not in f['ooc']
+
+
+def test_field_resampled():
+    from pyhipp.field.cubic_box import Mesh
+
+    n, l_box = 16, 10.0
+
+    def band_limited(n):
+        x = np.arange(n) * (l_box / n) * (2.0 * np.pi / l_box)
+        x0, x1, x2 = np.meshgrid(x, x, x, indexing='ij')
+        return np.cos(x0) + 0.5 * np.sin(3 * x1 + 2 * x2) \
+            + 0.2 * np.cos(5 * x0) * np.sin(x2)
+
+    field = Field.new_by_data(band_limited(n), Mesh.new(n, l_box))
+    up = field.resampled(32)
+    assert up.shape == (32, 32, 32) and up.mesh.l_box == l_box
+    assert np.allclose(up.data, band_limited(32))
+    assert np.allclose(up.resampled(n).data, field.data)
+    assert np.isclose(field.resampled(15).data.mean(), field.data.mean())
+
+    rho = Field.new_by_data(2.0 + field.data, field.mesh)
+    res = TidalField(r_sm=1.0, keep=('delta_k',)).run(rho)
+    delta = Field.new_by_data_k(res.delta_k, field.mesh, 32)
+    assert np.allclose(delta.data, band_limited(32) / 2.0)
+
+
+def test_periodic_box():
+    from pyhipp.field.cubic_box.box import _PeriodicBox
+
+    box = _PeriodicBox(10.0)
+    rng = np.random.default_rng(0)
+    x0 = rng.uniform(-5.0, 15.0, size=(10, 3))
+    for order in 'CF':
+        x = np.array(x0, order=order)
+        box.ishift_in(x)
+        assert np.allclose(x, x0 % 10.0)
+        x = np.array(x0, order=order)
+        box.ishift_to(x, np.full(3, 5.0))
+        assert np.allclose(x, x0 % 10.0)
+    x = x0.copy()
+    box.ishift_in(x[::2])
+    assert np.allclose(x[::2], x0[::2] % 10.0)
+    assert np.array_equal(x[1::2], x0[1::2])
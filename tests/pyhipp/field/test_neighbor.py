@@ -0,0 +1,48 @@
+from pyhipp.field.neighbor.kd_mesh import PeriodicCellIndex
+from scipy.spatial import KDTree
+import pytest
+import numpy as np
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    l_box = 10.0
+    xs = rng.uniform(0., l_box, size=(2000, 3))
+    xs_q = rng.uniform(0., l_box, size=(300, 3))
+    return l_box, xs, xs_q
+
+
+def test_cell_index_radius(points):
+    l_box, xs, xs_q = points
+    index = PeriodicCellIndex(xs, l_box, n_grids=8)
+    tree = KDTree(xs, boxsize=l_box)
+    rs = np.linspace(0.1, 2.0, len(xs_q))
+
+    offsets, indices, ds = index.query_radius(xs_q, rs, return_d=True)
+    assert offsets.shape == (len(xs_q) + 1,) and offsets[0] == 0
+    for i, ids in enumerate(tree.query_ball_point(xs_q, rs)):
+        b, e = offsets[i], offsets[i+1]
+        assert sorted(indices[b:e]) == sorted(ids)
+        dx = (xs[indices[b:e]] - xs_q[i] + 0.5 * l_box) % l_box - 0.5 * l_box
+        assert np.allclose(ds[b:e], np.linalg.norm(dx, axis=1))
+
+    counts = index.count_radius(xs_q, rs)
+    assert np.array_equal(counts, np.diff(offsets))
+    offsets, _ = index.query_radius(xs_q, 6.0)
+    assert (np.diff(offsets) == tree.query_ball_point(
+        xs_q, 6.0, return_length=True)).all()
+
+
+@pytest.mark.parametrize('n_grids', [1, 4, 8])
+def test_cell_index_knn(points, n_grids):
+    l_box, xs, xs_q = points
+    index = PeriodicCellIndex(xs, l_box, n_grids=n_grids)
+    ds, ids = index.query_k(xs_q, 5)
+    ds_ref, ids_ref = KDTree(xs, boxsize=l_box).query(xs_q, k=5)
+    assert ds.shape == ids.shape == (len(xs_q), 5)
+    assert np.allclose(ds, ds_ref) and np.array_equal(ids, ids_ref)
+
+    ds, ids = PeriodicCellIndex(xs[:3], l_box).query_k(xs_q, 4)
+    assert np.isinf(ds[:, 3]).all() and (ids[:, 3] == 3).all()
+    assert np.isfinite(ds[:, :3]).all()
@@ -283,4 +283,27 @@ def test_file_dump_load_example(tmp_path: Path):
         x = halos['x']
     
     print(id, x, v)
-    
\ No newline at end of file
+    
+
+def test_memmap(file_1):
+    f: h5.File = file_1['f']
+    a = np.arange(24.0).reshape(2, 3, 4)
+    dsets = f.datasets
+    dsets.dump({'a': a, 'b': 1})
+    dsets.create_empty('c', (4,), np.float32)
+    dsets.create('d', a, chunks=(1, 3, 4), compression='gzip')
+    e = dsets.create_empty('e', (2, 3, 4), np.float32, chunks=(1, 3, 4))
+    assert e._raw.chunks == (1, 3, 4)
+    f._raw.flush()
+
+    assert f['a'].memmappable and not f['d'].memmappable
+    m = f['a'].as_memmap()
+    assert isinstance(m, np.memmap) and (m == a).all()
+    with pytest.raises(ValueError):
+        f['d'].as_memmap()
+
+    d = f.load(mmap='c')
+    assert isinstance(d['a'], np.memmap) and d['b'] == 1
+    assert not isinstance(d['d'], np.memmap) and (d['d'] == a).all()
+    d['a'][0] = -1.0
+    assert (f['a'][()] == a).all()